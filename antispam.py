@@ -0,0 +1,823 @@
+import asyncio
+import io
+import logging
+import os
+import re
+import time
+from array import array
+from collections import OrderedDict, deque
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# Настройки антиспама: разбираются из c.ini один раз, а не на каждое сообщение
+class AntiSpamSettings:
+    __slots__ = ('max_messages', 'spam_seconds', 'mute_minutes', 'max_users', 'idle_seconds',
+                 'max_similar', 'time_window', 'similarity', 'similar_min_length')
+
+    def __init__(self, max_messages=6, spam_seconds=3.0, mute_minutes=10,
+                 max_users=10000, idle_seconds=600.0, max_similar=3, time_window=60.0,
+                 similarity=0.7, similar_min_length=20):
+        self.max_messages = max_messages
+        self.spam_seconds = spam_seconds
+        self.mute_minutes = mute_minutes
+        self.max_users = max_users
+        self.idle_seconds = idle_seconds
+        self.max_similar = max_similar
+        self.time_window = time_window
+        self.similarity = similarity
+        self.similar_min_length = similar_min_length
+
+    @classmethod
+    def from_config(cls, config, section='AntiSpam'):
+        return cls(
+            max_messages=config.getint(section, 'max_messages', fallback=6),
+            spam_seconds=config.getfloat(section, 'spam_seconds', fallback=3.0),
+            mute_minutes=config.getint(section, 'mute_minutes', fallback=10),
+            max_users=config.getint(section, 'max_users', fallback=10000),
+            idle_seconds=config.getfloat(section, 'idle_seconds', fallback=600.0),
+            max_similar=config.getint(section, 'max_similar', fallback=3),
+            time_window=config.getfloat(section, 'time_window', fallback=60.0),
+            similarity=config.getfloat(section, 'similarity', fallback=0.7),
+            similar_min_length=config.getint(section, 'similar_min_length', fallback=20)
+        )
+
+    # Копия с переопределёнными полями (настройки отдельного чата)
+    def copy(self, **overrides):
+        settings = AntiSpamSettings.__new__(AntiSpamSettings)
+        for name in self.__slots__:
+            setattr(settings, name, overrides.get(name, getattr(self, name)))
+        return settings
+
+
+# Детектор флуда: скользящее окно отметок времени на каждого пользователя
+class FloodDetector:
+    def __init__(self, settings, clock=time.monotonic):
+        self.settings = settings
+        self.clock = clock
+        # user_id -> array('d') времён; порядок вставки = порядок последней активности.
+        # array вместо deque: ~100 байт на пользователя против ~800 (блок deque + объекты float)
+        self.windows = OrderedDict()
+
+    def __len__(self):
+        return len(self.windows)
+
+    # user_id - любой хешируемый ключ (например, (chat_id, user_id)); settings - настройки чата
+    def hit(self, user_id, settings=None):
+        now = self.clock()
+        settings = settings or self.settings
+        windows = self.windows
+
+        window = windows.get(user_id)
+        if window is None:
+            self.evict(now)
+            window = windows[user_id] = array('d')
+        else:
+            windows.move_to_end(user_id)
+
+        border = now - settings.spam_seconds
+        stale = 0
+        while stale < len(window) and window[stale] <= border:
+            stale += 1
+        if stale:
+            del window[:stale]
+        window.append(now)
+
+        if len(window) > settings.max_messages:
+            # Сбрасываем окно, чтобы одна волна флуда не наказывалась повторно
+            del window[:]
+            return True
+        return False
+
+    def evict(self, now=None):
+        if now is None:
+            now = self.clock()
+        settings = self.settings
+        windows = self.windows
+        idle_border = now - settings.idle_seconds
+        while windows:
+            user_id, window = next(iter(windows.items()))
+            if len(windows) < settings.max_users and window and window[-1] > idle_border:
+                break
+            windows.popitem(last=False)
+
+    def reset(self, user_id):
+        self.windows.pop(user_id, None)
+
+
+# Скользящий счётчик входов в чат (защита от рейдов)
+class JoinRateCounter:
+    def __init__(self, window=60.0, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self.joins = {}  # chat_id -> deque((время, user_id))
+
+    def add(self, chat_id, user_ids):
+        now = self.clock()
+        joins = self.joins.get(chat_id)
+        if joins is None:
+            joins = self.joins[chat_id] = deque()
+        for user_id in user_ids:
+            joins.append((now, user_id))
+        border = now - self.window
+        while joins and joins[0][0] <= border:
+            joins.popleft()
+        if not joins:
+            del self.joins[chat_id]
+            return 0
+        return len(joins)
+
+    def recent(self, chat_id):
+        return [user_id for _, user_id in self.joins.get(chat_id, ())]
+
+
+# Индекс по скользящему окну settings.time_window: запись лежит в корзинах по своим ключам,
+# кандидаты на сходство - только записи с общим ключом
+class WindowIndex:
+    MAX_ENTRIES = 20000  # жёсткий предел размера индекса
+
+    def __init__(self, settings, clock=time.monotonic):
+        self.settings = settings
+        self.clock = clock
+        self.entries = deque()  # (время, id, ключи)
+        self.buckets = {}       # ключ -> {id: запись}
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def expire(self, now):
+        border = now - self.settings.time_window
+        entries = self.entries
+        buckets = self.buckets
+        while entries and (entries[0][0] <= border or len(entries) > self.MAX_ENTRIES):
+            _, entry_id, keys = entries.popleft()
+            for key in keys:
+                bucket = buckets.get(key)
+                if bucket is not None:
+                    bucket.pop(entry_id, None)
+                    if not bucket:
+                        del buckets[key]
+
+    def insert(self, now, keys, record):
+        entry_id = self.next_id
+        self.next_id += 1
+        buckets = self.buckets
+        for key in keys:
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = {entry_id: record}
+            else:
+                bucket[entry_id] = record
+        self.entries.append((now, entry_id, keys))
+
+
+# Поиск похожих сообщений (копипаста, рейды): MinHash + LSH по скользящему окну
+class SimilarityDetector(WindowIndex):
+    SHINGLE = 4          # длина шингла в символах
+    BANDS = 12           # LSH: число полос
+    ROWS = 4             # LSH: хешей в полосе
+    MAX_TEXT = 1000      # дальше текст не шинглуется
+
+    _cleanup = re.compile(r'[\W_]+')
+
+    def __init__(self, settings, clock=time.monotonic):
+        super().__init__(settings, clock)
+        self.size = self.BANDS * self.ROWS
+
+    def normalize(self, text):
+        return self._cleanup.sub(' ', text[:self.MAX_TEXT].casefold()).strip()
+
+    # One Permutation Hashing: один хеш на шингл, минимум в каждой из size корзин
+    def signature(self, text):
+        size = self.size
+        step = self.SHINGLE
+        mins = [None] * size
+        for i in range(max(1, len(text) - step + 1)):
+            h = hash(text[i:i + step]) & 0xFFFFFFFFFFFFFFFF
+            slot = h % size
+            value = h // size
+            current = mins[slot]
+            if current is None or value < current:
+                mins[slot] = value
+        # Уплотнение: пустые корзины берут значение ближайшей непустой справа
+        if None in mins:
+            filled = [i for i, value in enumerate(mins) if value is not None]
+            for i in range(size):
+                if mins[i] is None:
+                    for j in filled:
+                        if j > i:
+                            break
+                    else:
+                        j = filled[0]
+                    mins[i] = mins[j] + (j - i) % size
+        return tuple(mins)
+
+    def band_keys(self, signature):
+        rows = self.ROWS
+        return [(band, signature[band * rows:(band + 1) * rows]) for band in range(self.BANDS)]
+
+    # Возвращает множество user_id, чьи сообщения похожи на это (включая автора),
+    # если похожих в окне больше max_similar, иначе None
+    def check(self, user_id, text):
+        settings = self.settings
+        text = self.normalize(text)
+        if len(text) < settings.similar_min_length:
+            return None
+
+        now = self.clock()
+        self.expire(now)
+
+        signature = self.signature(text)
+        keys = self.band_keys(signature)
+        size = self.size
+        need = settings.similarity * size
+
+        buckets = self.buckets
+        limit = settings.max_similar
+        users = {user_id}
+        similar = 0
+        seen = set()
+        for key in keys:
+            bucket = buckets.get(key)
+            if not bucket:
+                continue
+            for other_id, (other_user, other_signature) in bucket.items():
+                if other_id in seen:
+                    continue
+                seen.add(other_id)
+                same = sum(1 for a, b in zip(signature, other_signature) if a == b)
+                if same >= need:
+                    similar += 1
+                    users.add(other_user)
+                    if similar >= limit:
+                        break
+            if similar >= limit:
+                break
+
+        self.insert(now, keys, (user_id, signature))
+
+        if similar + 1 > settings.max_similar:
+            return users
+        return None
+
+
+# Перцептивный хеш картинки (dHash): 64 бита - больше или меньше соседний пиксель в сетке 9x8.
+# Пережатие, масштаб и мелкие правки меняют лишь несколько бит. Вызывается в пуле процессов;
+# без Pillow картинки сравниваются только по file_unique_id (см. PERCEPTUAL_HASH)
+PERCEPTUAL_HASH = Image is not None
+
+
+def dhash(data, size=8):
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft('L', (size * 4, size * 4))  # JPEG сразу декодируется в уменьшенном виде
+        pixels = image.convert('L').resize((size + 1, size), Image.BILINEAR).tobytes()
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = value << 1 | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+# Ключи медиа: хеш картинки (int) режется на 8 байт - при расстоянии до 7 бит у похожих
+# совпадёт хотя бы один байт; остальные медиа (строка "тип:file_unique_id") - точный ключ
+MEDIA_BANDS = 8
+MAX_MEDIA_DISTANCE = MEDIA_BANDS - 1
+
+
+def media_keys(media):
+    if isinstance(media, int):
+        return [(band, media >> (8 * band) & 0xFF) for band in range(MEDIA_BANDS)]
+    return [media]
+
+
+def media_close(a, b, distance):
+    if isinstance(a, int) and isinstance(b, int):
+        return (a ^ b).bit_count() <= distance
+    return a == b
+
+
+def media_is_photo(media):
+    return isinstance(media, int) or media.startswith('photo:')
+
+
+# Повторы картинок и стикеров в чате за окно: волна одинаковых картинок от разных аккаунтов
+class MediaDetector(WindowIndex):
+    MAX_ENTRIES = 5000
+
+    # Множество user_id, приславших похожее медиа (включая автора), если в окне их больше
+    # max_similar, иначе None. Считаются разные пользователи: один участник, повторяющий
+    # свой стикер, - это флуд, а не рассылка
+    def check(self, user_id, media, distance):
+        now = self.clock()
+        self.expire(now)
+
+        keys = media_keys(media)
+        limit = self.settings.max_similar
+        users = {user_id}
+        seen = set()
+        for key in keys:
+            for other_id, (other_user, other_media) in self.buckets.get(key, {}).items():
+                if other_user in users or other_id in seen:
+                    continue
+                seen.add(other_id)
+                if media_close(media, other_media, distance):
+                    users.add(other_user)
+            if len(users) > limit:
+                break
+
+        self.insert(now, keys, (user_id, media))
+
+        if len(users) > limit:
+            return users
+        return None
+
+
+# Известный спам чата: медиа из волн рассылки и добавленные админом срабатывают с первого
+# сообщения, но только в своём чате и days дней. Хранится в хранилище состояния по ключу
+# на запись (значение - срок), чтобы воркеры не затирали друг друга
+class KnownMedia:
+    def __init__(self, store=None, limit=5000, days=7, prefix='mediaknown', clock=time.time):
+        self.store = store
+        self.limit = limit
+        self.ttl = days * 86400
+        self.prefix = prefix
+        self.clock = clock
+        self.items = OrderedDict()  # (chat_id, медиа) -> срок, порядок добавления
+        self.buckets = {}           # (chat_id, ключ) -> set(медиа)
+
+    def __len__(self):
+        return len(self.items)
+
+    @staticmethod
+    def encode(media):
+        return f"{media:016x}" if isinstance(media, int) else media
+
+    @staticmethod
+    def decode(text):
+        return int(text, 16) if len(text) == 16 and ':' not in text else text
+
+    def key(self, chat_id, media):
+        return f"{self.prefix}:{chat_id}:{self.encode(media)}"
+
+    async def load(self):
+        if self.store is None:
+            return
+        now = self.clock()
+        for key, expires in await self.store.scan(f"{self.prefix}:"):
+            chat, _, encoded = key[len(self.prefix) + 1:].partition(':')
+            # Записи без чата остались от общего списка на все чаты - он больше не действует
+            if not encoded or not chat.lstrip('-').isdigit() or expires <= now:
+                self.store.delete(key)
+                continue
+            self.insert(int(chat), self.decode(encoded), expires)
+
+    def insert(self, chat_id, media, expires):
+        item = (chat_id, media)
+        if item in self.items:
+            self.items[item] = expires
+            self.items.move_to_end(item)
+            return
+        self.items[item] = expires
+        for key in media_keys(media):
+            self.buckets.setdefault((chat_id, key), set()).add(media)
+        while len(self.items) > self.limit:
+            old, _ = self.items.popitem(last=False)
+            self.unindex(*old)
+            if self.store is not None:
+                self.store.delete(self.key(*old))
+
+    def unindex(self, chat_id, media):
+        for key in media_keys(media):
+            bucket = self.buckets.get((chat_id, key))
+            if bucket is not None:
+                bucket.discard(media)
+                if not bucket:
+                    del self.buckets[(chat_id, key)]
+
+    def add(self, chat_id, media):
+        expires = self.clock() + self.ttl
+        if self.store is not None:
+            self.store.set(self.key(chat_id, media), expires)
+        self.insert(chat_id, media, expires)
+
+    def remove(self, chat_id, media):
+        if self.items.pop((chat_id, media), None) is None:
+            return False
+        self.unindex(chat_id, media)
+        if self.store is not None:
+            self.store.delete(self.key(chat_id, media))
+        return True
+
+    def similar(self, chat_id, media, distance):
+        found = set()
+        for key in media_keys(media):
+            for other in self.buckets.get((chat_id, key), ()):
+                if media_close(media, other, distance):
+                    found.add(other)
+        return found
+
+    # Истёкшие записи удаляются, когда на них наткнулись
+    def match(self, chat_id, media, distance):
+        now = self.clock()
+        for other in self.similar(chat_id, media, distance):
+            if self.items[(chat_id, other)] > now:
+                return other
+            self.remove(chat_id, other)
+        return None
+
+    # Убрать из списка чата всё похожее на media; без media - весь список чата
+    def forget(self, chat_id, media=None, distance=MAX_MEDIA_DISTANCE):
+        if media is None:
+            found = [other for chat, other in self.items if chat == chat_id]
+        else:
+            found = self.similar(chat_id, media, distance)
+        for other in found:
+            self.remove(chat_id, other)
+        return len(found)
+
+    def count(self, chat_id):
+        now = self.clock()
+        return sum(1 for (chat, _), expires in self.items.items() if chat == chat_id and expires > now)
+
+
+# Приведение текста к каноническому виду для фильтра слов:
+# регистр, похожие латинские/кириллические буквы, разделители и повторы
+HOMOGLYPHS = str.maketrans({
+    'a': 'а', 'b': 'в', 'c': 'с', 'e': 'е', 'h': 'н', 'k': 'к', 'm': 'м', 'o': 'о',
+    'p': 'р', 't': 'т', 'x': 'х', 'y': 'у', 'u': 'и', 'ё': 'е', 'й': 'и',
+    '0': 'о', '3': 'з', '4': 'ч', '6': 'б', '@': 'а', '$': 'с',
+})
+_word_separators = re.compile(r'[^\w\s]+|_')
+_word_spaces = re.compile(r'\s+')
+_word_repeats = re.compile(r'(.)\1+')
+
+
+def normalize_words(text):
+    text = text.casefold().translate(HOMOGLYPHS)
+    text = _word_separators.sub('', text)
+    text = _word_spaces.sub(' ', text)
+    return _word_repeats.sub(r'\1', text)
+
+
+# Автомат Ахо-Корасик: поиск всех слов списка за один проход по тексту
+class AhoCorasick:
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]
+        for word in words:
+            self.add(word)
+        self.build()
+
+    def add(self, word):
+        state = 0
+        goto = self.goto
+        for char in word:
+            nxt = goto[state].get(char)
+            if nxt is None:
+                nxt = len(goto)
+                goto[state][char] = nxt
+                goto.append({})
+                self.fail.append(0)
+                self.output.append(None)
+            state = nxt
+        self.output[state] = word
+
+    def build(self):
+        goto, fail, output = self.goto, self.fail, self.output
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in goto[state].items():
+                queue.append(nxt)
+                link = fail[state]
+                while link and char not in goto[link]:
+                    link = fail[link]
+                link = goto[link].get(char, 0)
+                fail[nxt] = link if link != nxt else 0
+                # Наследуем совпадение по суффиксной ссылке, чтобы не обходить цепочку при поиске
+                if output[nxt] is None:
+                    output[nxt] = output[fail[nxt]]
+
+    def search(self, text):
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state] is not None:
+                return output[state]
+        return None
+
+
+# Фильтр запрещённых слов: список из файла, автомат пересобирается в фоне при изменении
+class WordFilter:
+    def __init__(self, path, reload_seconds=30.0):
+        self.path = path
+        self.reload_seconds = reload_seconds
+        self.mtime = None
+        self.automaton = AhoCorasick([])
+        self.reload()
+
+    @classmethod
+    def from_config(cls, config, section='AntiWord'):
+        return cls(
+            config.get(section, 'words_file', fallback='banned_words.txt'),
+            config.getfloat(section, 'reload_seconds', fallback=30.0)
+        )
+
+    def read_words(self):
+        words = set()
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    word = normalize_words(line).strip()
+                    if word:
+                        words.add(word)
+        return sorted(words)
+
+    def current_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def reload(self):
+        mtime = self.current_mtime()
+        words = self.read_words() if mtime is not None else []
+        self.automaton = AhoCorasick(words)
+        self.mtime = mtime
+        return len(words)
+
+    def match(self, text):
+        if not text:
+            return None
+        return self.automaton.search(normalize_words(text))
+
+    async def watch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.reload_seconds)
+            try:
+                if self.current_mtime() != self.mtime:
+                    # Сборка автомата идёт в потоке, подмена ссылки атомарна
+                    count = await loop.run_in_executor(None, self.reload)
+                    logging.info(f"Word filter reloaded: {count} words")
+            except Exception as e:
+                logging.error(f"Error reloading word filter: {e}")
+
+
+# Решение правила по сообщению
+class Verdict:
+    __slots__ = ('rule', 'action', 'detail')
+
+    def __init__(self, rule, action, detail=None):
+        self.rule = rule
+        self.action = action
+        self.detail = detail
+
+
+# Декларативное правило модерации (секция [Rule:<имя>] в c.ini)
+class Rule:
+    KINDS = ('regex', 'caps', 'entities', 'words', 'flood', 'similar', 'media')
+    ACTIONS = ('delete', 'warn', 'mute')
+
+    __slots__ = ('name', 'kind', 'action', 'reason', 'title', 'toggle', 'enabled',
+                 'pattern', 'ratio', 'min_length', 'types', 'min_count', 'mute_minutes', 'distance',
+                 'hits', 'checks', 'time_ns')
+
+    def __init__(self, name, kind, action='delete', reason='spam', title=None, toggle=None,
+                 enabled=True, pattern=None, ratio=0.7, min_length=10, types=(), min_count=1,
+                 mute_minutes=None, distance=6):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown rule kind '{kind}' in rule {name}")
+        if action not in self.ACTIONS:
+            raise ValueError(f"Unknown rule action '{action}' in rule {name}")
+        if kind == 'regex' and not pattern:
+            raise ValueError(f"Rule {name} needs a pattern")
+        if not 0 <= distance <= MAX_MEDIA_DISTANCE:
+            raise ValueError(f"Rule {name}: distance must be between 0 and {MAX_MEDIA_DISTANCE}")
+        self.name = name
+        self.kind = kind
+        self.action = action
+        self.reason = reason
+        self.title = title or name.upper()
+        self.toggle = toggle
+        self.enabled = enabled
+        self.pattern = pattern
+        self.ratio = ratio
+        self.min_length = min_length
+        self.types = frozenset(types)
+        self.min_count = min_count
+        self.mute_minutes = mute_minutes
+        self.distance = distance
+        self.hits = 0
+        self.checks = 0
+        self.time_ns = 0
+
+    @classmethod
+    def from_section(cls, name, section):
+        types = section.get('types', '')
+        mute_minutes = section.get('mute_minutes')
+        return cls(
+            name,
+            section.get('kind', 'regex'),
+            action=section.get('action', 'delete'),
+            reason=section.get('reason', 'spam'),
+            title=section.get('title'),
+            toggle=section.get('toggle'),
+            enabled=section.getboolean('enabled', fallback=True),
+            pattern=section.get('pattern', raw=True),
+            ratio=section.getfloat('ratio', fallback=0.7),
+            min_length=section.getint('min_length', fallback=10),
+            types=[t.strip() for t in types.split(',') if t.strip()],
+            min_count=section.getint('min_count', fallback=1),
+            mute_minutes=int(mute_minutes) if mute_minutes else None,
+            distance=section.getint('distance', fallback=6)
+        )
+
+
+# Правила по умолчанию, если в c.ini нет секций [Rule:...]
+DEFAULT_RULES = [
+    Rule('forbidden_symbols', 'regex', 'delete', 'forbidden_symbols',
+         'ОБНАРУЖЕНЫ ЗАПРЕЩЁННЫЕ СИМВОЛЫ', pattern=r'꙰|ᡃ⃝|⃟'),
+    Rule('words', 'words', 'warn', 'insult', 'ОБНАРУЖЕНО ЗАПРЕЩЁННОЕ СЛОВО', toggle='antiword'),
+    Rule('caps', 'caps', 'warn', 'caps', 'ОБНАРУЖЕН КАПС', toggle='anticaps'),
+    Rule('flood', 'flood', 'mute', 'flood', 'ОБНАРУЖЕН СПАМ', toggle='antispam'),
+    Rule('similar', 'similar', 'warn', 'spam', 'ОБНАРУЖЕНА РАССЫЛКА', toggle='antispam'),
+    Rule('media', 'media', 'warn', 'spam', 'ОБНАРУЖЕНА РАССЫЛКА КАРТИНОК', toggle='antispam'),
+]
+
+
+# Обратные ссылки по номеру и глобальные флаги в общем шаблоне поменяли бы смысл
+_backreference = re.compile(r'\\[1-9]|\(\?P=')
+_default_flags = re.compile('').flags
+
+
+# Движок правил: правила c.ini по порядку, entities разбираются один раз на сообщение.
+# Regex-правила собраны в один шаблон и проверяются одним проходом по тексту: общая
+# опережающая проверка останавливает finditer только там, где совпало хоть одно правило,
+# а необязательная опережающая группа на каждое правило отмечает все правила, совпавшие
+# с этой позиции, - перекрывающиеся совпадения не теряются. Правила с обратными ссылками,
+# своими именованными группами или глобальными флагами ищутся отдельно.
+# Капс, слова, флуд и повторы - свои детекторы со своим разбором текста.
+class RuleEngine:
+    SEVERITY = {'delete': 0, 'warn': 1, 'mute': 2}
+
+    def __init__(self, rules, flood_detector=None, word_filter=None, similarity_factory=SimilarityDetector,
+                 known_media=None):
+        self.rules = list(rules)
+        self.flood_detector = flood_detector
+        self.word_filter = word_filter
+        self.similarity_factory = similarity_factory
+        self.known_media = known_media
+        self.similarity = {}  # chat_id -> SimilarityDetector, индексы чатов не пересекаются
+        self.media = {}       # chat_id -> MediaDetector
+        self.scan_ns = 0
+        self.scans = 0
+
+        # Шаблоны компилируются при загрузке: ошибка в шаблоне указывает на правило
+        self.patterns = {}  # индекс -> шаблон правила, которое ищется отдельно
+        combined = []
+        for index, rule in enumerate(self.rules):
+            if rule.kind == 'regex' and rule.enabled:
+                pattern = re.compile(rule.pattern)
+                if pattern.flags != _default_flags or pattern.groupindex or _backreference.search(rule.pattern):
+                    self.patterns[index] = pattern
+                else:
+                    combined.append(index)
+        self.combined = None
+        self.combined_rules = {f"rule{index}": index for index in combined}
+        if combined:
+            any_rule = '|'.join(f"(?:{self.rules[index].pattern})" for index in combined)
+            groups = ''.join(f"(?:(?=(?P<rule{index}>{self.rules[index].pattern})))?" for index in combined)
+            self.combined = re.compile(f"(?=(?:{any_rule})){groups}")
+        self.needs_regex = bool(self.patterns or self.combined)
+        self.needs_entities = any(rule.kind == 'entities' for rule in self.rules)
+
+    @classmethod
+    def from_config(cls, config, flood_detector=None, word_filter=None, known_media=None):
+        rules = []
+        for section in config.sections():
+            if section.startswith('Rule:'):
+                try:
+                    rules.append(Rule.from_section(section[5:], config[section]))
+                except (ValueError, re.error) as e:
+                    raise ValueError(f"Invalid rule [{section}]: {e}")
+        return cls(rules or DEFAULT_RULES, flood_detector, word_filter, known_media=known_media)
+
+    def similarity_detector(self, chat_id, settings):
+        detector = self.similarity.get(chat_id)
+        if detector is None:
+            detector = self.similarity[chat_id] = self.similarity_factory(settings)
+        else:
+            detector.settings = settings
+        return detector
+
+    def media_detector(self, chat_id, settings):
+        detector = self.media.get(chat_id)
+        if detector is None:
+            detector = self.media[chat_id] = MediaDetector(settings)
+        else:
+            detector.settings = settings
+        return detector
+
+    # settings - настройки антиспама чата (обязательны: по ним работают окна флуда и повторов),
+    # protection - флаги защиты чата, media - перцептивный хеш картинки или "тип:file_unique_id"
+    def evaluate(self, chat_id, user_id, text, settings, entities=(), protection=None, media=None):
+        started = time.perf_counter_ns()
+
+        # Проход по entities: счётчики типов и скрытые ссылки text_link
+        entity_counts = {}
+        hidden = None
+        if self.needs_entities or self.needs_regex:
+            for entity in entities or ():
+                entity_counts[entity.type] = entity_counts.get(entity.type, 0) + 1
+                if entity.url:
+                    if hidden is None:
+                        hidden = []
+                    hidden.append(entity.url)
+        # Regex-правила проверяют и текст, и скрытые ссылки
+        scan = text if hidden is None else text + '\n' + '\n'.join(hidden)
+        # Один проход общего шаблона: индексы сработавших regex-правил
+        regex_hits = set()
+        if self.combined is not None and scan:
+            names = self.combined_rules
+            for match in self.combined.finditer(scan):
+                for name, value in match.groupdict().items():
+                    if value is not None:
+                        regex_hits.add(names[name])
+                if len(regex_hits) == len(names):
+                    break
+        self.scan_ns += time.perf_counter_ns() - started
+        self.scans += 1
+
+        verdicts = []
+        for index, rule in enumerate(self.rules):
+            if not rule.enabled or (rule.toggle and protection is not None and not protection.get(rule.toggle, True)):
+                continue
+            rule_started = time.perf_counter_ns()
+            detail = None
+            kind = rule.kind
+            if kind == 'regex':
+                if index in self.patterns:
+                    hit = bool(scan) and self.patterns[index].search(scan) is not None
+                else:
+                    hit = index in regex_hits
+            elif kind == 'caps':
+                length = len(text)
+                hit = length > rule.min_length and sum(map(str.isupper, text)) / length > rule.ratio
+            elif kind == 'entities':
+                count = sum(entity_counts.get(t, 0) for t in rule.types)
+                hit = count >= rule.min_count
+                if hit and rule.min_count > 1:
+                    detail = f"{count} шт."
+            elif kind == 'words':
+                word = self.word_filter.match(text) if self.word_filter else None
+                hit = word is not None
+            elif kind == 'flood':
+                hit = self.flood_detector is not None and self.flood_detector.hit((chat_id, user_id), settings)
+            elif kind == 'media':
+                hit = False
+                if media is not None:
+                    if self.known_media is not None and self.known_media.match(chat_id, media, rule.distance) is not None:
+                        hit = True
+                        detail = "известный спам"
+                    else:
+                        detector = self.media_detector(chat_id, settings)
+                        users = detector.check(user_id, media, rule.distance)
+                        hit = bool(users)
+                        if hit:
+                            detail = f"повторов от {len(users)} польз."
+                            # Сама запоминается только картинка: популярные стикеры и GIF шлют
+                            # и обычные участники, их в список добавляет админ (/blockmedia)
+                            if self.known_media is not None and media_is_photo(media):
+                                self.known_media.add(chat_id, media)
+            else:
+                detector = self.similarity_detector(chat_id, settings)
+                users = detector.check(user_id, text)
+                hit = bool(users)
+                if hit:
+                    detail = f"похожих сообщений от {len(users)} польз."
+            rule.checks += 1
+            rule.time_ns += time.perf_counter_ns() - rule_started
+            if hit:
+                rule.hits += 1
+                verdicts.append(Verdict(rule, rule.action, detail))
+        return verdicts
+
+    def strongest(self, verdicts):
+        return max(verdicts, key=lambda v: self.SEVERITY[v.action])
+
+    def stats(self):
+        rows = [('regex+entities', self.scans, None, self.scan_ns)]
+        for rule in self.rules:
+            rows.append((rule.name, rule.checks, rule.hits, rule.time_ns))
+        return rows
@@ -0,0 +1,402 @@
+import argparse
+import asyncio
+import atexit
+import configparser
+import functools
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from antispam import AntiSpamSettings, FloodDetector
+
+# Микробенчмарки горячих путей d.py и fpi.py: операций в секунду на одно ядро.
+# Всё работает без сети: боты импортируются во временном каталоге с копией конфигов,
+# рабочие файлы (config.ini, punishments.json, логи) репозитория не трогаются.
+# Результаты дописываются в JSON по версиям, новый прогон сравнивается с прошлым.
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BOT_FILES = ('c.ini', 'config.ini', 'banned_words.txt')
+DEFAULT_SIZES = (1000, 100000, 1000000)
+
+# имя -> (функция подготовки, зависит ли от размера); подготовка возвращает run(n)
+BENCHMARKS = {}
+
+
+def benchmark(name, scaled=False):
+    def register(setup):
+        BENCHMARKS[name] = (setup, scaled)
+        return setup
+    return register
+
+
+# Поток (user_id, время): rate сообщений в секунду от users пользователей
+def make_stream(count, users, rate=200, seed=1):
+    rnd = random.Random(seed)
+    start = time.time()
+    return [(rnd.randrange(users), start + i / rate) for i in range(count)]
+
+
+# Старая реализация из handle_messages: список datetime + разбор config на каждое сообщение
+def legacy_spam(stream, config):
+    spam_data = {}
+    flagged = 0
+    for user_id, timestamp in stream:
+        current_time = datetime.fromtimestamp(timestamp)
+        if user_id not in spam_data:
+            spam_data[user_id] = {"messages": [], "last_time": current_time.timestamp()}
+        messages = spam_data[user_id]["messages"]
+        messages = [t for t in messages if (current_time - t).total_seconds() < float(config['AntiSpam']['spam_seconds'])]
+        messages.append(current_time)
+        spam_data[user_id]["messages"] = messages
+        if len(messages) > int(config['AntiSpam']['max_messages']):
+            flagged += 1
+    return flagged
+
+
+def flood_detector(stream, config):
+    clock = [0.0]
+    detector = FloodDetector(AntiSpamSettings.from_config(config), clock=lambda: clock[0])
+    hit = detector.hit
+    flagged = 0
+    for user_id, timestamp in stream:
+        clock[0] = timestamp
+        if hit(user_id):
+            flagged += 1
+    return flagged
+
+
+# Как timeit.autorange: n удваивается, пока прогон не займёт min_time; лучший из repeat
+def measure(run, min_time=0.2, repeat=3):
+    n = 1
+    while True:
+        started = time.perf_counter()
+        run(n)
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        n *= 2 if elapsed * 10 >= min_time else 10
+    best = elapsed
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        run(n)
+        best = min(best, time.perf_counter() - started)
+    return n / best
+
+
+# Боты импортируются один раз, рабочий каталог - временная копия конфигов
+@functools.lru_cache(maxsize=None)
+def bots():
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    atexit.register(shutil.rmtree, workdir, True)
+    for name in BOT_FILES:
+        if os.path.exists(os.path.join(ROOT, name)):
+            shutil.copy(os.path.join(ROOT, name), workdir)
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import d
+    import fpi
+    return d, fpi
+
+
+def bot_config():
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, 'c.ini'))
+    return config
+
+
+# Больше сообщений, чем в потоке, - несколько прогонов с чистым состоянием
+def stream_runner(func, count=200000, users=50):
+    stream, config = make_stream(count, users), bot_config()
+
+    def run(n):
+        while n > 0:
+            func(stream[:n], config)
+            n -= count
+    return run
+
+
+@benchmark('antispam_legacy')
+def bench_antispam_legacy(size):
+    return stream_runner(legacy_spam)
+
+
+@benchmark('antispam')
+def bench_antispam(size):
+    return stream_runner(flood_detector)
+
+
+@benchmark('parse_time')
+def bench_parse_time(size):
+    d, _ = bots()
+    values = ['30m', '2h', '7d', '15', 'abc', '120m'] * 100
+    parse_time = d.parse_time
+
+    def run(n):
+        for i in range(n):
+            parse_time(values[i % 600])
+    return run
+
+
+@benchmark('format_time')
+def bench_format_time(size):
+    d, _ = bots()
+    values = [random.Random(i).randrange(60, 90 * 86400) for i in range(600)]
+    format_time = d.format_time
+
+    def run(n):
+        for i in range(n):
+            format_time(values[i % 600])
+    return run
+
+
+# Проверки handle_messages (запрещённые символы, капс, слова, флуд, рассылки) - движок правил
+@benchmark('message_checks')
+def bench_message_checks(size):
+    d, _ = bots()
+    snapshot = d.snapshot
+    texts = [
+        'привет всем, как дела?',
+        'СРОЧНО ВСЕ СЮДА СМОТРИТЕ',
+        'особый символ ꙰ в тексте',
+        'заходите на мой канал, там раздача монет каждый день',
+        'ок',
+    ] * 120
+    evaluate = snapshot.rule_engine.evaluate
+
+    def run(n):
+        for i in range(n):
+            evaluate(-100, i % 1000, texts[i % 600], snapshot.antispam, (), snapshot.protection)
+    return run
+
+
+class FakeUser:
+    __slots__ = ('id',)
+
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+class FakeMessage:
+    __slots__ = ('from_user',)
+
+    def __init__(self, user_id):
+        self.from_user = FakeUser(user_id)
+
+    async def answer(self, text, **kwargs):
+        pass
+
+
+# Флуд-контроль fpi: size разных пользователей шлют команды по кругу
+@benchmark('throttling', scaled=True)
+def bench_throttling(size):
+    _, fpi = bots()
+    from aiogram.dispatcher.handler import CancelHandler
+    middleware = fpi.ThrottlingMiddleware()
+    messages = [FakeMessage(user_id) for user_id in range(size)]
+    loop = asyncio.new_event_loop()
+    position = [0]
+
+    async def process(n):
+        for _ in range(n):
+            message = messages[position[0] % size]
+            position[0] += 1
+            try:
+                await middleware.on_process_message(message, None)
+            except CancelHandler:
+                pass
+
+    loop.run_until_complete(process(size))
+    return lambda n: loop.run_until_complete(process(n))
+
+
+# Статистика fpi: size уже известных пользователей, /coin от случайного из них;
+# config.ini пишется отложенно, как в работающем боте
+@benchmark('update_stats', scaled=True)
+def bench_update_stats(size):
+    _, fpi = bots()
+    config = fpi.config
+    config.config['Stats']['unique_users'] = str(list(range(size)))
+    config.load_users()
+    config.save_config()
+    rnd = random.Random(size)
+    loop = asyncio.new_event_loop()
+
+    async def process(n):
+        for _ in range(n):
+            config.update_stats(rnd.randrange(size), '/coin')
+            config.record_command('/coin')
+
+    return lambda n: loop.run_until_complete(process(n))
+
+
+# Наказания: size записей поровну между банами, мутами и варнами в 10 чатах.
+# Набор строится заново для каждого бенчмарка: add и remove меняют его по ходу замера
+def punishment_system(size):
+    d, _ = bots()
+    system = d.PunishmentSystem()
+    system.data_file = os.path.join(os.getcwd(), f'bench_punishments_{size}.json')
+    rnd = random.Random(size)
+    now = time.time()
+    for type_name in ('bans', 'mutes', 'warns'):
+        system.punishments[type_name] = [
+            {
+                "chat_id": -100 - rnd.randrange(10),
+                "user_id": rnd.randrange(size),
+                "admin_id": 1,
+                "admin_name": "admin",
+                "reason": "bench",
+                "until_date": now + rnd.randrange(-86400, 86400) if type_name != 'warns' else None,
+                "date": now
+            }
+            for _ in range(size // 3)
+        ]
+    return system
+
+
+@benchmark('punishments_add', scaled=True)
+def bench_punishments_add(size):
+    system = punishment_system(size)
+    rnd = random.Random(1)
+
+    def run(n):
+        for _ in range(n):
+            system.add_punishment('warns', {
+                "chat_id": -100, "user_id": rnd.randrange(size), "admin_id": 1,
+                "admin_name": "admin", "reason": "bench", "until_date": None, "date": time.time()
+            })
+    return run
+
+
+@benchmark('punishments_remove', scaled=True)
+def bench_punishments_remove(size):
+    system = punishment_system(size)
+    rnd = random.Random(2)
+
+    def run(n):
+        for _ in range(n):
+            system.remove_punishment('mutes', rnd.randrange(size), -100 - rnd.randrange(10))
+    return run
+
+
+@benchmark('punishments_lookup', scaled=True)
+def bench_punishments_lookup(size):
+    system = punishment_system(size)
+    rnd = random.Random(3)
+
+    def run(n):
+        for _ in range(n):
+            chat_id = -100 - rnd.randrange(10)
+            system.get_user_warns(rnd.randrange(size), chat_id)
+            system.get_active_punishments('mutes', chat_id)
+    return run
+
+
+@benchmark('punishments_save', scaled=True)
+def bench_punishments_save(size):
+    system = punishment_system(size)
+    return lambda n: [system.save_data() for _ in range(n)]
+
+
+def current_version():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def load_results(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"runs": []}
+
+
+def save_results(path, results):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+# Последний замер того же бенчмарка другой версией на той же машине - база для сравнения
+def baseline(results, version, name, key):
+    for run in reversed(results['runs']):
+        if run['version'] != version and run['machine'] == platform.machine():
+            ops = run['results'].get(name, {}).get(key)
+            if ops:
+                return run['version'], ops
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hot path microbenchmarks for d.py and fpi.py')
+    parser.add_argument('names', nargs='*', help=f"benchmarks to run: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='record counts for scaled benchmarks')
+    parser.add_argument('--min-time', type=float, default=0.2)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=os.path.join(ROOT, 'bench_results.json'))
+    parser.add_argument('--version', default=None, help='label for this run (default: git describe)')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown reported as regression')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    names = args.names or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+
+    version = args.version or current_version()
+    results = load_results(args.output)
+    run = {
+        "version": version,
+        "date": datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": {}
+    }
+
+    regressions = []
+    # Снаружи размер: большие наборы наказаний держатся в памяти по одному
+    for size in sizes:
+        for name in names:
+            setup, scaled = BENCHMARKS[name]
+            if not scaled and size != sizes[0]:
+                continue
+            key = str(size) if scaled else '-'
+            ops = measure(setup(size), args.min_time, args.repeat)
+            run['results'].setdefault(name, {})[key] = ops
+
+            line = f"{name:<20} {key:>8} {ops:>14,.1f} ops/s"
+            previous = baseline(results, version, name, key)
+            if previous:
+                change = ops / previous[1] - 1
+                line += f"  {change:+.1%} vs {previous[0]}"
+                if change < -args.tolerance:
+                    line += "  REGRESSION"
+                    regressions.append(f"{name}[{key}]")
+            print(line, flush=True)
+
+    results['runs'].append(run)
+    save_results(args.output, results)
+    print(f"Saved to {args.output}")
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        if args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import asyncio
+import configparser
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+
+# Флаги inotify из <sys/inotify.h>
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+# Чтение конфига с ошибкой вместо молча пропущенного файла (как у ConfigParser.read)
+def read_config(path):
+    config = configparser.ConfigParser()
+    with open(path, 'r', encoding='utf-8') as f:
+        config.read_file(f)
+    return config
+
+
+# Секции, которые отличаются в двух конфигах
+def changed_sections(old, new):
+    names = set(old.sections()) | set(new.sections())
+    return sorted(
+        name for name in names
+        if not old.has_section(name) or not new.has_section(name) or dict(old[name]) != dict(new[name])
+    )
+
+
+# inotify через libc; None - если недоступен (не Linux, нет прав, нет libc)
+def inotify_watch(directories):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    # Следим за каталогом: редакторы сохраняют файл через переименование
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    for directory in directories:
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            os.close(fd)
+            return None
+    return fd
+
+
+def read_events(fd):
+    names = set()
+    try:
+        data = os.read(fd, 65536)
+    except BlockingIOError:
+        return names
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(data):
+        _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        names.add(os.fsdecode(data[offset:offset + length].rstrip(b'\0')))
+        offset += length
+    return names
+
+
+# Наблюдатель за файлами конфигурации: inotify, а без него - опрос mtime
+class ConfigWatcher:
+    def __init__(self, paths, callback, interval=2.0, debounce=0.5):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.callback = callback
+        self.interval = interval
+        self.debounce = debounce
+
+    def mtimes(self):
+        result = {}
+        for path in self.paths:
+            try:
+                result[path] = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                result[path] = None
+        return result
+
+    async def notify(self):
+        try:
+            await self.callback()
+        except Exception as e:
+            logging.error(f"Config reload callback failed: {e}")
+
+    async def watch(self):
+        fd = inotify_watch({os.path.dirname(path) for path in self.paths})
+        if fd is None:
+            logging.info("inotify unavailable, polling config files")
+            await self.poll()
+        else:
+            try:
+                await self.watch_inotify(fd)
+            finally:
+                os.close(fd)
+
+    async def poll(self):
+        known = self.mtimes()
+        while True:
+            await asyncio.sleep(self.interval)
+            current = self.mtimes()
+            if current != known:
+                known = current
+                await asyncio.sleep(self.debounce)
+                await self.notify()
+
+    async def watch_inotify(self, fd):
+        loop = asyncio.get_running_loop()
+        names = {os.path.basename(path) for path in self.paths}
+        changed = asyncio.Event()
+
+        def on_readable():
+            if read_events(fd) & names:
+                changed.set()
+
+        loop.add_reader(fd, on_readable)
+        try:
+            while True:
+                await changed.wait()
+                # Одно сохранение - несколько событий: ждём, пока запись закончится
+                await asyncio.sleep(self.debounce)
+                changed.clear()
+                await self.notify()
+        finally:
+            loop.remove_reader(fd)
@@ -1,6 +1,5 @@
 import logging
-from aiogram import Bot, Dispatcher, executor, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram import Bot, Dispatcher, types
 from datetime import datetime, timedelta
 import configparser
 import re
@@ -8,24 +7,58 @@ import json
 from pathlib import Path
 import random
 import asyncio
-from collections import defaultdict
+import functools
+import time
+import csv
+import gzip
+import io
+import os
+import tempfile
+from array import array
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from storage import StateStore, StoreFSMStorage
+from updates import run_sharded, run_polling, OffsetFile, StaleUpdateMiddleware, UpdateExecutor, is_stale, is_main_shard
+from configwatch import ConfigWatcher, read_config, changed_sections
+from monitoring import LoopProfiler, ProfilerMiddleware, LoopMonitor, MemoryTracker, format_size, process_rss, trace_site
+from antispam import AntiSpamSettings, FloodDetector, SimilarityDetector, WordFilter, RuleEngine, JoinRateCounter, KnownMedia, dhash, PERCEPTUAL_HASH
+from concurrent.futures import ProcessPoolExecutor
+
+# Блокировка файла наказаний нужна только режиму воркеров (fork), а он есть только в POSIX
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Загрузка конфигурации
 config = configparser.ConfigParser()
 config.read('c.ini')
 
+def parse_ids(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+# Основной чат - первый из c.ini при запуске (к нему относятся старые записи без chat_id)
+PRIMARY_CHAT = (parse_ids(config.get('Chat', 'chat_id', fallback='')) or [None])[0]
+
+def record_chat(record):
+    return record.get('chat_id', PRIMARY_CHAT)
+
 # Эмодзи для слотов
 SLOT_EMOJI = ['🍎', '🍊', '🍋', '🍒', '🔔', '💎', '7️⃣']
 
 # Система сохранения наказаний
 class PunishmentSystem:
-    def __init__(self):
+    def __init__(self, stats=None):
         self.data_file = config.get('Storage', 'data_file', fallback='punishments.json')
+        self.shared = False  # файл пишут несколько процессов-воркеров
+        self.stats = stats
+        self.mtime = None
         self.punishments = self.load_data()
         
     def load_data(self):
         try:
             with open(self.data_file, 'r', encoding='utf-8') as f:
+                self.mtime = os.fstat(f.fileno()).st_mtime_ns
                 return json.load(f)
         except FileNotFoundError:
             return {
@@ -37,50 +70,98 @@ class PunishmentSystem:
     def save_data(self):
         with open(self.data_file, 'w', encoding='utf-8') as f:
             json.dump(self.punishments, f, indent=4, ensure_ascii=False)
+        self.mtime = os.stat(self.data_file).st_mtime_ns
+        
+    # В режиме воркеров файл пишут и другие процессы: перед чтением подхватываем их записи
+    def refresh(self):
+        if not self.shared:
+            return
+        try:
+            mtime = os.stat(self.data_file).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self.mtime:
+            self.punishments = self.load_data()
+            
+    # Изменение с сохранением; в режиме воркеров - под файловой блокировкой
+    # и поверх свежей копии файла, чтобы не затереть записи других процессов
+    @contextmanager
+    def transaction(self):
+        if not self.shared:
+            yield
+            self.save_data()
+            return
+        with open(self.data_file + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.punishments = self.load_data()
+                yield
+                self.save_data()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
             
     def add_punishment(self, type_name, data):
-        self.punishments[type_name].append(data)
-        self.save_data()
+        with self.transaction():
+            self.punishments[type_name].append(data)
+        if self.stats:
+            self.stats.record_punishment(type_name, data)
         
-    def remove_punishment(self, type_name, user_id):
-        self.punishments[type_name] = [
-            p for p in self.punishments[type_name] 
-            if p['user_id'] != user_id
-        ]
-        self.save_data()
+    def remove_punishment(self, type_name, user_id, chat_id=None, expired=False):
+        with self.transaction():
+            before = len(self.punishments[type_name])
+            self.punishments[type_name] = [
+                p for p in self.punishments[type_name] 
+                if p['user_id'] != user_id or (chat_id is not None and record_chat(p) != chat_id)
+            ]
+            removed = before - len(self.punishments[type_name])
+        if self.stats and removed and chat_id is not None:
+            self.stats.record_removal(chat_id, type_name, removed, expired)
+        
+    def remove_last_warn(self, user_id, chat_id=None):
+        with self.transaction():
+            user_warns = self.get_user_warns(user_id, chat_id)
+            if user_warns:
+                self.punishments['warns'].remove(user_warns[-1])
+        if self.stats and user_warns:
+            self.stats.record_removal(record_chat(user_warns[-1]), 'warns')
+        return len(user_warns)
         
-    def get_active_punishments(self, type_name):
+    def get_active_punishments(self, type_name, chat_id=None):
+        self.refresh()
         current_time = datetime.now().timestamp()
         return [
             p for p in self.punishments[type_name]
-            if p.get('until_date', float('inf')) > current_time
+            if (p.get('until_date') or float('inf')) > current_time
+            and (chat_id is None or record_chat(p) == chat_id)
+        ]
+        
+    def get_user_warns(self, user_id, chat_id=None):
+        self.refresh()
+        return [
+            p for p in self.punishments['warns']
+            if p['user_id'] == user_id and (chat_id is None or record_chat(p) == chat_id)
         ]
         
-    def get_user_warns(self, user_id):
-        return [p for p in self.punishments['warns'] if p['user_id'] == user_id]
+    def get_chat_punishments(self, type_name, chat_id):
+        self.refresh()
+        return [p for p in self.punishments[type_name] if record_chat(p) == chat_id]
         
     async def check_expired_punishments(self, bot):
+        self.refresh()
         current_time = datetime.now().timestamp()
-        try:
-            chat_id = config.get('Chat', 'chat_id')
-        except:
-            logging.error("Chat ID not found in config!")
-            return
-            
-        if not chat_id:
-            logging.error("Chat ID is empty!")
-            return
             
         for ban in self.punishments['bans']:
-            if ban.get('until_date', float('inf')) <= current_time:
+            chat_id = record_chat(ban)
+            if chat_id and (ban.get('until_date') or float('inf')) <= current_time:
                 try:
                     await bot.unban_chat_member(chat_id, ban['user_id'])
-                    self.remove_punishment('bans', ban['user_id'])
+                    self.remove_punishment('bans', ban['user_id'], chat_id, expired=True)
                 except Exception as e:
                     logging.error(f"Error unbanning user {ban['user_id']}: {e}")
                     
         for mute in self.punishments['mutes']:
-            if mute.get('until_date', float('inf')) <= current_time:
+            chat_id = record_chat(mute)
+            if chat_id and (mute.get('until_date') or float('inf')) <= current_time:
                 try:
                     await bot.restrict_chat_member(
                         chat_id,
@@ -92,27 +173,659 @@ class PunishmentSystem:
                             can_add_web_page_previews=True
                         )
                     )
-                    self.remove_punishment('mutes', mute['user_id'])
+                    self.remove_punishment('mutes', mute['user_id'], chat_id, expired=True)
                 except Exception as e:
                     logging.error(f"Error unmuting user {mute['user_id']}: {e}")
 
+# Сводка модерации по дням: счётчики обновляются при каждом действии, а /modstats
+# читает по одной записи на день периода вместо просмотра всей истории наказаний.
+# Ключ modstats:{день}:{чат} - у чата один воркер, поэтому записи не конфликтуют.
+class ModStats:
+    def __init__(self, store, bot_id):
+        self.store = store
+        self.bot_id = bot_id
+        self.day = None
+        self.today = {}  # chat_id -> сводка за текущий день
+
+    @staticmethod
+    def day_key(day, chat_id):
+        return f"modstats:{day}:{chat_id}"
+
+    @staticmethod
+    def empty():
+        return {"actions": {}, "auto": 0, "manual": 0, "reasons": {}, "admins": {}, "names": {},
+                "mute_minutes": 0, "removed": {}, "expired": {}}
+
+    async def load(self):
+        self.day = datetime.now().strftime('%Y-%m-%d')
+        self.today = {
+            int(key.rsplit(':', 1)[1]): rollup
+            for key, rollup in await self.store.scan(f"modstats:{self.day}:")
+        }
+
+    def rollup(self, chat_id):
+        day = datetime.now().strftime('%Y-%m-%d')
+        if day != self.day:
+            self.day = day
+            self.today = {}
+        rollup = self.today.get(chat_id)
+        if rollup is None:
+            rollup = self.today[chat_id] = self.empty()
+        return rollup
+
+    def save(self, chat_id):
+        self.store.set(self.day_key(self.day, chat_id), self.today[chat_id])
+
+    def record_action(self, chat_id, action, admin_id, admin_name=None, reason=None, mute_minutes=0):
+        rollup = self.rollup(chat_id)
+        rollup["actions"][action] = rollup["actions"].get(action, 0) + 1
+        # Действия систем (антиспам, автомут за варны) записываются от имени бота: имя и счёт
+        # админа, по команде которого они сработали, они не трогают
+        if admin_id == self.bot_id:
+            rollup["auto"] += 1
+        else:
+            rollup["manual"] += 1
+            admin = str(admin_id)
+            rollup["admins"][admin] = rollup["admins"].get(admin, 0) + 1
+            if admin_name:
+                rollup["names"][admin] = admin_name
+        if reason:
+            rollup["reasons"][reason] = rollup["reasons"].get(reason, 0) + 1
+        rollup["mute_minutes"] += mute_minutes
+        self.save(chat_id)
+
+    def record_punishment(self, type_name, data):
+        chat_id = record_chat(data)
+        if chat_id is None:
+            return
+        minutes = 0
+        if type_name == 'mutes' and data.get('until_date'):
+            minutes = round((data['until_date'] - data['date']) / 60)
+        self.record_action(chat_id, type_name, data.get('admin_id'), data.get('admin_name'),
+                           data.get('reason'), minutes)
+
+    def record_removal(self, chat_id, type_name, count=1, expired=False):
+        rollup = self.rollup(chat_id)
+        bucket = rollup["expired" if expired else "removed"]
+        bucket[type_name] = bucket.get(type_name, 0) + count
+        self.save(chat_id)
+
+    # Сумма сводок за последние days дней (включая сегодня)
+    async def summary(self, chat_id, days):
+        total = self.empty()
+        start = datetime.now()
+        for offset in range(days):
+            day = (start - timedelta(days=offset)).strftime('%Y-%m-%d')
+            if day == self.day:
+                rollup = self.today.get(chat_id)
+            else:
+                rollup = await self.store.get(self.day_key(day, chat_id))
+            if not rollup:
+                continue
+            total["auto"] += rollup["auto"]
+            total["manual"] += rollup["manual"]
+            total["mute_minutes"] += rollup["mute_minutes"]
+            total["names"].update(rollup["names"])
+            for field in ("actions", "reasons", "admins", "removed", "expired"):
+                for name, count in rollup[field].items():
+                    total[field][name] = total[field].get(name, 0) + count
+        return total
+
+# Уведомление о нарушениях пользователя; таких записей столько же, сколько нарушителей за окно
+class Notice:
+    __slots__ = ('message_id', 'count', 'render', 'dirty', 'expires')
+
+    def __init__(self, message_id, render, expires):
+        self.message_id = message_id
+        self.count = 1
+        self.render = render
+        self.dirty = False
+        self.expires = expires
+
+# Буфер действий модерации: пакетное удаление и объединённые уведомления
+class ModerationBuffer:
+    MAX_BATCH = 100  # лимит deleteMessages
+
+    def __init__(self, bot, window=1.0, notice_window=30.0):
+        self.bot = bot
+        self.window = window
+        self.notice_window = notice_window
+        self.pending = defaultdict(list)  # chat_id -> [message_id]
+        self.flushing = set()             # чаты с запланированной отправкой
+        self.notices = OrderedDict()      # (chat_id, user_id) -> уведомление
+
+    def delete(self, chat_id, message_id):
+        pending = self.pending[chat_id]
+        pending.append(message_id)
+        if len(pending) >= self.MAX_BATCH:
+            asyncio.create_task(self.flush(chat_id))
+        else:
+            self.flush_soon(chat_id)
+
+    async def flush_later(self, chat_id):
+        await asyncio.sleep(self.window)
+        await self.flush(chat_id)
+
+    async def flush(self, chat_id):
+        self.flushing.discard(chat_id)
+        message_ids = self.pending.pop(chat_id, [])
+        for i in range(0, len(message_ids), self.MAX_BATCH):
+            batch = message_ids[i:i + self.MAX_BATCH]
+            try:
+                await self.bot.request('deleteMessages', {
+                    "chat_id": chat_id,
+                    "message_ids": json.dumps(batch)
+                })
+            except Exception as e:
+                logging.warning(f"Bulk delete failed in {chat_id}, falling back: {e}")
+                for message_id in batch:
+                    try:
+                        await self.bot.delete_message(chat_id, message_id)
+                    except Exception:
+                        pass
+        await self.flush_notices(chat_id)
+
+    def flush_soon(self, chat_id):
+        if chat_id not in self.flushing:
+            self.flushing.add(chat_id)
+            asyncio.create_task(self.flush_later(chat_id))
+
+    # render(count) -> текст уведомления; в пределах окна одно сообщение на нарушителя.
+    # Запись ставится до отправки: нарушения, пришедшие, пока уведомление отправляется,
+    # только увеличивают счётчик, а не шлют ещё по уведомлению
+    async def notify(self, chat_id, user_id, render):
+        now = time.monotonic()
+        while self.notices:
+            key, notice = next(iter(self.notices.items()))
+            if notice.expires > now:
+                break
+            self.notices.popitem(last=False)
+        
+        key = (chat_id, user_id)
+        notice = self.notices.get(key)
+        if notice is not None:
+            notice.count += 1
+            notice.render = render
+            notice.dirty = True
+            if notice.message_id is not None:
+                self.flush_soon(chat_id)
+            return
+        
+        notice = self.notices[key] = Notice(None, render, now + self.notice_window)
+        try:
+            sent = await self.bot.send_message(chat_id, render(1), parse_mode="Markdown")
+        except Exception:
+            if self.notices.get(key) is notice:
+                del self.notices[key]
+            raise
+        notice.message_id = sent.message_id
+        if notice.dirty:
+            self.flush_soon(chat_id)
+
+    async def flush_notices(self, chat_id):
+        for (notice_chat, user_id), notice in list(self.notices.items()):
+            if notice_chat != chat_id or not notice.dirty or notice.message_id is None:
+                continue
+            notice.dirty = False
+            try:
+                await self.bot.edit_message_text(
+                    notice.render(notice.count),
+                    chat_id,
+                    notice.message_id,
+                    parse_mode="Markdown"
+                )
+            except Exception as e:
+                logging.warning(f"Could not update notice for {user_id}: {e}")
+
+# Последние сообщения пользователя в чате: id в array, время последнего - для вытеснения
+class RecentMessages:
+    __slots__ = ('ids', 'last')
+
+    def __init__(self):
+        self.ids = array('l')
+        self.last = 0.0
+
+# Индекс последних сообщений по (чат, пользователь) для /purge и удаления при бане.
+# На пользователя хранится не больше per_user id, на всех - не больше max_users записей;
+# записи старше 48 часов вытесняются: такие сообщения Telegram уже не даёт удалить.
+class MessageIndex:
+    def __init__(self, per_user=50, max_users=20000, max_age=48 * 3600, clock=time.monotonic):
+        self.per_user = per_user
+        self.max_users = max_users
+        self.max_age = max_age
+        self.clock = clock
+        self.users = OrderedDict()  # (chat_id, user_id) -> RecentMessages, порядок = последняя активность
+
+    @classmethod
+    def from_config(cls, config, section='Purge'):
+        return cls(
+            config.getint(section, 'per_user', fallback=50),
+            config.getint(section, 'max_users', fallback=20000),
+            config.getfloat(section, 'max_age_hours', fallback=48) * 3600
+        )
+
+    def __len__(self):
+        return len(self.users)
+
+    def add(self, chat_id, user_id, message_id):
+        now = self.clock()
+        key = (chat_id, user_id)
+        recent = self.users.get(key)
+        if recent is None:
+            self.evict(now)
+            recent = self.users[key] = RecentMessages()
+        else:
+            self.users.move_to_end(key)
+        recent.ids.append(message_id)
+        if len(recent.ids) > self.per_user:
+            del recent.ids[0]
+        recent.last = now
+
+    def evict(self, now):
+        while self.users:
+            recent = next(iter(self.users.values()))
+            if len(self.users) < self.max_users and now - recent.last < self.max_age:
+                break
+            self.users.popitem(last=False)
+
+    # Забрать до limit последних id (все, если limit не задан); забранные из индекса удаляются
+    def take(self, chat_id, user_id, limit=None):
+        key = (chat_id, user_id)
+        recent = self.users.get(key)
+        if recent is None:
+            return []
+        if self.clock() - recent.last >= self.max_age:
+            del self.users[key]
+            return []
+        count = len(recent.ids) if limit is None else min(limit, len(recent.ids))
+        message_ids = recent.ids[len(recent.ids) - count:].tolist()
+        del recent.ids[len(recent.ids) - count:]
+        if not recent.ids:
+            del self.users[key]
+        return message_ids
+
+# Ключ медиа для правил kind = media: перцептивный хеш фото (по превью ~90px, в пуле процессов),
+# для стикеров, GIF, видео и файлов - "тип:file_unique_id". Хеши кэшируются по file_unique_id:
+# пересланная волна одной картинки скачивается один раз
+class MediaHasher:
+    TYPES = ('sticker', 'animation', 'video', 'document')
+
+    def __init__(self, workers=2, cache_size=4096, timeout=2.0):
+        self.workers = workers
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self.cache = OrderedDict()  # file_unique_id -> хеш
+        self.hashing = {}           # file_unique_id -> задача скачивания и хеширования
+        self.pool = None
+
+    @classmethod
+    def from_config(cls, config, section='Media'):
+        return cls(
+            config.getint(section, 'workers', fallback=2),
+            config.getint(section, 'cache_size', fallback=4096),
+            config.getfloat(section, 'hash_timeout', fallback=2.0)
+        )
+
+    # Пул создаётся при первой картинке: в режиме воркеров - уже в своём процессе
+    def executor(self):
+        if self.pool is None and self.workers > 0:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self.pool
+
+    async def hash_photo(self, message, unique_id):
+        try:
+            data = await bot.download_file_by_id(message.photo[0].file_id)
+            value = await asyncio.get_running_loop().run_in_executor(self.executor(), dhash, data.getvalue())
+        except Exception as e:
+            logging.warning(f"Could not hash photo {unique_id}: {e}")
+            return None
+        self.cache[unique_id] = value
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return value
+
+    # Обработчик ждёт хеш не дольше timeout (очередь чата стоит, пока он ждёт), дальше картинка
+    # считается неизвестной (None) и медиа-правила её пропускают: ключ по file_unique_id не
+    # совпал бы с хешами известного спама. Хеширование доходит в фоне и пригодится её повторам.
+    # Команды админов передают timeout=None и дожидаются хеша
+    async def key(self, message, timeout=...):
+        if timeout is ...:
+            timeout = self.timeout
+        if message.photo:
+            unique_id = message.photo[-1].file_unique_id
+            if not PERCEPTUAL_HASH:
+                return f"photo:{unique_id}"
+            value = self.cache.get(unique_id)
+            if value is not None:
+                self.cache.move_to_end(unique_id)
+                return value
+            task = self.hashing.get(unique_id)
+            if task is None:
+                task = self.hashing[unique_id] = asyncio.create_task(self.hash_photo(message, unique_id))
+                task.add_done_callback(lambda _: self.hashing.pop(unique_id, None))
+            try:
+                return await asyncio.wait_for(asyncio.shield(task), timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Photo {unique_id} not hashed in {timeout}s, skipping media rules")
+                return None
+        for content_type in self.TYPES:
+            media = getattr(message, content_type)
+            if media:
+                return f"{content_type}:{media.file_unique_id}"
+        return None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+# Защита от рейдов: счётчик входов, массовые ограничения и автоматический выход из режима
+class RaidGuard:
+    def __init__(self, bot):
+        self.bot = bot
+        self.max_joins = config.getint('AntiRaid', 'max_joins', fallback=10)
+        self.cooldown = config.getfloat('AntiRaid', 'cooldown_minutes', fallback=10) * 60
+        self.restrict_minutes = config.getint('AntiRaid', 'restrict_minutes', fallback=60)
+        self.semaphore = asyncio.Semaphore(config.getint('AntiRaid', 'concurrency', fallback=5))
+        self.counter = JoinRateCounter(config.getfloat('AntiRaid', 'join_seconds', fallback=60))
+        self.raids = {}  # chat_id -> состояние рейд-режима
+
+    def active(self, chat_id):
+        return chat_id in self.raids
+
+    async def on_join(self, chat_id, user_ids):
+        count = self.counter.add(chat_id, user_ids)
+        raid = self.raids.get(chat_id)
+        if raid is None:
+            if count < self.max_joins:
+                return False
+            raid = self.raids[chat_id] = {"joins": 0, "restricted": 0, "until": time.monotonic() + self.cooldown}
+            # Снятие режима планируется до оповещения: если оно не уйдёт (RetryAfter во время
+            # рейда), чат не должен остаться в рейд-режиме навсегда
+            asyncio.create_task(self.expire(chat_id))
+            # Ограничиваем всех, кто вошёл за окно, а не только последнего
+            user_ids = self.counter.recent(chat_id)
+            logging.warning(f"Raid detected in {chat_id}: {count} joins")
+            await self.alert(chat_id, count)
+        
+        raid["until"] = time.monotonic() + self.cooldown
+        raid["joins"] += len(user_ids)
+        raid["restricted"] += await self.restrict_all(chat_id, user_ids)
+        return True
+
+    async def alert(self, chat_id, count):
+        try:
+            await self.bot.send_message(chat_id, f"""
+{DECORATIONS['header']}
+{EMOJIS['alert']} **ОБНАРУЖЕН РЕЙД** {EMOJIS['alert']}
+{DECORATIONS['separator']}
+
+{EMOJIS['users']} *Входов за окно:* {count}
+{EMOJIS['lock']} *Новые участники ограничены на:* {format_time(self.restrict_minutes * 60)}
+{EMOJIS['time']} *Режим снимется через:* {format_time(int(self.cooldown))} без новых входов
+
+{DECORATIONS['footer']}
+""", parse_mode="Markdown")
+        except Exception as e:
+            logging.error(f"Error sending raid alert: {e}")
+
+    async def restrict_all(self, chat_id, user_ids):
+        until_date = datetime.now() + timedelta(minutes=self.restrict_minutes)
+        
+        async def restrict(user_id):
+            async with self.semaphore:
+                try:
+                    await self.bot.restrict_chat_member(
+                        chat_id,
+                        user_id,
+                        permissions=types.ChatPermissions(can_send_messages=False),
+                        until_date=until_date
+                    )
+                    return True
+                except Exception as e:
+                    logging.warning(f"Error restricting raider {user_id}: {e}")
+                    return False
+        
+        results = await asyncio.gather(*(restrict(user_id) for user_id in user_ids))
+        return sum(results)
+
+    async def expire(self, chat_id):
+        while True:
+            delay = self.raids[chat_id]["until"] - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        raid = self.raids.pop(chat_id)
+        logging.info(f"Raid mode ended in {chat_id}: {raid}")
+        try:
+            await self.bot.send_message(chat_id, f"""
+{DECORATIONS['header']}
+{EMOJIS['unlock']} **РЕЙД-РЕЖИМ СНЯТ** {EMOJIS['unlock']}
+{DECORATIONS['separator']}
+
+{EMOJIS['users']} *Вошло во время рейда:* {raid['joins']}
+{EMOJIS['lock']} *Ограничено:* {raid['restricted']}
+
+{DECORATIONS['footer']}
+""", parse_mode="Markdown")
+        except Exception as e:
+            logging.error(f"Error sending raid summary: {e}")
+
+# Счётчики варнов по (чат, пользователь) в хранилище состояния: читаются через его кэш,
+# своей копии всех счётчиков у процесса нет (в режиме воркеров она бы устаревала)
+class WarnCounter:
+    def __init__(self, store):
+        self.store = store
+
+    @staticmethod
+    def key(chat_id, user_id):
+        return f"warns:{chat_id}:{user_id}"
+
+    # Перенос старых ключей и первичное заполнение из punishments.json - один раз, одним процессом
+    async def migrate(self):
+        found = False
+        for key, count in await self.store.scan('warns:'):
+            found = True
+            parts = key.split(':')
+            if len(parts) == 2:
+                # Старый формат без чата: переносим в основной чат
+                self.store.delete(key)
+                if PRIMARY_CHAT is not None:
+                    self.set(PRIMARY_CHAT, int(parts[1]), count)
+        # Первый запуск с новым хранилищем: восстанавливаем счётчики из punishments.json
+        if not await self.store.get('meta:warns_seeded'):
+            if not found:
+                totals = defaultdict(int)
+                for warn in punishment_system.punishments['warns']:
+                    if record_chat(warn) is not None:
+                        totals[(record_chat(warn), warn['user_id'])] += 1
+                for (chat_id, user_id), total in totals.items():
+                    self.set(chat_id, user_id, total % 3)
+            self.store.set('meta:warns_seeded', True)
+
+    async def get(self, chat_id, user_id):
+        return await self.store.get(self.key(chat_id, user_id), 0)
+
+    def set(self, chat_id, user_id, count):
+        if count > 0:
+            self.store.set(self.key(chat_id, user_id), count)
+        else:
+            self.store.delete(self.key(chat_id, user_id))
+
+    async def add(self, chat_id, user_id, delta=1):
+        count = max(0, await self.get(chat_id, user_id) + delta)
+        self.set(chat_id, user_id, count)
+        return count
+
+    def reset(self, chat_id, user_id):
+        self.set(chat_id, user_id, 0)
+
+# Настройки чата: значения из c.ini, поверх них - изменения админов из хранилища
+BOOL_SETTINGS = ('antiword', 'anticaps', 'antispam')
+NUMBER_SETTINGS = {
+    'max_messages': int, 'spam_seconds': float, 'mute_minutes': int,
+    'max_similar': int, 'time_window': float, 'similarity': float
+}
+
+# Снимок настроек из c.ini: собирается и проверяется целиком, подменяется одной ссылкой.
+# Обработчик держит снимок через ChatSettings и дорабатывает со старым после перезагрузки.
+RELOADABLE_SECTIONS = ('Chat', 'Admin', 'Protection', 'AntiSpam')
+
+class ConfigSnapshot:
+    __slots__ = ('config', 'chat_ids', 'owner_ids', 'alert_chat_ids', 'protection', 'antispam', 'rule_engine')
+
+    def __init__(self, config, previous=None):
+        self.config = config
+        self.chat_ids = parse_ids(config.get('Chat', 'chat_id', fallback=''))
+        self.owner_ids = set(parse_ids(config.get('Admin', 'owner_ids', fallback='')))
+        self.alert_chat_ids = parse_ids(config.get('Admin', 'alert_chat_id', fallback=''))
+        self.protection = {key: config.getboolean('Protection', key, fallback=True) for key in BOOL_SETTINGS}
+        self.antispam = AntiSpamSettings.from_config(config)
+        for key in AntiSpamSettings.__slots__:
+            if getattr(self.antispam, key) <= 0:
+                raise ValueError(f"[AntiSpam] {key} must be positive")
+        if self.antispam.similarity > 1:
+            raise ValueError("[AntiSpam] similarity must be between 0 and 1")
+        self.rule_engine = RuleEngine.from_config(config, flood_detector, word_filter, known_media)
+        if previous is not None:
+            # Индексы похожих сообщений и медиа и статистика правил переживают перезагрузку
+            self.rule_engine.similarity = previous.rule_engine.similarity
+            self.rule_engine.media = previous.rule_engine.media
+            old_rules = {rule.name: rule for rule in previous.rule_engine.rules}
+            for rule in self.rule_engine.rules:
+                old = old_rules.get(rule.name)
+                if old is not None:
+                    rule.checks, rule.hits, rule.time_ns = old.checks, old.hits, old.time_ns
+
+    def restart_sections(self, changed):
+        return [name for name in changed if name not in RELOADABLE_SECTIONS and not name.startswith('Rule:')]
+
+class ChatSettings:
+    __slots__ = ('chat_id', 'enabled', 'protection', 'antispam', 'overrides', 'snapshot')
+
+    def __init__(self, chat_id, overrides, snapshot):
+        self.chat_id = chat_id
+        self.overrides = overrides
+        self.snapshot = snapshot
+        self.enabled = overrides.get('enabled', not snapshot.chat_ids or chat_id in snapshot.chat_ids)
+        self.protection = {key: overrides.get(key, value) for key, value in snapshot.protection.items()}
+        self.antispam = snapshot.antispam.copy(**{
+            key: value for key, value in overrides.items() if key in NUMBER_SETTINGS
+        })
+
+# Кэш настроек: хранилище читается один раз на чат, сбрасывается при изменениях
+class ChatSettingsCache:
+    def __init__(self, store):
+        self.store = store
+        self.cache = {}
+
+    async def get(self, chat_id):
+        settings = self.cache.get(chat_id)
+        if settings is None:
+            overrides = await self.store.get(f"chat:{chat_id}", {})
+            settings = self.cache[chat_id] = ChatSettings(chat_id, overrides, snapshot)
+        return settings
+
+    async def update(self, chat_id, **changes):
+        overrides = dict(await self.store.get(f"chat:{chat_id}", {}))
+        overrides.update(changes)
+        self.store.set(f"chat:{chat_id}", overrides)
+        self.invalidate(chat_id)
+        return await self.get(chat_id)
+
+    def invalidate(self, chat_id=None):
+        if chat_id is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(chat_id, None)
+
 # Инициализация бота
 bot = Bot(token=config['Bot']['token'])
-storage = MemoryStorage()
+state_store = StateStore.from_config(config)
+storage = StoreFSMStorage(state_store)
 dp = Dispatcher(bot, storage=storage)
-punishment_system = PunishmentSystem()
+mod_stats = ModStats(state_store, bot.id)
+punishment_system = PunishmentSystem(mod_stats)
+warn_counter = WarnCounter(state_store)
+chat_settings = ChatSettingsCache(state_store)
+moderation_buffer = ModerationBuffer(bot)
+raid_guard = RaidGuard(bot)
+message_index = MessageIndex.from_config(config)
+media_hasher = MediaHasher.from_config(config)
+PURGE_ON_BAN = config.getboolean('Purge', 'on_ban', fallback=True)
 logging.basicConfig(level=logging.INFO)
 
-# Хранение данных
-user_data = {}
-spam_data = {}
+# Дочитывание очереди после перезапуска: старые команды-развлечения не отвечаем
+STALE_SECONDS = config.getfloat('Updates', 'stale_seconds', fallback=60)
+dp.middleware.setup(StaleUpdateMiddleware(
+    STALE_SECONDS,
+    commands=('start', 'help', 'about', 'slot', 'casino', 'dice', 'flip', 'bans', 'mutes', 'warns', 'rules')
+))
+
+# Профилировщик цикла событий для /profile
+loop_profiler = LoopProfiler()
+dp.middleware.setup(ProfilerMiddleware(loop_profiler))
+
+# Служебные оповещения (в них бывает текст исключений) уходят только админам: в alert_chat_id,
+# без него - владельцам, без них - в личку админам основного чата. В сам чат - никогда
+async def alert_recipients():
+    recipients = snapshot.alert_chat_ids or sorted(snapshot.owner_ids)
+    if recipients or not snapshot.chat_ids:
+        return recipients
+    try:
+        admins = await bot.get_chat_administrators(snapshot.chat_ids[0])
+    except Exception as e:
+        logging.error(f"Error getting admins of {snapshot.chat_ids[0]} for alerts: {e}")
+        return []
+    return [admin.user.id for admin in admins if not admin.user.is_bot]
 
-# Настройки защиты
-protection_settings = {
-    "antiword": config.getboolean('Protection', 'antiword', fallback=True),
-    "anticaps": config.getboolean('Protection', 'anticaps', fallback=True),
-    "antispam": config.getboolean('Protection', 'antispam', fallback=True)
-}
+async def send_alert(text):
+    delivered = False
+    for chat_id in await alert_recipients():
+        try:
+            await bot.send_message(chat_id, text, parse_mode="Markdown")
+            delivered = True
+        except Exception as e:
+            logging.error(f"Error sending alert to {chat_id}: {e}")
+    if not delivered:
+        logging.warning(f"Alert not delivered (set [Admin] alert_chat_id or owner_ids): {text.strip()[:200]}")
+
+# Задержка цикла событий и медленные шаги (блокирующие вызовы); у каждого воркера свой цикл
+async def alert_loop_lag(monitor):
+    stats = monitor.stats()
+    slow = "\n".join(f"{DECORATIONS['bullet']} `{name}` — {count}" for name, count in stats['top']) or "—"
+    await send_alert(f"""
+{DECORATIONS['header']}
+{EMOJIS['alert']} **БОТ ТОРМОЗИТ** {EMOJIS['alert']}
+{DECORATIONS['separator']}
+
+{EMOJIS['time']} *Задержка цикла:* {stats['current'] * 1000:.0f} мс (порог {monitor.threshold * 1000:.0f} мс)
+{EMOJIS['fire']} *Медленные шаги:*
+{slow}
+
+{DECORATIONS['footer']}
+""")
+
+loop_monitor = LoopMonitor.from_config(config, on_alert=alert_loop_lag)
+
+# Очереди обновлений по чатам; при перегрузке первыми отбрасываются игры и справка.
+# Профилирование, выгрузка и игры с анимацией идут мимо очереди чата: антиспам их не ждёт
+update_executor = UpdateExecutor.from_config(
+    dp, config,
+    low_priority=('slot', 'casino', 'dice', 'flip', 'about', 'start', 'help'),
+    detached=('profile', 'export', 'slot', 'casino', 'dice')
+)
+
+# Окна сообщений (ограничены по памяти), словарь и известный спам живут дольше снимков настроек
+flood_detector = FloodDetector(AntiSpamSettings.from_config(config))
+word_filter = WordFilter.from_config(config)
+known_media = KnownMedia(
+    state_store,
+    config.getint('Media', 'max_known', fallback=5000),
+    config.getfloat('Media', 'known_days', fallback=7)
+)
+
+# Настройки защиты, антиспама и правила модерации (секции [Rule:...] в c.ini)
+snapshot = ConfigSnapshot(config)
 
 # Эмодзи и декорации
 EMOJIS = {
@@ -142,16 +855,15 @@ DECORATIONS = {
 }
 
 # Вспомогательные функции
+# Возвращает настройки чата, если бот в нём работает, иначе None
 async def check_chat(message: types.Message):
     try:
-        allowed_chat = config.get('Chat', 'chat_id', fallback=None)
-        if not allowed_chat:
-            logging.error("Chat ID not found in config!")
-            return True
-        return str(message.chat.id) == allowed_chat
-    except:
-        logging.error("Error checking chat ID!")
-        return True
+        settings = await chat_settings.get(message.chat.id)
+        return settings if settings.enabled else None
+    except Exception as e:
+        logging.error(f"Error checking chat {message.chat.id}: {e}")
+        settings = ChatSettings(message.chat.id, {}, snapshot)
+        return settings if settings.enabled else None
 
 async def is_admin(message: types.Message):
     if not await check_chat(message):
@@ -212,6 +924,9 @@ async def cmd_help(message: types.Message):
 
 {EMOJIS['shield']} *Модерация:*
 {EMOJIS['ban']} `/ban [ID/reply] [время] [причина]` - Бан
+{EMOJIS['cross']} `/purge [ID/reply] [количество]` - Удалить последние сообщения
+{EMOJIS['ban']} `/blockmedia [reply]` - Известный спам: картинка, стикер или GIF
+{EMOJIS['unban']} `/unblockmedia [reply/all]` - Убрать из известного спама
 {EMOJIS['mute']} `/mute [ID/reply] [время] [причина]` - Мут
 {EMOJIS['warn']} `/warn [ID/reply] [причина]` - Варн
 {EMOJIS['unban']} `/unban [ID]` - Разбан
@@ -222,6 +937,13 @@ async def cmd_help(message: types.Message):
 {EMOJIS['page']} `/bans` - Список банов
 {EMOJIS['page']} `/mutes` - Список мутов
 {EMOJIS['page']} `/warns` - Список варнов
+{EMOJIS['chart']} `/rules` - Статистика правил
+{EMOJIS['chart']} `/queue` - Очередь и задержка бота
+{EMOJIS['time']} `/profile [секунд]` - Профилирование бота
+{EMOJIS['gear']} `/mem [start|stop]` - Память бота
+{EMOJIS['chart']} `/modstats [дней]` - Статистика модерации
+{EMOJIS['scroll']} `/export [тип] [с даты]` - Выгрузка наказаний
+{EMOJIS['gear']} `/set [настройка] [значение]` - Настройки чата
 {EMOJIS['info']} `/about` - О боте
 
 {EMOJIS['game_die']} *Мини-игры:*
@@ -248,17 +970,78 @@ PUNISHMENTS = {
     "forbidden_symbols": "Запрещенные символы"
 }
 
-# Мини-игры
+# Мини-игры: ограничения на чат и пользователя, чтобы волна игр не съедала лимиты модерации
+class GameScheduler:
+    def __init__(self, per_chat=2, cooldown=10.0):
+        self.per_chat = per_chat
+        self.cooldown = cooldown
+        self.active = defaultdict(int)  # chat_id -> идущих игр
+        self.playing = set()            # (chat_id, user_id) с идущей игрой
+        self.last_play = OrderedDict()  # (chat_id, user_id) -> время последней игры
+
+    def try_start(self, chat_id, user_id):
+        now = time.monotonic()
+        while self.last_play:
+            key, started = next(iter(self.last_play.items()))
+            if now - started < self.cooldown:
+                break
+            self.last_play.popitem(last=False)
+        
+        key = (chat_id, user_id)
+        if key in self.playing or key in self.last_play or self.active[chat_id] >= self.per_chat:
+            return False
+        self.active[chat_id] += 1
+        self.playing.add(key)
+        self.last_play[key] = now
+        return True
+
+    def finish(self, chat_id, user_id):
+        self.playing.discard((chat_id, user_id))
+        self.active[chat_id] -= 1
+        if self.active[chat_id] <= 0:
+            del self.active[chat_id]
+
+game_scheduler = GameScheduler(
+    config.getint('Games', 'max_per_chat', fallback=2),
+    config.getfloat('Games', 'user_cooldown', fallback=10)
+)
+
+# Лишние игры молча отбрасываются: ответ на отказ тоже стоит запроса к API
+def scheduled_game(handler):
+    @functools.wraps(handler)
+    async def wrapper(message: types.Message):
+        chat_id, user_id = message.chat.id, message.from_user.id
+        if not game_scheduler.try_start(chat_id, user_id):
+            return
+        try:
+            await handler(message)
+        finally:
+            game_scheduler.finish(chat_id, user_id)
+    return wrapper
+
+# Длительность анимации нативных кубиков Telegram
+DICE_ANIMATION = 2.5
+
+# Значение 🎰 (1-64) кодирует три барабана по 4 символа
+SLOT_REELS = ['BAR', '🍇', '🍋', '7️⃣']
+
+def decode_slot(value):
+    return [SLOT_REELS[((value - 1) >> (2 * i)) & 3] for i in range(3)]
+
+async def roll_dice(message: types.Message, emoji, fallback):
+    try:
+        dice = await message.reply_dice(emoji=emoji)
+        await asyncio.sleep(DICE_ANIMATION)
+        return dice, dice.dice.value
+    except Exception as e:
+        logging.warning(f"sendDice failed, using text fallback: {e}")
+        return message, fallback()
+
 @dp.message_handler(commands=['slot'])
+@scheduled_game
 async def cmd_slot(message: types.Message):
-    slots = [random.choice(['🍎', '🍊', '🍋', '🍒', '🔔', '💎', '7️⃣']) for _ in range(3)]
-    
-    msg = await message.reply("🎰 | - | - | - |")
-    await asyncio.sleep(0.5)
-    await msg.edit_text(f"🎰 | {slots[0]} | - | - |")
-    await asyncio.sleep(0.5)
-    await msg.edit_text(f"🎰 | {slots[0]} | {slots[1]} | - |")
-    await asyncio.sleep(0.5)
+    target, value = await roll_dice(message, types.DiceEmoji.SLOT_MACHINE, lambda: random.randint(1, 64))
+    slots = decode_slot(value)
     
     result = f"""
 {DECORATIONS['header']}
@@ -277,39 +1060,34 @@ async def cmd_slot(message: types.Message):
         result += f"\n{EMOJIS['lose']} *Попробуйте снова* {EMOJIS['lose']}"
         
     result += f"\n\n{DECORATIONS['footer']}"
-    await msg.edit_text(result, parse_mode="Markdown")
+    await target.reply(result, parse_mode="Markdown")
 
 @dp.message_handler(commands=['casino'])
+@scheduled_game
 async def cmd_casino(message: types.Message):
-    numbers = [random.randint(0, 9) for _ in range(3)]
-    
-    msg = await message.reply(f"{EMOJIS['casino']} | ? | ? | ? |")
-    await asyncio.sleep(0.7)
-    await msg.edit_text(f"{EMOJIS['casino']} | {numbers[0]} | ? | ? |")
-    await asyncio.sleep(0.7)
-    await msg.edit_text(f"{EMOJIS['casino']} | {numbers[0]} | {numbers[1]} | ? |")
-    await asyncio.sleep(0.7)
+    target, value = await roll_dice(message, types.DiceEmoji.DART, lambda: random.randint(1, 6))
     
     response = f"""
 {DECORATIONS['header']}
 {EMOJIS['casino']} **КАЗИНО** {EMOJIS['casino']}
 {DECORATIONS['separator']}
 
-{EMOJIS['casino']} | {numbers[0]} | {numbers[1]} | {numbers[2]} |
+{EMOJIS['casino']} Очки: *{value}/6*
 
 """
     
-    if len(set(numbers)) == 1:
-        response += f"\n{EMOJIS['win']} **ДЖЕКПОТ!** {EMOJIS['win']}"
-    elif len(set(numbers)) == 2:
+    if value == 6:
+        response += f"\n{EMOJIS['win']} **ДЖЕКПОТ! В яблочко!** {EMOJIS['win']}"
+    elif value >= 4:
         response += f"\n{EMOJIS['star']} *Хорошая комбинация!* {EMOJIS['star']}"
     else:
         response += f"\n{EMOJIS['lose']} *Попробуйте ещё раз* {EMOJIS['lose']}"
         
     response += f"\n\n{DECORATIONS['footer']}"
-    await msg.edit_text(response, parse_mode="Markdown")
+    await target.reply(response, parse_mode="Markdown")
 
 @dp.message_handler(commands=['dice'])
+@scheduled_game
 async def cmd_dice(message: types.Message):
     dice1 = random.randint(1, 6)
     dice2 = random.randint(1, 6)
@@ -330,13 +1108,11 @@ async def cmd_dice(message: types.Message):
     await message.reply(response, parse_mode="Markdown")
 
 @dp.message_handler(commands=['flip'])
+@scheduled_game
 async def cmd_flip(message: types.Message):
     result = random.choice(["ОРЁЛ", "РЕШКА"])
     emoji = "🦅" if result == "ОРЁЛ" else "👑"
     
-    msg = await message.reply(f"{EMOJIS['coin']} Подбрасываем монетку...")
-    await asyncio.sleep(1)
-    
     response = f"""
 {DECORATIONS['header']}
 {EMOJIS['coin']} **МОНЕТКА** {EMOJIS['coin']}
@@ -346,7 +1122,7 @@ async def cmd_flip(message: types.Message):
 
 {DECORATIONS['footer']}
 """
-    await msg.edit_text(response, parse_mode="Markdown")
+    await message.reply(response, parse_mode="Markdown")
 
         # Команды модерации
         
@@ -355,7 +1131,7 @@ async def cmd_bans(message: types.Message):
     if not await is_admin(message):
         return await message.reply(f"{EMOJIS['cross']} У вас недостаточно прав")
         
-    active_bans = punishment_system.get_active_punishments('bans')
+    active_bans = punishment_system.get_active_punishments('bans', message.chat.id)
     
     if not active_bans:
         return await message.reply(f"{EMOJIS['info']} Активные баны отсутствуют")
@@ -387,7 +1163,7 @@ async def cmd_mutes(message: types.Message):
     if not await is_admin(message):
         return await message.reply(f"{EMOJIS['cross']} У вас недостаточно прав")
         
-    active_mutes = punishment_system.get_active_punishments('mutes')
+    active_mutes = punishment_system.get_active_punishments('mutes', message.chat.id)
     
     if not active_mutes:
         return await message.reply(f"{EMOJIS['info']} Активные муты отсутствуют")
@@ -419,7 +1195,7 @@ async def cmd_warns(message: types.Message):
     if not await is_admin(message):
         return await message.reply(f"{EMOJIS['cross']} У вас недостаточно прав")
         
-    all_warns = punishment_system.punishments['warns']
+    all_warns = punishment_system.get_chat_punishments('warns', message.chat.id)
     
     if not all_warns:
         return await message.reply(f"{EMOJIS['info']} Предупреждения отсутствуют")
@@ -493,6 +1269,7 @@ async def cmd_ban(message: types.Message):
         )
         
         punishment_system.add_punishment('bans', {
+            "chat_id": message.chat.id,
             "user_id": user_id,
             "admin_id": message.from_user.id,
             "admin_name": message.from_user.get_mention(),
@@ -500,6 +1277,7 @@ async def cmd_ban(message: types.Message):
             "until_date": until_date.timestamp() if until_date else None,
             "date": datetime.now().timestamp()
         })
+        purged = purge_user(message.chat.id, user_id) if PURGE_ON_BAN else 0
         
         response = f"""
 {DECORATIONS['header']}
@@ -510,6 +1288,7 @@ async def cmd_ban(message: types.Message):
 {EMOJIS['time']} *Срок:* {'Навсегда' if not ban_time else format_time(ban_time)}
 {EMOJIS['scroll']} *Причина:* {reason}
 {EMOJIS['shield']} *Модератор:* {message.from_user.get_mention()}
+{f"{EMOJIS['cross']} *Удалено сообщений:* {purged}" if purged else ""}
 
 {DECORATIONS['footer']}
 """
@@ -518,6 +1297,108 @@ async def cmd_ban(message: types.Message):
     except Exception as e:
         await message.reply(f"{EMOJIS['cross']} Ошибка: {str(e)}")
 
+# Удаление последних сообщений пользователя из индекса: пакетами через буфер модерации.
+# extra - сообщение, которое удаляется в любом случае (ответ в /purge: медиа или старое)
+def purge_user(chat_id, user_id, limit=None, extra=None):
+    message_ids = message_index.take(chat_id, user_id, limit)
+    if extra is not None and extra not in message_ids:
+        message_ids.append(extra)
+    for message_id in message_ids:
+        moderation_buffer.delete(chat_id, message_id)
+    return len(message_ids)
+
+@dp.message_handler(commands=['purge'])
+async def cmd_purge(message: types.Message):
+    if not await is_admin(message):
+        return await message.reply(f"{EMOJIS['cross']} У вас недостаточно прав")
+    
+    args = message.get_args().split()
+    extra = None
+    if message.reply_to_message:
+        user_id = message.reply_to_message.from_user.id
+        user_mention = message.reply_to_message.from_user.get_mention()
+        extra = message.reply_to_message.message_id
+    elif args:
+        try:
+            user_id = int(args.pop(0))
+            user_mention = await get_user_mention(message.chat.id, user_id)
+        except ValueError:
+            return await message.reply(f"{EMOJIS['cross']} Неверный ID пользователя")
+    else:
+        return await message.reply(f"{EMOJIS['info']} Использование: `/purge [ID/reply] [количество]`", parse_mode="Markdown")
+    
+    if args and not args[0].isdigit():
+        return await message.reply(f"{EMOJIS['cross']} Количество должно быть числом")
+    limit = int(args[0]) if args else None
+    
+    purged = purge_user(message.chat.id, user_id, limit, extra)
+    if not purged:
+        return await message.reply(f"{EMOJIS['info']} Нет недавних сообщений {user_mention}", parse_mode="Markdown")
+    
+    response = f"""
+{DECORATIONS['header']}
+{EMOJIS['cross']} **СООБЩЕНИЯ УДАЛЕНЫ** {EMOJIS['cross']}
+{DECORATIONS['separator']}
+
+{EMOJIS['guard']} *Пользователь:* {user_mention}
+{EMOJIS['number']} *Удалено:* {purged}
+{EMOJIS['shield']} *Модератор:* {message.from_user.get_mention()}
+
+{DECORATIONS['footer']}
+"""
+    await message.reply(response, parse_mode="Markdown")
+
+# Известный спам чата: медиа из ответа срабатывает с первого сообщения (без ответа - сколько их)
+@dp.message_handler(commands=['blockmedia'])
+async def cmd_blockmedia(message: types.Message):
+    if not await is_admin(message):
+        return await message.reply(f"{EMOJIS['cross']} У вас недостаточно прав")
+    
+    reply = message.reply_to_message
+    media = await media_hasher.key(reply, timeout=None) if reply else None
+    if media is None:
+        return await message.reply(
+            f"{EMOJIS['info']} Известного спама в чате: {known_media.count(message.chat.id)}\n"
+            f"Добавить: ответьте `/blockmedia` на картинку, стикер или GIF\n"
+            f"Убрать: `/unblockmedia` ответом или `/unblockmedia all`",
+            parse_mode="Markdown"
+        )
+    
+    known_media.add(message.chat.id, media)
+    response = f"""
+{DECORATIONS['header']}
+{EMOJIS['ban']} **МЕДИА В СПАМЕ** {EMOJIS['ban']}
+{DECORATIONS['separator']}
+
+{EMOJIS['info']} Такие же медиа удаляются с первого сообщения ({known_media.ttl / 86400:g} дн.)
+{EMOJIS['shield']} *Модератор:* {message.from_user.get_mention()}
+
+{DECORATIONS['footer']}
+"""
+    await message.reply(response, parse_mode="Markdown")
+
+# Ложное срабатывание: медиа из ответа и похожие на него убираются из известного спама чата
+@dp.message_handler(commands=['unblockmedia'])
+async def cmd_unblockmedia(message: types.Message):
+    if not await is_admin(message):
+        return await message.reply(f"{EMOJIS['cross']} У вас недостаточно прав")
+    
+    reply = message.reply_to_message
+    media = await media_hasher.key(reply, timeout=None) if reply else None
+    if message.get_args().strip().lower() == 'all':
+        removed = known_media.forget(message.chat.id)
+    elif media is not None:
+        removed = known_media.forget(message.chat.id, media)
+    else:
+        return await message.reply(
+            f"{EMOJIS['info']} Использование: `/unblockmedia` ответом на медиа или `/unblockmedia all`",
+            parse_mode="Markdown"
+        )
+    
+    if not removed:
+        return await message.reply(f"{EMOJIS['info']} Этого медиа нет в известном спаме")
+    await message.reply(f"{EMOJIS['check']} Убрано из известного спама: {removed}")
+
 @dp.message_handler(commands=['about'])
 async def cmd_about(message: types.Message):
     response = f"""
@@ -579,6 +1460,7 @@ async def cmd_mute(message: types.Message):
         )
         
         punishment_system.add_punishment('mutes', {
+            "chat_id": message.chat.id,
             "user_id": user_id,
             "admin_id": message.from_user.id,
             "admin_name": message.from_user.get_mention(),
@@ -625,12 +1507,10 @@ async def cmd_warn(message: types.Message):
         except:
             return await message.reply(f"{EMOJIS['cross']} Неверный ID пользователя")
     
-    if user_id not in user_data:
-        user_data[user_id] = {"warns": 0}
-    user_data[user_id]["warns"] += 1
-    warns_count = user_data[user_id]["warns"]
+    warns_count = await warn_counter.add(message.chat.id, user_id)
     
     punishment_system.add_punishment('warns', {
+        "chat_id": message.chat.id,
         "user_id": user_id,
         "admin_id": message.from_user.id,
         "admin_name": message.from_user.get_mention(),
@@ -663,8 +1543,9 @@ async def cmd_warn(message: types.Message):
         )
         
         punishment_system.add_punishment('mutes', {
+            "chat_id": message.chat.id,
             "user_id": user_id,
-            "admin_id": message.from_user.id,
+            "admin_id": bot.id,
             "admin_name": "Система варнов",
             "reason": "Превышен лимит предупреждений (3/3)",
             "until_date": until_date.timestamp(),
@@ -675,7 +1556,7 @@ async def cmd_warn(message: types.Message):
 {EMOJIS['mute']} **АВТОМАТИЧЕСКИЙ МУТ НА 3 ЧАСА**
 {EMOJIS['info']} *Причина:* Превышен лимит предупреждений
 """
-        user_data[user_id]["warns"] = 0
+        warn_counter.reset(message.chat.id, user_id)
         
     response += f"\n{DECORATIONS['footer']}"
     await message.reply(response, parse_mode="Markdown")
@@ -694,7 +1575,7 @@ async def cmd_unban(message: types.Message):
         user_mention = await get_user_mention(message.chat.id, user_id)
         
         await bot.unban_chat_member(message.chat.id, user_id)
-        punishment_system.remove_punishment('bans', user_id)
+        punishment_system.remove_punishment('bans', user_id, message.chat.id)
         
         response = f"""
 {DECORATIONS['header']}
@@ -738,7 +1619,7 @@ async def cmd_unmute(message: types.Message):
             )
         )
         
-        punishment_system.remove_punishment('mutes', user_id)
+        punishment_system.remove_punishment('mutes', user_id, message.chat.id)
         
         response = f"""
 {DECORATIONS['header']}
@@ -771,17 +1652,13 @@ async def cmd_unwarn(message: types.Message):
             user_id = int(args[0])
             user_mention = await get_user_mention(message.chat.id, user_id)
         
-        user_warns = punishment_system.get_user_warns(user_id)
-        if not user_warns:
-            return await message.reply(f"{EMOJIS['info']} У пользователя нет предупреждений")
-        
         # Удаляем последнее предупреждение
-        punishment_system.punishments['warns'].remove(user_warns[-1])
-        punishment_system.save_data()
+        warns_count = punishment_system.remove_last_warn(user_id, message.chat.id)
+        if not warns_count:
+            return await message.reply(f"{EMOJIS['info']} У пользователя нет предупреждений")
         
         # Обновляем счетчик варнов
-        if user_id in user_data:
-            user_data[user_id]["warns"] = max(0, user_data[user_id]["warns"] - 1)
+        await warn_counter.add(message.chat.id, user_id, -1)
         
         response = f"""
 {DECORATIONS['header']}
@@ -789,7 +1666,7 @@ async def cmd_unwarn(message: types.Message):
 {DECORATIONS['separator']}
 
 {EMOJIS['guard']} *Пользователь:* {user_mention}
-{EMOJIS['alert']} *Осталось варнов:* {len(user_warns)-1}/3
+{EMOJIS['alert']} *Осталось варнов:* {warns_count-1}/3
 {EMOJIS['shield']} *Модератор:* {message.from_user.get_mention()}
 
 {DECORATIONS['footer']}
@@ -799,106 +1676,493 @@ async def cmd_unwarn(message: types.Message):
     except Exception as e:
         await message.reply(f"{EMOJIS['cross']} Ошибка: {str(e)}")
 
-# Защита от спама/капса/флуда
-@dp.message_handler()
-async def handle_messages(message: types.Message):
-    if not await check_chat(message):
-        return
+@dp.message_handler(commands=['rules'])
+async def cmd_rules(message: types.Message):
+    if not await is_admin(message):
+        return await message.reply(f"{EMOJIS['cross']} У вас недостаточно прав")
+    
+    response = f"""
+{DECORATIONS['header']}
+{EMOJIS['chart']} **ПРАВИЛА МОДЕРАЦИИ** {EMOJIS['chart']}
+{DECORATIONS['separator']}
+"""
+    for name, checks, hits, time_ns in snapshot.rule_engine.stats():
+        average = time_ns / checks / 1000 if checks else 0
+        hits_text = f"срабатываний: {hits}, " if hits is not None else ""
+        response += f"\n{DECORATIONS['bullet']} `{name}` — {hits_text}проверок: {checks}, ср. {average:.1f} мкс"
+    
+    response += f"\n\n{DECORATIONS['footer']}"
+    await message.reply(response, parse_mode="Markdown")
+
+@dp.message_handler(commands=['queue'])
+async def cmd_queue(message: types.Message):
+    if not await is_admin(message):
+        return await message.reply(f"{EMOJIS['cross']} У вас недостаточно прав")
+    
+    stats = update_executor.stats()
+    lag = loop_monitor.stats()
+    slow = "".join(f"\n{DECORATIONS['bullet']} `{name}` — {count}" for name, count in lag['top'])
+    response = f"""
+{DECORATIONS['header']}
+{EMOJIS['chart']} **ОЧЕРЕДЬ ОБНОВЛЕНИЙ** {EMOJIS['chart']}
+{DECORATIONS['separator']}
+
+{EMOJIS['page']} *В очереди:* {stats['pending']} (пик: {stats['peak']})
+{EMOJIS['users']} *Чатов с очередью:* {stats['chats']}, самая длинная: {stats['deepest']}
+{EMOJIS['lightning']} *Обрабатывается:* {stats['in_flight']}/{stats['concurrency']}
+{EMOJIS['check']} *Обработано:* {stats['processed']}
+{EMOJIS['cross']} *Отброшено при перегрузке:* {stats['shed']}
+
+{EMOJIS['time']} *Задержка цикла:* сейчас {lag['current'] * 1000:.0f} мс, ср. {lag['avg'] * 1000:.1f} мс, p99 {lag['p99'] * 1000:.0f} мс, макс. {lag['max'] * 1000:.0f} мс
+{EMOJIS['fire']} *Медленных шагов:* {lag['slow']}{slow}
+
+{DECORATIONS['footer']}
+"""
+    await message.reply(response, parse_mode="Markdown")
+
+# Выгрузка истории наказаний: записи идут пачками в gzip-файл на диске,
+# поэтому память не растёт вместе с историей
+EXPORT_TYPES = ('bans', 'mutes', 'warns')
+EXPORT_FIELDS = ('type', 'chat_id', 'user_id', 'admin_id', 'admin_name', 'reason', 'date', 'until_date')
+EXPORT_CHUNK = 1000
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # лимит Bot API на отправку файла
+
+def parse_since(value):
+    if value[-1] in 'dд' and value[:-1].isdigit():
+        return (datetime.now() - timedelta(days=int(value[:-1]))).timestamp()
+    for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            pass
+    raise ValueError(value)
+
+def export_time(timestamp):
+    return datetime.fromtimestamp(timestamp).isoformat(timespec='seconds') if timestamp else ''
+
+def export_row(type_name, record):
+    return {
+        'type': type_name,
+        'chat_id': record_chat(record),
+        'user_id': record['user_id'],
+        'admin_id': record.get('admin_id'),
+        'admin_name': record.get('admin_name'),
+        'reason': record.get('reason'),
+        'date': export_time(record.get('date')),
+        'until_date': export_time(record.get('until_date'))
+    }
+
+def write_export_rows(out, writer, rows):
+    if writer is not None:
+        writer.writerows(rows)
+    else:
+        out.writelines(json.dumps(row, ensure_ascii=False) + '\n' for row in rows)
+
+@dp.message_handler(commands=['export'])
+async def cmd_export(message: types.Message):
+    if not await is_admin(message):
+        return await message.reply(f"{EMOJIS['cross']} У вас недостаточно прав")
+    
+    # /export [bans|mutes|warns|all] [с даты: 2024-01-31, 31.01.2024 или 30d] [csv|jsonl]
+    type_names, since, fmt = EXPORT_TYPES, 0, 'csv'
+    try:
+        for arg in message.get_args().lower().split():
+            if arg in EXPORT_TYPES:
+                type_names = (arg,)
+            elif arg in ('csv', 'jsonl'):
+                fmt = arg
+            elif arg != 'all':
+                since = parse_since(arg)
+    except ValueError:
+        return await message.reply(
+            f"{EMOJIS['info']} Использование: `/export [bans|mutes|warns|all] [с даты|30d] [csv|jsonl]`",
+            parse_mode="Markdown"
+        )
+    
+    chat_id = message.chat.id
+    loop = asyncio.get_running_loop()
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}.gz")
+    os.close(fd)
+    count = 0
+    try:
+        out = await loop.run_in_executor(None, functools.partial(gzip.open, path, 'wt', encoding='utf-8', newline=''))
+        try:
+            writer = csv.DictWriter(out, EXPORT_FIELDS) if fmt == 'csv' else None
+            if writer is not None:
+                writer.writeheader()
+            for type_name in type_names:
+                punishment_system.refresh()
+                records = punishment_system.punishments[type_name]
+                for start in range(0, len(records), EXPORT_CHUNK):
+                    rows = [
+                        export_row(type_name, record) for record in records[start:start + EXPORT_CHUNK]
+                        if record_chat(record) == chat_id and (record.get('date') or 0) >= since
+                    ]
+                    if rows:
+                        # Сжатие и запись - в потоке, цикл событий между пачками свободен
+                        await loop.run_in_executor(None, write_export_rows, out, writer, rows)
+                        count += len(rows)
+        finally:
+            await loop.run_in_executor(None, out.close)
         
-    user_id = message.from_user.id
-    current_time = datetime.now()
-    text = message.text or ""
+        if not count:
+            return await message.reply(f"{EMOJIS['info']} Нет записей для выгрузки")
+        if os.path.getsize(path) > EXPORT_MAX_BYTES:
+            return await message.reply(f"{EMOJIS['cross']} Файл больше 50 МБ, укажите тип или период короче")
+        
+        kind = type_names[0] if len(type_names) == 1 else 'all'
+        filename = f"punishments_{kind}_{datetime.now().strftime('%Y%m%d')}.{fmt}.gz"
+        await message.reply_document(
+            types.InputFile(path, filename=filename),
+            caption=f"{EMOJIS['scroll']} Записей: {count}"
+        )
+    finally:
+        os.remove(path)
+
+@dp.message_handler(commands=['profile'])
+async def cmd_profile(message: types.Message):
+    if not await is_admin(message):
+        return await message.reply(f"{EMOJIS['cross']} У вас недостаточно прав")
+    if loop_profiler.active:
+        return await message.reply(f"{EMOJIS['info']} Профилирование уже идёт")
     
-    # Проверка на спам символы
-    if re.search(r'꙰|ᡃ⃝|⃟', text):
-        await message.delete()
-        response = f"""
+    args = message.get_args().strip()
+    seconds = min(max(int(args), 1), 120) if args.isdigit() else 10
+    await message.reply(f"{EMOJIS['time']} Профилирование {seconds} с...")
+    profile = await loop_profiler.run(seconds)
+    
+    def rows(table):
+        return "\n".join(
+            f"{DECORATIONS['bullet']} `{name}` — CPU {cpu * 1000:.0f} мс, на цикле {wall * 1000:.0f} мс, шагов {steps}"
+            for name, (steps, cpu, wall) in profile.top(table, 8)
+        ) or "—"
+    
+    responses = "\n".join(
+        f"{DECORATIONS['bullet']} `{name}` — {calls} выз., ср. {total / calls * 1000:.0f} мс"
+        for name, (calls, total) in sorted(profile.responses.items(), key=lambda item: -item[1][1])[:8]
+    ) or "—"
+    hot = "\n".join(
+        f"{DECORATIONS['bullet']} `{name}` — {count * 100 / max(profile.samples, 1):.0f}%"
+        for name, count in profile.hot_frames(5)
+    ) or "—"
+    
+    response = f"""
 {DECORATIONS['header']}
-{EMOJIS['alert']} **ОБНАРУЖЕНЫ ЗАПРЕЩЁННЫЕ СИМВОЛЫ** {EMOJIS['alert']}
+{EMOJIS['chart']} **ПРОФИЛЬ ЗА {profile.duration:.0f} С** {EMOJIS['chart']}
 {DECORATIONS['separator']}
 
-{EMOJIS['guard']} *Нарушитель:* {message.from_user.get_mention()}
-{EMOJIS['cross']} *Действие:* Сообщение удалено
+{EMOJIS['lightning']} *Корутины:*
+{rows(profile.coroutines)}
+
+{EMOJIS['hammer']} *Обработчики:*
+{rows(profile.handlers)}
+
+{EMOJIS['time']} *Время ответа:*
+{responses}
+
+{EMOJIS['fire']} *Горячие функции ({profile.samples} сэмплов):*
+{hot}
 
 {DECORATIONS['footer']}
 """
-        await message.answer(response, parse_mode="Markdown")
-        return
+    await message.reply(response, parse_mode="Markdown")
+    if profile.stacks:
+        await message.reply_document(
+            types.InputFile(io.BytesIO(profile.collapsed().encode()), filename=f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded"),
+            caption=f"{EMOJIS['page']} Стеки для flamegraph.pl / speedscope"
+        )
 
-    # Антикапс
-    if protection_settings["anticaps"] and len(text) > 10:
-        caps_ratio = sum(1 for c in text if c.isupper()) / len(text)
-        if caps_ratio > 0.7:  # Если больше 70% текста в капсе
-            await message.delete()
-            if user_id not in user_data:
-                user_data[user_id] = {"warns": 0}
-            user_data[user_id]["warns"] += 1
-            warns_count = user_data[user_id]["warns"]
-            
-            response = f"""
+# Хранилища состояния для /mem: то, что живёт всё время работы и растёт вместе с чатами
+memory_tracker = MemoryTracker()
+memory_tracker.register('Баны', lambda: punishment_system.punishments['bans'])
+memory_tracker.register('Муты', lambda: punishment_system.punishments['mutes'])
+memory_tracker.register('Варны (история)', lambda: punishment_system.punishments['warns'])
+memory_tracker.register('Окна флуда', lambda: flood_detector.windows)
+memory_tracker.register('Индексы похожих', lambda: snapshot.rule_engine.similarity)
+memory_tracker.register('Индексы медиа', lambda: snapshot.rule_engine.media)
+memory_tracker.register('Известный спам', lambda: known_media.items)
+memory_tracker.register('Хеши картинок', lambda: media_hasher.cache)
+memory_tracker.register('Настройки чатов', lambda: chat_settings.cache)
+memory_tracker.register('Кэш хранилища', lambda: state_store.cache)
+memory_tracker.register('Незаписанное', lambda: state_store.dirty)
+memory_tracker.register('Уведомления', lambda: moderation_buffer.notices)
+memory_tracker.register('Последние сообщения', lambda: message_index.users)
+memory_tracker.register('Удаления в очереди', lambda: moderation_buffer.pending)
+memory_tracker.register('Входы (рейды)', lambda: raid_guard.counter.joins)
+memory_tracker.register('Рейд-режимы', lambda: raid_guard.raids)
+memory_tracker.register('Кулдауны игр', lambda: game_scheduler.last_play)
+memory_tracker.register('Статистика дня', lambda: mod_stats.today)
+memory_tracker.register('Очереди обновлений', lambda: update_executor.queues)
+
+# /mem - размеры хранилищ; /mem start - включить tracemalloc, /mem - снимок и рост с прошлого,
+# /mem stop - выключить (трассировка замедляет выделение памяти, держать постоянно не стоит)
+@dp.message_handler(commands=['mem'])
+async def cmd_mem(message: types.Message):
+    if not await is_admin(message):
+        return await message.reply(f"{EMOJIS['cross']} У вас недостаточно прав")
+    
+    args = message.get_args().strip().lower()
+    if args == 'start':
+        memory_tracker.start()
+        return await message.reply(f"{EMOJIS['check']} Трассировка памяти включена, снимок - /mem")
+    if args == 'stop':
+        memory_tracker.stop()
+        return await message.reply(f"{EMOJIS['check']} Трассировка памяти выключена")
+    
+    containers = "\n".join(
+        f"{DECORATIONS['bullet']} {name}: {items if items is not None else '—'} зап., {format_size(size)}{'+' if truncated else ''}"
+        for name, items, size, truncated in memory_tracker.sizes()
+    )
+    rss = process_rss()
+    response = f"""
 {DECORATIONS['header']}
-{EMOJIS['alert']} **ОБНАРУЖЕН КАПС** {EMOJIS['alert']}
+{EMOJIS['chart']} **ПАМЯТЬ** {EMOJIS['chart']}
 {DECORATIONS['separator']}
 
-{EMOJIS['guard']} *Нарушитель:* {message.from_user.get_mention()}
-{EMOJIS['scroll']} *Наказание:* Варн + удаление сообщения
-{EMOJIS['alert']} *Варнов:* {warns_count}/3
+{EMOJIS['gear']} *Процесс:* {format_size(rss) if rss is not None else '—'}
+
+{EMOJIS['scroll']} *Хранилища:*
+{containers}
+"""
+    if memory_tracker.tracing:
+        top, diff, traced = memory_tracker.snapshot()
+        sites = "\n".join(
+            f"{DECORATIONS['bullet']} `{trace_site(stat)}` — {format_size(stat.size)}, {stat.count} объектов"
+            for stat in top
+        ) or "—"
+        response += f"""
+{EMOJIS['fire']} *Места выделения ({format_size(traced)} отслежено):*
+{sites}
+"""
+        if diff is not None:
+            growth = "\n".join(
+                f"{DECORATIONS['bullet']} `{trace_site(stat)}` — {'+' if stat.size_diff > 0 else ''}{format_size(stat.size_diff)}"
+                for stat in diff
+            ) or "—"
+            response += f"""
+{EMOJIS['lightning']} *Изменения с прошлого снимка:*
+{growth}
+"""
+    else:
+        response += f"\n{EMOJIS['info']} Места выделения: /mem start\n"
+    await message.reply(response + f"\n{DECORATIONS['footer']}", parse_mode="Markdown")
+
+MODSTATS_ACTIONS = {'bans': 'Баны', 'mutes': 'Муты', 'warns': 'Варны', 'deletes': 'Удалено сообщений'}
+
+def top_counts(counts, limit=5):
+    return sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+@dp.message_handler(commands=['modstats'])
+async def cmd_modstats(message: types.Message):
+    if not await is_admin(message):
+        return await message.reply(f"{EMOJIS['cross']} У вас недостаточно прав")
+    
+    # Период в днях: /modstats, /modstats 30, /modstats 30d
+    args = message.get_args().strip().lower().rstrip('dд')
+    try:
+        days = int(args) if args else 7
+    except ValueError:
+        return await message.reply(f"{EMOJIS['info']} Использование: `/modstats [дней]`", parse_mode="Markdown")
+    days = max(1, min(days, 365))
+    
+    stats = await mod_stats.summary(message.chat.id, days)
+    actions = "\n".join(
+        f"{DECORATIONS['bullet']} {title}: {stats['actions'].get(name, 0)}"
+        for name, title in MODSTATS_ACTIONS.items()
+    )
+    reasons = "\n".join(f"{DECORATIONS['bullet']} {reason}: {count}" for reason, count in top_counts(stats['reasons'])) or "—"
+    admins = "\n".join(
+        f"{DECORATIONS['bullet']} {stats['names'].get(admin, admin)}: {count}"
+        for admin, count in top_counts(stats['admins'])
+    ) or "—"
+    removed = ", ".join(f"{MODSTATS_ACTIONS.get(name, name)}: {count}" for name, count in stats['removed'].items()) or "—"
+    expired = ", ".join(f"{MODSTATS_ACTIONS.get(name, name)}: {count}" for name, count in stats['expired'].items()) or "—"
+    
+    response = f"""
+{DECORATIONS['header']}
+{EMOJIS['chart']} **МОДЕРАЦИЯ ЗА {days} ДН.** {EMOJIS['chart']}
+{DECORATIONS['separator']}
+
+{EMOJIS['hammer']} *Действия:*
+{actions}
+
+{EMOJIS['gear']} *Автоматически:* {stats['auto']}
+{EMOJIS['guard']} *Вручную:* {stats['manual']}
+{EMOJIS['mute']} *Минут мута:* {stats['mute_minutes']} (в среднем {stats['mute_minutes'] / days:.0f} в день)
+
+{EMOJIS['scroll']} *Частые причины:*
+{reasons}
+
+{EMOJIS['crown']} *Активные админы:*
+{admins}
+
+{EMOJIS['unban']} *Снято вручную:* {removed}
+{EMOJIS['time']} *Истекло:* {expired}
 
 {DECORATIONS['footer']}
 """
-            await message.answer(response, parse_mode="Markdown")
+    await message.reply(response, parse_mode="Markdown")
 
-    # Антиспам
-    if protection_settings["antispam"]:
-        if user_id not in spam_data:
-            spam_data[user_id] = {"messages": [], "last_time": current_time.timestamp()}
-            
-        messages = spam_data[user_id]["messages"]
-        messages = [t for t in messages if (current_time - t).total_seconds() < float(config['AntiSpam']['spam_seconds'])]
-        messages.append(current_time)
-        spam_data[user_id]["messages"] = messages
-        
-        if len(messages) > int(config['AntiSpam']['max_messages']):
-            await message.delete()
-            if user_id not in user_data:
-                user_data[user_id] = {"warns": 0}
-            user_data[user_id]["warns"] += 1
-            warns_count = user_data[user_id]["warns"]
-            
-            mute_duration = timedelta(minutes=int(config['AntiSpam']['mute_minutes']))
-            until_date = current_time + mute_duration
+def parse_switch(value):
+    value = value.lower()
+    if value in ('on', 'вкл', '1', 'true', 'да'):
+        return True
+    if value in ('off', 'выкл', '0', 'false', 'нет'):
+        return False
+    raise ValueError(value)
+
+@dp.message_handler(commands=['set'])
+async def cmd_set(message: types.Message):
+    if not await is_admin(message):
+        return await message.reply(f"{EMOJIS['cross']} У вас недостаточно прав")
+    
+    args = message.get_args().split()
+    if len(args) == 2:
+        key, value = args[0].lower(), args[1]
+        try:
+            if key in BOOL_SETTINGS:
+                parsed = parse_switch(value)
+            elif key in NUMBER_SETTINGS:
+                parsed = NUMBER_SETTINGS[key](value)
+                if parsed <= 0:
+                    raise ValueError(value)
+            else:
+                return await message.reply(f"{EMOJIS['cross']} Неизвестная настройка `{key}`", parse_mode="Markdown")
+        except ValueError:
+            return await message.reply(f"{EMOJIS['cross']} Неверное значение для `{key}`", parse_mode="Markdown")
+        await chat_settings.update(message.chat.id, **{key: parsed})
+    elif args:
+        return await message.reply(f"{EMOJIS['info']} Использование: `/set [настройка] [значение]`", parse_mode="Markdown")
+    
+    settings = await check_chat(message)
+    response = f"""
+{DECORATIONS['header']}
+{EMOJIS['gear']} **НАСТРОЙКИ ЧАТА** {EMOJIS['gear']}
+{DECORATIONS['separator']}
+"""
+    for key in BOOL_SETTINGS:
+        state = EMOJIS['check'] if settings.protection[key] else EMOJIS['cross']
+        response += f"\n{state} `{key}`"
+    for key in NUMBER_SETTINGS:
+        response += f"\n{DECORATIONS['bullet']} `{key}` = {getattr(settings.antispam, key)}"
+    
+    response += f"\n\n{DECORATIONS['footer']}"
+    await message.reply(response, parse_mode="Markdown")
+
+# Подключение бота к новым чатам (только владельцы из c.ini)
+@dp.message_handler(commands=['enable', 'disable'])
+async def cmd_enable(message: types.Message):
+    if message.from_user.id not in snapshot.owner_ids:
+        return
+    
+    enabled = message.get_command(pure=True) == 'enable'
+    await chat_settings.update(message.chat.id, enabled=enabled)
+    if enabled:
+        await message.reply(f"{EMOJIS['check']} Модерация в этом чате включена")
+    else:
+        await message.reply(f"{EMOJIS['cross']} Модерация в этом чате выключена")
+
+# Защита от рейдов
+@dp.message_handler(content_types=['new_chat_members'])
+async def handle_new_members(message: types.Message):
+    if not await check_chat(message):
+        return
+    
+    user_ids = [member.id for member in message.new_chat_members if not member.is_bot]
+    if user_ids:
+        await raid_guard.on_join(message.chat.id, user_ids)
+
+# Защита от спама/капса/флуда
+async def apply_verdict(message: types.Message, settings, verdict, verdicts):
+    rule = verdict.rule
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+    mention = message.from_user.get_mention()
+    reason = PUNISHMENTS.get(rule.reason, rule.reason)
+    moderation_buffer.delete(chat_id, message.message_id)
+    
+    reasons = ", ".join(PUNISHMENTS.get(v.rule.reason, v.rule.reason) for v in verdicts)
+    if verdict.detail:
+        reasons += f" ({verdict.detail})"
+    
+    # В статистику идёт одно действие на вердикт - самое строгое; мут записывает add_punishment
+    if verdict.action == 'delete':
+        mod_stats.record_action(chat_id, 'deletes', bot.id, reason=reason)
+        summary = f"{EMOJIS['cross']} *Действие:* Сообщение удалено"
+    else:
+        warns_count = await warn_counter.add(chat_id, user_id)
+        if verdict.action == 'warn':
+            mod_stats.record_action(chat_id, 'warns', bot.id, reason=reason)
+        punishment = "Варн + удаление сообщения"
+        
+        if verdict.action == 'mute':
+            mute_minutes = rule.mute_minutes or settings.antispam.mute_minutes
+            current_time = datetime.now()
+            until_date = current_time + timedelta(minutes=mute_minutes)
             
             await bot.restrict_chat_member(
-                message.chat.id,
+                chat_id,
                 user_id,
                 permissions=types.ChatPermissions(can_send_messages=False),
                 until_date=until_date
             )
             
             punishment_system.add_punishment('mutes', {
+                "chat_id": chat_id,
                 "user_id": user_id,
                 "admin_id": bot.id,
                 "admin_name": "Система антиспам",
-                "reason": "Флуд сообщениями",
+                "reason": reason,
                 "until_date": until_date.timestamp(),
                 "date": current_time.timestamp()
             })
-            
-            response = f"""
+            punishment = f"Варн + Мут {mute_minutes} минут"
+        
+        summary = f"{EMOJIS['scroll']} *Наказание:* {punishment}\n{EMOJIS['alert']} *Варнов:* {warns_count}/3"
+    
+    # Спам из очереди после простоя: наказание применяется, уведомление уже не нужно
+    if is_stale(message, STALE_SECONDS):
+        return
+    
+    # Во время волны спама уведомление одно на нарушителя и обновляется счётчиком
+    def render(count):
+        removed = f"\n{EMOJIS['cross']} *Удалено сообщений:* {count}" if count > 1 else ""
+        return f"""
 {DECORATIONS['header']}
-{EMOJIS['alert']} **ОБНАРУЖЕН СПАМ** {EMOJIS['alert']}
+{EMOJIS['alert']} **{rule.title}** {EMOJIS['alert']}
 {DECORATIONS['separator']}
 
-{EMOJIS['guard']} *Нарушитель:* {message.from_user.get_mention()}
-{EMOJIS['scroll']} *Наказание:* Варн + Мут {config['AntiSpam']['mute_minutes']} минут
-{EMOJIS['alert']} *Варнов:* {warns_count}/3
+{EMOJIS['guard']} *Нарушитель:* {mention}
+{EMOJIS['scroll']} *Причина:* {reasons}
+{summary}{removed}
 
 {DECORATIONS['footer']}
 """
-            await message.answer(response, parse_mode="Markdown")
+    await moderation_buffer.notify(chat_id, user_id, render)
+
+# Текст и подписи к медиа проверяются одинаково; картинки и стикеры - ещё и на повторы
+@dp.message_handler(content_types=['text', 'photo', 'sticker', 'animation', 'video', 'document'])
+async def handle_messages(message: types.Message):
+    settings = await check_chat(message)
+    if not settings:
+        return
+        
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+    text = message.text or message.caption or ""
+    entities = message.entities or message.caption_entities
+    message_index.add(chat_id, user_id, message.message_id)
+    media = await media_hasher.key(message) if message.content_type != 'text' else None
+    
+    # Все правила из c.ini по порядку; применяется самое строгое сработавшее
+    rule_engine = settings.snapshot.rule_engine
+    verdicts = rule_engine.evaluate(chat_id, user_id, text, settings.antispam, entities, settings.protection, media)
+    if verdicts:
+        await apply_verdict(message, settings, rule_engine.strongest(verdicts), verdicts)
 
     # Проверка на накопленные варны
-    if user_id in user_data and user_data[user_id]["warns"] >= 3:
+    if await warn_counter.get(chat_id, user_id) >= 3:
+        current_time = datetime.now()
         mute_duration = timedelta(hours=3)
         until_date = current_time + mute_duration
         
@@ -910,6 +2174,7 @@ async def handle_messages(message: types.Message):
         )
         
         punishment_system.add_punishment('mutes', {
+            "chat_id": message.chat.id,
             "user_id": user_id,
             "admin_id": bot.id,
             "admin_name": "Система варнов",
@@ -929,13 +2194,87 @@ async def handle_messages(message: types.Message):
 
 {DECORATIONS['footer']}
 """
-        await message.answer(response, parse_mode="Markdown")
-        user_data[user_id]["warns"] = 0
+        if not is_stale(message, STALE_SECONDS):
+            await message.answer(response, parse_mode="Markdown")
+        warn_counter.reset(chat_id, user_id)
+
+# Перезагрузка c.ini на лету: новый снимок применяется, только если он целиком корректен
+async def reload_config():
+    global snapshot
+    try:
+        new_config = read_config('c.ini')
+        changed = changed_sections(snapshot.config, new_config)
+        if not changed:
+            return
+        new_snapshot = ConfigSnapshot(new_config, snapshot)
+    except (OSError, configparser.Error, ValueError) as e:
+        logging.error(f"Config reload failed: {e}")
+        await report_reload(f"""
+{DECORATIONS['header']}
+{EMOJIS['cross']} **ОШИБКА В C.INI** {EMOJIS['cross']}
+{DECORATIONS['separator']}
+
+{EMOJIS['info']} `{e}`
+{EMOJIS['shield']} Действуют прежние настройки
+
+{DECORATIONS['footer']}
+""")
+        return
+    
+    snapshot = new_snapshot
+    flood_detector.settings = snapshot.antispam
+    chat_settings.invalidate()
+    restart = snapshot.restart_sections(changed)
+    applied = [name for name in changed if name not in restart]
+    logging.info(f"Config reloaded: applied {applied}, restart required for {restart}")
+    
+    response = f"""
+{DECORATIONS['header']}
+{EMOJIS['gear']} **C.INI ПЕРЕЗАГРУЖЕН** {EMOJIS['gear']}
+{DECORATIONS['separator']}
+"""
+    if applied:
+        response += f"\n{EMOJIS['check']} *Применено:* " + ", ".join(f"`{name}`" for name in applied)
+    if restart:
+        response += f"\n{EMOJIS['warn']} *Нужен перезапуск:* " + ", ".join(f"`{name}`" for name in restart)
+    response += f"\n\n{DECORATIONS['footer']}"
+    await report_reload(response)
+
+async def report_reload(text):
+    # В режиме нескольких процессов перезагружается каждый воркер, сообщает только первый
+    if not is_main_shard():
+        return
+    await send_alert(text)
 
 # Запуск бота
 async def on_startup(dp):
-    await punishment_system.check_expired_punishments(bot)
+    # В режиме воркеров разовые задачи (перенос счётчиков, снятие истёкших наказаний) - только
+    # в первом; словарь, известный спам и c.ini у каждого процесса свои, их грузит и следит каждый
+    if is_main_shard():
+        await warn_counter.migrate()
+        await punishment_system.check_expired_punishments(bot)
+    await known_media.load()
+    await mod_stats.load()
+    asyncio.create_task(word_filter.watch())
+    asyncio.create_task(loop_monitor.run())
+    if config.getboolean('Reload', 'watch', fallback=True):
+        watcher = ConfigWatcher(['c.ini'], reload_config, config.getfloat('Reload', 'interval', fallback=2.0))
+        asyncio.create_task(watcher.watch())
     logging.info("Bot started and punishments checked")
 
+async def on_shutdown(dp):
+    media_hasher.close()
+    await state_store.close()
+
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+    workers = config.getint('Workers', 'count', fallback=1)
+    offsets = OffsetFile(config.get('Updates', 'offset_file', fallback='update_offset'))
+    if workers > 1 and fcntl is None:
+        logging.warning("Multi-process mode needs fork and fcntl, running a single process")
+        workers = 1
+    if workers > 1:
+        # Обновления раздаются процессам по chat_id: порядок внутри чата сохраняется
+        punishment_system.shared = True
+        run_sharded(dp, workers, on_startup=on_startup, on_shutdown=on_shutdown, offsets=offsets, executor=update_executor)
+    else:
+        run_polling(dp, offsets, on_startup=on_startup, on_shutdown=on_shutdown, executor=update_executor)
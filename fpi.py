@@ -7,8 +7,18 @@ from aiogram import Bot, Dispatcher, types
 from aiogram.dispatcher.handler import CancelHandler
 from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ChatPermissions
+from aiogram.utils.exceptions import RetryAfter, Unauthorized, ChatNotFound, TelegramAPIError
 import time
+import random
+import json
 import logging
+from array import array
+from collections import OrderedDict
+from antispam import JoinRateCounter
+from configwatch import ConfigWatcher, read_config, changed_sections
+from updates import run_polling, OffsetFile, StaleUpdateMiddleware, UpdateExecutor
+from monitoring import LoopProfiler, ProfilerMiddleware, LoopMonitor, MemoryTracker, format_size, process_rss, trace_site
+import io
 
 # Настройка логирования
 logging.basicConfig(
@@ -23,25 +33,40 @@ logger = logging.getLogger(__name__)
 
 START_TIME = datetime.now()
 
+# Флуд-контроль команд: времена последних команд пользователя в array('d'),
+# пользователи без команд дольше timeout вытесняются (раньше словарь только рос)
 class ThrottlingMiddleware(BaseMiddleware):
     def __init__(self, limit=3, timeout=3):
         self.limit = limit
         self.timeout = timeout
-        self.user_timeouts = {}
+        self.user_timeouts = OrderedDict()  # user_id -> array('d'), порядок = последняя активность
         super(ThrottlingMiddleware, self).__init__()
 
+    def evict(self, current_time):
+        while self.user_timeouts:
+            _, times = next(iter(self.user_timeouts.items()))
+            if times and current_time - times[-1] < self.timeout:
+                break
+            self.user_timeouts.popitem(last=False)
+
     async def on_process_message(self, message: types.Message, _):
         user_id = message.from_user.id
         current_time = time.time()
+        self.evict(current_time)
         
-        if user_id not in self.user_timeouts:
-            self.user_timeouts[user_id] = []
+        times = self.user_timeouts.get(user_id)
+        if times is None:
+            times = self.user_timeouts[user_id] = array('d')
+        else:
+            self.user_timeouts.move_to_end(user_id)
         
-        self.user_timeouts[user_id] = [t for t in self.user_timeouts[user_id] 
-                                     if current_time - t < self.timeout]
+        stale = 0
+        while stale < len(times) and current_time - times[stale] >= self.timeout:
+            stale += 1
+        del times[:stale]
         
-        if len(self.user_timeouts[user_id]) >= self.limit:
-            remaining_time = round(self.timeout - (current_time - self.user_timeouts[user_id][0]))
+        if len(times) >= self.limit:
+            remaining_time = round(self.timeout - (current_time - times[0]))
             await message.answer(
                 f"⚠️ *Флуд-контроль активирован!*\n"
                 f"Подождите {remaining_time} секунд перед следующей командой.",
@@ -49,18 +74,223 @@ class ThrottlingMiddleware(BaseMiddleware):
             )
             raise CancelHandler()
         
-        self.user_timeouts[user_id].append(current_time)
+        times.append(current_time)
+
+# Активность по командам. Учёт ограничен списком ActivityHistory.COMMANDS: остальное, что
+# начинается с "/", идёт в один ключ "other" и не заводит новых колец
+class ActivityMiddleware(BaseMiddleware):
+    def __init__(self, config):
+        self.config = config
+        super(ActivityMiddleware, self).__init__()
+
+    async def on_process_message(self, message: types.Message, _):
+        if message.is_command():
+            self.config.record_command('/' + message.get_command(pure=True).lower())
+
+# История активности: почасовые корзины за неделю в кольце на массивах, вытесняемый час
+# добавляется в дневную корзину (кольцо на год). При смене суток ничего не обнуляется.
+# Кольца есть только у команд бота (COMMANDS), всё прочее считается в "other".
+class ActivityHistory:
+    HOURS = 24 * 7
+    DAYS = 366
+    COMMANDS = ('/start', '/about', '/stat', '/coin', '/profile', '/mem', '/all', '/mod',
+                '/setwelcome', '/broadcast', 'other')
+
+    def __init__(self, path='activity_history.json'):
+        self.path = path
+        self.hour_stamps = array('l', [-1]) * self.HOURS  # номер часа, лежащего в ячейке
+        self.day_stamps = array('l', [-1]) * self.DAYS
+        self.hourly = {command: array('L', [0]) * self.HOURS for command in self.COMMANDS}
+        self.daily = {command: array('L', [0]) * self.DAYS for command in self.COMMANDS}
+        self.load()
+        # Команды за сегодня считаются на ходу, чтобы /stat не обходил все ячейки
+        self.today = self.current_hour() // 24
+        self.today_count = sum(next(iter(self.days(1).values())).values())
+
+    # Номер часа с начала эпохи по местному времени (сутки = час // 24)
+    @staticmethod
+    def current_hour():
+        now = datetime.now()
+        return int((now.timestamp() + now.astimezone().utcoffset().total_seconds()) // 3600)
+
+    def day_slot(self, day):
+        slot = day % self.DAYS
+        if self.day_stamps[slot] > day:
+            return None  # день старше года: ячейку уже занял более новый
+        if self.day_stamps[slot] != day:
+            for counts in self.daily.values():
+                counts[slot] = 0
+            self.day_stamps[slot] = day
+        return slot
+
+    def hour_slot(self, hour):
+        slot = hour % self.HOURS
+        old = self.hour_stamps[slot]
+        if old != hour:
+            day_slot = self.day_slot(old // 24) if old >= 0 else None
+            if day_slot is not None:
+                for command, counts in self.hourly.items():
+                    self.daily[command][day_slot] += counts[slot]
+            for counts in self.hourly.values():
+                counts[slot] = 0
+            self.hour_stamps[slot] = hour
+        return slot
+
+    def add(self, command='other'):
+        hour = self.current_hour()
+        counts = self.hourly.get(command) or self.hourly['other']
+        counts[self.hour_slot(hour)] += 1
+        if hour // 24 != self.today:
+            self.today, self.today_count = hour // 24, 0
+        self.today_count += 1
+
+    # Суммы по дням за последние days суток: {день: {команда: count}}
+    def days(self, days):
+        today = self.current_hour() // 24
+        first = today - days + 1
+        totals = {day: dict.fromkeys(self.hourly, 0) for day in range(first, today + 1)}
+        for slot, day in enumerate(self.day_stamps):
+            if day in totals:
+                for command, counts in self.daily.items():
+                    totals[day][command] += counts[slot]
+        for slot, hour in enumerate(self.hour_stamps):
+            if hour >= 0 and hour // 24 in totals:
+                for command, counts in self.hourly.items():
+                    totals[hour // 24][command] += counts[slot]
+        return totals
+
+    def today_total(self):
+        return self.today_count if self.current_hour() // 24 == self.today else 0
+
+    # Самый активный час суток по почасовым корзинам (за неделю)
+    def peak_hour(self):
+        by_hour = [0] * 24
+        for slot, hour in enumerate(self.hour_stamps):
+            if hour >= 0:
+                by_hour[hour % 24] += sum(counts[slot] for counts in self.hourly.values())
+        peak = max(range(24), key=by_hour.__getitem__)
+        return peak, by_hour[peak]
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if len(data['hour_stamps']) != self.HOURS or len(data['day_stamps']) != self.DAYS:
+                raise ValueError("bucket sizes changed")
+            self.hour_stamps = array('l', data['hour_stamps'])
+            self.day_stamps = array('l', data['day_stamps'])
+            # Команды не из списка (записанные прежними версиями) складываются в "other"
+            for command in data['hourly']:
+                if command in self.hourly:
+                    self.hourly[command] = array('L', data['hourly'][command])
+                    self.daily[command] = array('L', data['daily'][command])
+            for command in data['hourly']:
+                if command not in self.hourly:
+                    for name, counts in (('hourly', self.hourly), ('daily', self.daily)):
+                        other = counts['other']
+                        for slot, count in enumerate(data[name][command]):
+                            other[slot] += count
+        except FileNotFoundError:
+            pass
+        except (KeyError, ValueError, TypeError) as e:
+            logger.error(f"Activity history not loaded: {e}")
+
+    def save(self):
+        data = {
+            'hour_stamps': self.hour_stamps.tolist(),
+            'day_stamps': self.day_stamps.tolist(),
+            'hourly': {command: counts.tolist() for command, counts in self.hourly.items()},
+            'daily': {command: counts.tolist() for command, counts in self.daily.items()}
+        }
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
 
 class Config:
     def __init__(self, filename='config.ini'):
         self.filename = filename
         self.config = configparser.ConfigParser()
+        self.mtime = None
+        self.broken = False
+        self.reports = []
+        self.save_handle = None
         self.load_config()
+        self.history = ActivityHistory(self.config.get('Stats', 'history_file', fallback='activity_history.json'))
+        self.save_delay = self.config.getfloat('Stats', 'save_delay', fallback=30)
 
     def load_config(self):
         if os.path.exists(self.filename):
             self.config.read(self.filename)
         self.init_default_config()
+        self.chat_ids, self.admin_ids, self.welcome_texts = self.compile(self.config)
+        self.load_users()
+        self.save_config()
+
+    # Пользователи разбираются из config.ini один раз, дальше - список и множество в памяти;
+    # в файл список пишется только при сохранении
+    def load_users(self):
+        self.users = eval(self.config['Stats'].get('unique_users', '[]'))
+        self.user_set = set(self.users)
+
+    # Чаты, админы и приветствия разбираются один раз, а не на каждое сообщение
+    @staticmethod
+    def compile(config):
+        chat_ids = {int(chat_id) for chat_id in config['Chat']['main_chat_id'].split(',') if chat_id.strip()}
+        admin_ids = {int(user_id) for user_id in config['Admin']['admin_ids'].split(',') if user_id.strip()}
+        welcome_texts = {
+            int(section.split(':', 1)[1]): config[section]['text'].replace('\\n', '\n')
+            for section in config.sections()
+            if section.startswith('Welcome:') and 'text' in config[section]
+        }
+        return chat_ids, admin_ids, welcome_texts
+
+    def current_mtime(self):
+        try:
+            return os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    # Файл изменён не ботом: новые настройки подменяются целиком и только если они корректны.
+    # Статистику бот ведёт сам, её значения из файла не берутся.
+    def reload(self):
+        mtime = self.current_mtime()
+        if mtime is None or mtime == self.mtime:
+            return
+        self.mtime = mtime
+        try:
+            new_config = read_config(self.filename)
+            compiled = self.compile(new_config)
+        except (OSError, configparser.Error, KeyError, ValueError) as e:
+            # Пока файл с ошибкой, не перезаписываем его - статистика копится в памяти
+            self.broken = True
+            logger.error(f"Config reload failed: {e}")
+            self.reports.append(f"❌ *Ошибка в config.ini:* `{e}`\nДействуют прежние настройки")
+            return
+        new_config['Stats'] = dict(self.config['Stats'])
+        changed = [name for name in changed_sections(self.config, new_config) if name != 'Stats']
+        self.config = new_config
+        self.chat_ids, self.admin_ids, self.welcome_texts = compiled
+        self.broken = False
+        if changed:
+            logger.info(f"Config reloaded: {changed}")
+            applied = [name for name in changed if name != 'Bot']
+            report = "♻️ *config.ini перезагружен*"
+            if applied:
+                report += "\nПрименено: " + ", ".join(f"`{name}`" for name in applied)
+            if 'Bot' in changed:
+                report += "\n⚠️ Изменения `[Bot]` применятся после перезапуска"
+            self.reports.append(report)
+
+    def get_welcome_text(self, chat_id):
+        return self.welcome_texts.get(chat_id, WELCOME_TEXT)
+
+    def set_welcome_text(self, chat_id, text):
+        # Переводы строк храним как \n: configparser теряет пустые строки в значениях,
+        # % удваиваем: иначе это синтаксис подстановки configparser
+        self.config[f'Welcome:{chat_id}'] = {'text': text.replace('\n', '\\n').replace('%', '%%')}
+        self.welcome_texts[chat_id] = text
+        self.save_config()
 
     def init_default_config(self):
         if 'Bot' not in self.config:
@@ -76,35 +306,66 @@ class Config:
                 'daily_activity': '0',
                 'unique_users': '[]'
             }
-        self.save_config()
 
     def save_config(self):
+        if self.save_handle is not None:
+            self.save_handle.cancel()
+            self.save_handle = None
+        self.config['Stats']['unique_users'] = str(self.users)
+        # Правки, сделанные в файле вручную, подхватываем до записи, иначе они затрутся
+        self.reload()
+        if self.broken:
+            return
         with open(self.filename, 'w') as configfile:
             self.config.write(configfile)
+        self.mtime = self.current_mtime()
+
+    # Статистика пишется в config.ini не чаще раза в save_delay секунд; без цикла событий - сразу
+    def schedule_save(self):
+        if self.save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save_config()
+            return
+        self.save_handle = loop.call_later(self.save_delay, self.save_stats)
+
+    def save_stats(self):
+        try:
+            self.save_config()
+        except OSError as e:
+            logger.error(f"Error saving stats: {e}")
 
     def update_stats(self, user_id, command=None):
-        if 'Stats' not in self.config:
-            self.config['Stats'] = {}
-        
-        users = eval(self.config['Stats'].get('unique_users', '[]'))
-        if user_id not in users:
-            users.append(user_id)
-            self.config['Stats']['unique_users'] = str(users)
-            self.config['Stats']['total_users'] = str(len(users))
+        if user_id not in self.user_set:
+            self.user_set.add(user_id)
+            self.users.append(user_id)
+            self.config['Stats']['total_users'] = str(len(self.users))
 
         if command == '/coin':
             coin_requests = int(self.config['Stats'].get('coin_requests', 0))
             self.config['Stats']['coin_requests'] = str(coin_requests + 1)
 
-        daily_activity = int(self.config['Stats'].get('daily_activity', 0))
-        self.config['Stats']['daily_activity'] = str(daily_activity + 1)
-        
-        self.save_config()
+        self.schedule_save()
+
+    # Каждая обработанная команда бота; daily_activity - отражение истории за сегодня
+    def record_command(self, command):
+        self.history.add(command)
+        self.config['Stats']['daily_activity'] = str(self.history.today_total())
+        self.schedule_save()
 
-    def reset_daily_stats(self):
-        self.config['Stats']['daily_activity'] = '0'
+    # Пользователи, заблокировавшие бота, больше не считаются и не получают рассылку
+    def remove_users(self, user_ids):
+        drop = set(user_ids)
+        self.users = [user_id for user_id in self.users if user_id not in drop]
+        self.user_set -= drop
+        self.config['Stats']['total_users'] = str(len(self.users))
         self.save_config()
 
+    def get_users(self):
+        return list(self.users)
+
     def get_system_stats(self):
         try:
             # CPU
@@ -131,10 +392,51 @@ class Config:
         except:
             return 0, 0
 
+WELCOME_TEXT = (
+    "🌟 Добро пожаловать в чат FPI-Клан!\n\n"
+    "🤖 У нас есть собственный бот: @Fpiclan_bot\n\n"
+    "👥 Нам требуются:\n"
+    "• 📣 Рекламщики\n"
+    "• 💡 Идеи для сайта\n"
+    "• 🎨 Дизайнеры для картинок сайта"
+)
+
 config = Config()
 bot = Bot(token=config.config['Bot']['token'])
 dp = Dispatcher(bot)
-dp.middleware.setup(ThrottlingMiddleware())
+# Очередь после перезапуска: на старые команды и вступления не отвечаем (и не троттлим их)
+dp.middleware.setup(StaleUpdateMiddleware(
+    config.config.getfloat('Updates', 'stale_seconds', fallback=60),
+    commands=('start', 'about', 'stat', 'coin', 'all', 'mod'),
+    content_types=('new_chat_members',)
+))
+throttling = ThrottlingMiddleware()
+dp.middleware.setup(throttling)
+dp.middleware.setup(ActivityMiddleware(config))
+
+# Профилировщик цикла событий для /profile
+loop_profiler = LoopProfiler()
+dp.middleware.setup(ProfilerMiddleware(loop_profiler))
+
+# Задержка цикла событий и медленные шаги (например, запись config.ini)
+async def alert_loop_lag(monitor):
+    stats = monitor.stats()
+    text = (
+        "🚨 *Бот тормозит*\n\n"
+        f"⏱ Задержка цикла: {stats['current'] * 1000:.0f} мс (порог {monitor.threshold * 1000:.0f} мс)\n"
+        + "".join(f"• `{name}` — {count}\n" for name, count in stats['top'])
+    )
+    for admin_id in config.admin_ids:
+        try:
+            await bot.send_message(admin_id, text, parse_mode="Markdown")
+        except Exception as e:
+            logger.error(f"Error sending lag alert to {admin_id}: {e}")
+
+loop_monitor = LoopMonitor.from_config(config.config, on_alert=alert_loop_lag)
+
+# Очереди обновлений по чатам; при перегрузке отбрасываются /about и /start,
+# /profile идёт мимо очереди чата
+update_executor = UpdateExecutor.from_config(dp, config.config, low_priority=('about', 'start'), detached=('profile',))
 
 timeframes_kb = InlineKeyboardMarkup(row_width=3)
 timeframes_kb.add(
@@ -148,7 +450,7 @@ timeframes_kb.add(
 @dp.message_handler(commands=['start'])
 async def send_welcome(message: types.Message):
     try:
-        config.update_stats(message.from_user.id)
+        config.update_stats(message.from_user.id, '/start')
         welcome_text = (
             "👋 *Добро пожаловать в FPIBANK!*\n\n"
             "🤖 Я ваш персональный помощник.\n"
@@ -176,10 +478,12 @@ async def show_about(message: types.Message):
 @dp.message_handler(commands=['stat'])
 async def show_stats(message: types.Message):
     try:
-        if str(message.from_user.id) not in config.config['Admin']['admin_ids'].split(','):
+        if message.from_user.id not in config.admin_ids:
             return
         
         cpu_usage, ram_usage = config.get_system_stats()
+        queue = update_executor.stats()
+        lag = loop_monitor.stats()
         uptime = datetime.now() - START_TIME
         hours = uptime.total_seconds() // 3600
         minutes = (uptime.total_seconds() % 3600) // 60
@@ -193,52 +497,308 @@ async def show_stats(message: types.Message):
             "*👥 Пользователи:*\n"
             f"📈 Всего пользователей: {config.config['Stats']['total_users']}\n"
             f"🔄 Использований /coin: {config.config['Stats']['coin_requests']}\n"
-            f"📊 Активность сегодня: {config.config['Stats']['daily_activity']} команд\n"
+            f"📊 Активность сегодня: {config.history.today_total()} команд\n\n"
+            "*📅 Активность за неделю:*\n"
+            f"{activity_trend()}\n\n"
+            "*📥 Очередь обновлений:*\n"
+            f"⏳ В очереди: {queue['pending']} (пик: {queue['peak']}), чатов: {queue['chats']}\n"
+            f"✅ Обработано: {queue['processed']}, отброшено: {queue['shed']}\n\n"
+            "*⏱ Цикл событий:*\n"
+            f"🐢 Задержка: сейчас {lag['current'] * 1000:.0f} мс, p99 {lag['p99'] * 1000:.0f} мс, макс. {lag['max'] * 1000:.0f} мс\n"
+            f"🔥 Медленных шагов: {lag['slow']}"
+            + "".join(f"\n• `{name}` — {count}" for name, count in lag['top'])
         )
         
         await message.answer(stats_message, parse_mode="Markdown")
     except Exception as e:
         logger.error(f"Error in stat command: {e}")
 
+# Предохранитель: после failures ошибок подряд источник не дёргаем reset_seconds,
+# затем пропускаем один пробный запрос (half-open)
+class CircuitBreaker:
+    def __init__(self, failures=3, reset_seconds=30):
+        self.max_failures = failures
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_seconds
+
+    def allow(self):
+        return not self.is_open
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            if self.opened_at is None:
+                logger.warning(f"DexScreener circuit opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+# Данные пары с DexScreener: последний удачный снимок отдаётся сразу, обновление идёт в фоне
+# (stale-while-revalidate). Пользователь ждёт не дольше wait_seconds, что бы ни делал источник,
+# а пока снимка нет - не дольше first_wait_seconds.
+class PairDataCache:
+    URL = 'https://api.dexscreener.com/latest/dex/pairs/ton/eqayrrajgsuyhrggo1himnbgv9tvlndz3uoclaoytw_fgegd'
+
+    def __init__(self, timeout=3.0, retries=2, fresh_seconds=15.0, wait_seconds=1.5, breaker=None,
+                 first_wait_seconds=4.0):
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.fresh_seconds = fresh_seconds
+        self.wait_seconds = wait_seconds
+        self.first_wait_seconds = first_wait_seconds
+        self.breaker = breaker or CircuitBreaker()
+        self.session = None
+        self.data = None
+        self.fetched_at = None  # datetime последнего удачного ответа
+        self.failed = False  # последнее обновление закончилось ошибкой
+        self.refresh_task = None
+
+    @classmethod
+    def from_config(cls, config, section='DexScreener'):
+        return cls(
+            config.getfloat(section, 'timeout', fallback=3.0),
+            config.getint(section, 'retries', fallback=2),
+            config.getfloat(section, 'fresh_seconds', fallback=15.0),
+            config.getfloat(section, 'wait_seconds', fallback=1.5),
+            CircuitBreaker(
+                config.getint(section, 'failures', fallback=3),
+                config.getfloat(section, 'reset_seconds', fallback=30)
+            ),
+            config.getfloat(section, 'first_wait_seconds', fallback=4.0)
+        )
+
+    def is_fresh(self):
+        return self.fetched_at is not None and (datetime.now() - self.fetched_at).total_seconds() < self.fresh_seconds
+
+    # Сколько секунд снимок ещё свежий (0 - устарел или его нет)
+    def fresh_for(self):
+        if self.fetched_at is None:
+            return 0
+        return max(0.0, self.fresh_seconds - (datetime.now() - self.fetched_at).total_seconds())
+
+    # Источник недоступен: предохранитель разомкнут или последний запрос не удался.
+    # Просто долгий ответ недоступностью не считается
+    def is_unavailable(self):
+        return self.breaker.is_open or self.failed
+
+    async def fetch(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=self.timeout)
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.session.get(self.URL) as response:
+                    response.raise_for_status()
+                    data = await response.json()
+                if not data.get('pairs'):
+                    raise ValueError("no pairs in response")
+                return data
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                if attempt == self.retries:
+                    raise
+                # Экспоненциальная пауза со случайным разбросом, чтобы не бить в источник залпом
+                delay = 0.3 * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.warning(f"DexScreener request failed ({e}), retry in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    async def refresh(self):
+        try:
+            data = await self.fetch()
+        except Exception as e:
+            self.failed = True
+            self.breaker.failure()
+            logger.error(f"DexScreener refresh failed: {e}")
+            raise
+        self.failed = False
+        self.breaker.success()
+        self.data = data
+        self.fetched_at = datetime.now()
+        return data
+
+    # Текущее обновление; новое не запускается, пока предохранитель разомкнут
+    def start_refresh(self):
+        if self.refresh_task is not None and not self.refresh_task.done():
+            return self.refresh_task
+        if not self.breaker.allow():
+            return None
+        self.refresh_task = asyncio.create_task(self.refresh())
+        # Ошибку фоновой задачи уже записали в лог
+        self.refresh_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return self.refresh_task
+
+    # (данные, время снимка, недоступен ли источник); исключение - только если снимка ещё нет
+    async def get(self):
+        if self.is_fresh():
+            return self.data, self.fetched_at, False
+        task = self.start_refresh()
+        if task is None:
+            if self.data is None:
+                raise RuntimeError("DexScreener unavailable (circuit open)")
+        else:
+            try:
+                # Без снимка ждём дольше, но тоже ограниченно: запрос с повторами может идти десятки секунд
+                wait = self.first_wait_seconds if self.data is None else self.wait_seconds
+                await asyncio.wait_for(asyncio.shield(task), wait)
+            except Exception:
+                if self.data is None:
+                    raise
+        return self.data, self.fetched_at, self.is_unavailable()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+pair_data_cache = PairDataCache.from_config(config.config)
+
+def data_time_line(fetched_at, unavailable):
+    line = f"🕒 {fetched_at.strftime('%d.%m.%Y %H:%M:%S')}"
+    if unavailable:
+        line += "\n⚠️ _Данные на это время: источник сейчас недоступен_"
+    return line
+
+@dp.message_handler(commands=['profile'])
+async def profile_bot(message: types.Message):
+    try:
+        if message.from_user.id not in config.admin_ids:
+            return
+        if loop_profiler.active:
+            await message.reply("⏳ Профилирование уже идёт")
+            return
+        
+        args = message.get_args().strip()
+        seconds = min(max(int(args), 1), 120) if args.isdigit() else 10
+        await message.reply(f"⏱ Профилирование {seconds} с...")
+        profile = await loop_profiler.run(seconds)
+        
+        lines = [f"🔬 *Профиль за {profile.duration:.0f} с* ({profile.samples} сэмплов)\n", "*⚡️ Корутины:*"]
+        for name, (steps, cpu, wall) in profile.top(profile.coroutines, 8):
+            lines.append(f"• `{name}` — CPU {cpu * 1000:.0f} мс, на цикле {wall * 1000:.0f} мс")
+        lines.append("\n*🛠 Обработчики:*")
+        for name, (steps, cpu, wall) in profile.top(profile.handlers, 8):
+            lines.append(f"• `{name}` — CPU {cpu * 1000:.0f} мс, на цикле {wall * 1000:.0f} мс")
+        for name, (calls, total) in sorted(profile.responses.items(), key=lambda item: -item[1][1])[:8]:
+            lines.append(f"• `{name}` — {calls} выз., ответ ср. {total / calls * 1000:.0f} мс")
+        lines.append("\n*🔥 Горячие функции:*")
+        for name, count in profile.hot_frames(5):
+            lines.append(f"• `{name}` — {count * 100 / max(profile.samples, 1):.0f}%")
+        
+        await message.answer("\n".join(lines), parse_mode="Markdown")
+        if profile.stacks:
+            await message.answer_document(
+                types.InputFile(io.BytesIO(profile.collapsed().encode()), filename=f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded"),
+                caption="📄 Стеки для flamegraph.pl / speedscope"
+            )
+    except Exception as e:
+        logger.error(f"Error in profile command: {e}")
+
+# Хранилища состояния для /mem
+memory_tracker = MemoryTracker()
+memory_tracker.register('Флуд-контроль', lambda: throttling.user_timeouts)
+memory_tracker.register('Ожидают приветствия', lambda: pending_welcomes)
+memory_tracker.register('Входы', lambda: welcome_counter.joins)
+memory_tracker.register('Конфиг и статистика', lambda: config.config)
+memory_tracker.register('История активности', lambda: config.history)
+memory_tracker.register('Данные DexScreener', lambda: pair_data_cache.data)
+memory_tracker.register('Очереди обновлений', lambda: update_executor.queues)
+
+# /mem [start|stop]: размеры хранилищ, а при включённом tracemalloc - места выделения и рост
+@dp.message_handler(commands=['mem'])
+async def memory_report(message: types.Message):
+    try:
+        if message.from_user.id not in config.admin_ids:
+            return
+        
+        args = message.get_args().strip().lower()
+        if args == 'start':
+            memory_tracker.start()
+            await message.reply("✅ Трассировка памяти включена, снимок - /mem")
+            return
+        if args == 'stop':
+            memory_tracker.stop()
+            await message.reply("✅ Трассировка памяти выключена")
+            return
+        
+        rss = process_rss()
+        lines = [f"🧠 *Память:* {format_size(rss) if rss is not None else '—'}\n", "*📦 Хранилища:*"]
+        for name, items, size, truncated in memory_tracker.sizes():
+            lines.append(f"• {name}: {items if items is not None else '—'} зап., {format_size(size)}{'+' if truncated else ''}")
+        if memory_tracker.tracing:
+            top, diff, traced = memory_tracker.snapshot()
+            lines.append(f"\n*🔥 Места выделения ({format_size(traced)}):*")
+            for stat in top:
+                lines.append(f"• `{trace_site(stat)}` — {format_size(stat.size)}, {stat.count} объектов")
+            if diff is not None:
+                lines.append("\n*📈 С прошлого снимка:*")
+                for stat in diff:
+                    lines.append(f"• `{trace_site(stat)}` — {'+' if stat.size_diff > 0 else ''}{format_size(stat.size_diff)}")
+        else:
+            lines.append("\nℹ️ Места выделения: /mem start")
+        
+        await message.answer("\n".join(lines), parse_mode="Markdown")
+    except Exception as e:
+        logger.error(f"Error in mem command: {e}")
+
+SPARKS = "▁▂▃▄▅▆▇█"
+
+def activity_trend():
+    history = config.history
+    days = history.days(14)
+    totals = [sum(counts.values()) for counts in days.values()]
+    week, previous = sum(totals[7:]), sum(totals[:7])
+    peak = max(totals[7:]) or 1
+    spark = "".join(SPARKS[min(7, total * 8 // (peak + 1))] for total in totals[7:])
+    change = f" ({(week - previous) / previous * 100:+.0f}% к прошлой)" if previous else ""
+    commands = {command: sum(day[command] for day in list(days.values())[7:]) for command in history.hourly}
+    top = ", ".join(f"{command} {count}" for command, count in sorted(commands.items(), key=lambda item: -item[1]) if count)
+    peak_hour, peak_count = history.peak_hour()
+    return (
+        f"📈 7 дней: {week} команд{change}\n"
+        f"`{spark}`\n"
+        f"⏰ Пиковый час: {peak_hour:02d}:00 ({peak_count})\n"
+        f"🔝 Команды: {top or 'нет данных'}"
+    )
+
 async def get_pair_data():
-    pair_address = 'eqayrrajgsuyhrggo1himnbgv9tvlndz3uoclaoytw_fgegd'
-    url = f'https://api.dexscreener.com/latest/dex/pairs/ton/{pair_address}'
+    return await pair_data_cache.get()
+
+def coin_card(data, fetched_at, unavailable):
+    pair_data = data['pairs'][0]
     
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            return await response.json()
+    price = float(pair_data['priceUsd'])
+    price_change_24h = float(pair_data['priceChange']['h24'])
+    market_cap = float(pair_data.get('fdv', 0))
+    liquidity = float(pair_data.get('liquidity', {}).get('usd', 0))
+    volume_24h = float(pair_data.get('volume', {}).get('h24', 0))
+    
+    trend = "📈 Растёт" if price_change_24h > 0 else "📉 Падает"
+    
+    return (
+        "🏦 *FPIBANK Price Analysis*\n\n"
+        f"💰 Цена: ${price:.6f}\n"
+        f"📊 24h: {price_change_24h:+.2f}%\n"
+        f"📈 Тренд: {trend}\n\n"
+        f"📊 *Рыночные данные:*\n"
+        f"💎 Market Cap: ${market_cap:,.2f}\n"
+        f"💧 Ликвидность: ${liquidity:,.2f}\n"
+        f"📈 Объём (24h): ${volume_24h:,.2f}\n\n"
+        + data_time_line(fetched_at, unavailable)
+    )
 
 @dp.message_handler(commands=['coin'])
 async def show_coin_info(message: types.Message):
     try:
         config.update_stats(message.from_user.id, '/coin')
         
-        data = await get_pair_data()
-        pair_data = data['pairs'][0]
+        data, fetched_at, unavailable = await get_pair_data()
         
-        price = float(pair_data['priceUsd'])
-        price_change_24h = float(pair_data['priceChange']['h24'])
-        market_cap = float(pair_data.get('fdv', 0))
-        liquidity = float(pair_data.get('liquidity', {}).get('usd', 0))
-        volume_24h = float(pair_data.get('volume', {}).get('h24', 0))
-        
-        trend = "📈 Растёт" if price_change_24h > 0 else "📉 Падает"
-        current_time = datetime.now().strftime("%d.%m.%Y %H:%M:%S")
-        
-        message_text = (
-            "🏦 *FPIBANK Price Analysis*\n\n"
-            f"💰 Цена: ${price:.6f}\n"
-            f"📊 24h: {price_change_24h:+.2f}%\n"
-            f"📈 Тренд: {trend}\n\n"
-            f"📊 *Рыночные данные:*\n"
-            f"💎 Market Cap: ${market_cap:,.2f}\n"
-            f"💧 Ликвидность: ${liquidity:,.2f}\n"
-            f"📈 Объём (24h): ${volume_24h:,.2f}\n\n"
-            f"🕒 {current_time}"
-        )
-
         await message.answer(
-            message_text,
+            coin_card(data, fetched_at, unavailable),
             parse_mode="Markdown",
             reply_markup=timeframes_kb
         )
@@ -248,12 +808,54 @@ async def show_coin_info(message: types.Message):
         error_message = "❌ *Ошибка при получении данных*\n\nПожалуйста, попробуйте позже или обратитесь к администратору."
         await message.answer(error_message, parse_mode="Markdown")
 
+# Инлайн-режим (@Fpiclan_bot fpi в любом чате; включается в @BotFather через /setinline).
+# Карточка берётся из снимка PairDataCache, так что запросы не добавляют обращений
+# к DexScreener; cache_time - пока снимок свежий, и повторы Telegram отдаёт из своего кэша.
+INLINE_STALE_CACHE_TIME = 5
+
+@dp.inline_handler()
+async def inline_coin_quote(inline_query: types.InlineQuery):
+    try:
+        data, fetched_at, unavailable = await get_pair_data()
+        pair_data = data['pairs'][0]
+        price = float(pair_data['priceUsd'])
+        price_change_24h = float(pair_data['priceChange']['h24'])
+        result = types.InlineQueryResultArticle(
+            id=f"coin-{int(fetched_at.timestamp())}",
+            title=f"FPIBANK ${price:.6f}",
+            description=f"24h: {price_change_24h:+.2f}% · {fetched_at.strftime('%H:%M:%S')}",
+            input_message_content=types.InputTextMessageContent(
+                coin_card(data, fetched_at, unavailable),
+                parse_mode="Markdown"
+            ),
+            reply_markup=timeframes_kb
+        )
+        fresh_for = pair_data_cache.fresh_for()
+        cache_time = max(1, int(fresh_for)) if fresh_for else INLINE_STALE_CACHE_TIME
+    except Exception as e:
+        logger.error(f"Error getting data for inline query: {e}")
+        result = types.InlineQueryResultArticle(
+            id="coin-unavailable",
+            title="❌ Данные временно недоступны",
+            description="Попробуйте позже",
+            input_message_content=types.InputTextMessageContent(
+                "❌ *Ошибка при получении данных*\n\nПожалуйста, попробуйте позже.",
+                parse_mode="Markdown"
+            )
+        )
+        cache_time = INLINE_STALE_CACHE_TIME
+    
+    try:
+        await inline_query.answer([result], cache_time=cache_time, is_personal=False)
+    except Exception as e:
+        logger.error(f"Error answering inline query: {e}")
+
 @dp.callback_query_handler(lambda c: c.data.startswith('tf_'))
 async def process_timeframe(callback_query: types.CallbackQuery):
     try:
         timeframe = callback_query.data.split('_')[1]
         
-        data = await get_pair_data()
+        data, fetched_at, unavailable = await get_pair_data()
         pair_data = data['pairs'][0]
         
         timeframe_text = {
@@ -282,10 +884,11 @@ async def process_timeframe(callback_query: types.CallbackQuery):
             f"💰 Текущая цена: ${price:.6f}\n"
             f"📊 Изменение: {change:+.2f}%\n"
             f"📈 Тренд: {trend}\n\n"
-            f"🕒 {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}"
+            + data_time_line(fetched_at, unavailable)
         )
         
-        await callback_query.message.edit_text(
+        await edit_callback_text(
+            callback_query,
             message_text,
             parse_mode="Markdown",
             reply_markup=timeframes_kb
@@ -293,17 +896,28 @@ async def process_timeframe(callback_query: types.CallbackQuery):
         
     except Exception as e:
         logger.error(f"Error in timeframe callback: {e}")
-        await callback_query.message.edit_text(
+        await edit_callback_text(
+            callback_query,
             "❌ Ошибка при получении данных. Попробуйте позже.",
             reply_markup=timeframes_kb
         )
 
     await callback_query.answer()
 
+# Карточка, отправленная через инлайн-режим, приходит без message - только inline_message_id
+async def edit_callback_text(callback_query: types.CallbackQuery, text, **kwargs):
+    try:
+        if callback_query.message is not None:
+            await callback_query.message.edit_text(text, **kwargs)
+        else:
+            await bot.edit_message_text(text, inline_message_id=callback_query.inline_message_id, **kwargs)
+    except Exception as e:
+        logger.error(f"Error editing callback message: {e}")
+
 @dp.message_handler(commands=['all'])
 async def ping_all(message: types.Message):
     try:
-        if str(message.chat.id) != config.config['Chat']['main_chat_id']:
+        if message.chat.id not in config.chat_ids:
             return
             
         member = await message.chat.get_member(message.from_user.id)
@@ -365,7 +979,7 @@ async def ping_all(message: types.Message):
 @dp.message_handler(commands=['mod'])
 async def ping_mods(message: types.Message):
     try:
-        if str(message.chat.id) != config.config['Chat']['main_chat_id']:
+        if message.chat.id not in config.chat_ids:
             return
             
         member = await message.chat.get_member(message.from_user.id)
@@ -416,46 +1030,337 @@ async def ping_mods(message: types.Message):
             parse_mode="Markdown"
         )
 
+# Наплыв новых участников: вместо приветствия каждому - одно общее за окно
+welcome_counter = JoinRateCounter(config.config.getfloat('Welcome', 'join_seconds', fallback=60))
+pending_welcomes = {}
+
+async def send_merged_welcome(chat_id):
+    await asyncio.sleep(welcome_counter.window)
+    count = pending_welcomes.pop(chat_id, 0)
+    try:
+        await bot.send_message(chat_id, f"👋 Новых участников: {count}\n\n" + config.get_welcome_text(chat_id))
+    except Exception as e:
+        logger.error(f"Error in merged welcome: {e}")
+
 @dp.message_handler(content_types=['new_chat_members'])
 async def welcome_new_member(message: types.Message):
     try:
-        if str(message.chat.id) != config.config['Chat']['main_chat_id']:
+        if message.chat.id not in config.chat_ids:
             return
-            
-        for new_member in message.new_chat_members:
-            if not new_member.is_bot:
-                welcome_text = (
-                    "🌟 Добро пожаловать в чат FPI-Клан!\n\n"
-                    "🤖 У нас есть собственный бот: @Fpiclan_bot\n\n"
-                    "👥 Нам требуются:\n"
-                    "• 📣 Рекламщики\n"
-                    "• 💡 Идеи для сайта\n"
-                    "• 🎨 Дизайнеры для картинок сайта"
-                )
+        
+        new_members = [member for member in message.new_chat_members if not member.is_bot]
+        if not new_members:
+            return
+        
+        chat_id = message.chat.id
+        joins = welcome_counter.add(chat_id, [member.id for member in new_members])
+        max_joins = config.config.getint('Welcome', 'max_joins', fallback=5)
+        
+        if chat_id in pending_welcomes:
+            pending_welcomes[chat_id] += len(new_members)
+        elif joins > max_joins:
+            pending_welcomes[chat_id] = len(new_members)
+            asyncio.create_task(send_merged_welcome(chat_id))
+        else:
+            welcome_text = config.get_welcome_text(chat_id)
+            for _ in new_members:
                 await message.answer(welcome_text)
 
     except Exception as e:
         logger.error(f"Error in welcome message: {e}")
 
-async def reset_daily_stats():
+@dp.message_handler(commands=['setwelcome'])
+async def set_welcome(message: types.Message):
+    try:
+        if message.chat.id not in config.chat_ids:
+            return
+        if message.from_user.id not in config.admin_ids:
+            await message.reply("❌ У вас нет доступа к этой команде!")
+            return
+        
+        text = message.get_args().strip()
+        if not text:
+            # Текст приветствия без разметки: _ и * в нём ломали бы Markdown
+            await message.reply(
+                "ℹ️ Текущее приветствие:\n\n" + config.get_welcome_text(message.chat.id) +
+                "\n\nИзменить: /setwelcome текст"
+            )
+            return
+        
+        config.set_welcome_text(message.chat.id, text)
+        await message.reply("✅ Приветствие для этого чата обновлено!")
+
+    except Exception as e:
+        logger.error(f"Error in setwelcome: {e}")
+        await message.reply("❌ Не удалось сохранить приветствие, попробуйте ещё раз")
+
+# Рассылка всем пользователям из unique_users: копия сообщения админа с темпом rate в секунду
+# (общий лимит Telegram - около 30 сообщений в секунду на бота, остаток - обычным ответам).
+# Список получателей фиксируется при старте в broadcast.json, позиция сохраняется после
+# каждой отправки в broadcast.progress: после перезапуска рассылка продолжается с того же места.
+class Broadcast:
+    def __init__(self, path='broadcast.json', rate=25.0, report_seconds=15.0):
+        self.path = path
+        self.progress_path = os.path.splitext(path)[0] + '.progress'
+        self.rate = rate
+        self.report_seconds = report_seconds
+        self.job = None
+        self.progress = None
+        self.task = None
+        self.dropped = []
+        self.started = None
+        self.processed = 0
+
+    @classmethod
+    def from_config(cls, config, section='Broadcast'):
+        return cls(
+            config.get(section, 'job_file', fallback='broadcast.json'),
+            config.getfloat(section, 'rate', fallback=25.0),
+            config.getfloat(section, 'report_seconds', fallback=15.0)
+        )
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    @staticmethod
+    def write(path, data):
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def checkpoint(self):
+        self.write(self.progress_path, self.progress)
+
+    def start(self, from_chat_id, message_id, admin_id, status_chat_id, status_message_id, users):
+        self.job = {
+            'from_chat_id': from_chat_id,
+            'message_id': message_id,
+            'admin_id': admin_id,
+            'status_chat_id': status_chat_id,
+            'status_message_id': status_message_id,
+            'users': users,
+            'started': time.time()
+        }
+        self.progress = {'position': 0, 'sent': 0, 'failed': 0, 'blocked': 0}
+        self.write(self.path, self.job)
+        self.checkpoint()
+        self.task = asyncio.create_task(self.run())
+
+    # Незаконченная рассылка с прошлого запуска
+    def resume(self):
+        try:
+            with open(self.path) as f:
+                self.job = json.load(f)
+            with open(self.progress_path) as f:
+                self.progress = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (ValueError, KeyError) as e:
+            logger.error(f"Broadcast state not loaded: {e}")
+            return False
+        logger.info(f"Resuming broadcast at {self.progress['position']}/{len(self.job['users'])}")
+        self.task = asyncio.create_task(self.run())
+        return True
+
+    def stop(self):
+        if self.running:
+            self.task.cancel()
+        self.finish()
+
+    def finish(self):
+        for path in (self.path, self.progress_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.flush_dropped()
+
+    def flush_dropped(self):
+        if self.dropped:
+            config.remove_users(self.dropped)
+            self.dropped = []
+
+    def status_text(self, started, processed, done=False, failed=False):
+        total = len(self.job['users'])
+        progress = self.progress
+        elapsed = max(time.monotonic() - started, 1e-9)
+        speed = processed / elapsed
+        left = total - progress['position']
+        eta = f"{left / speed / 60:.0f} мин" if speed and left else "—"
+        return (
+            f"📣 *Рассылка {'прервана из-за ошибки' if failed else 'завершена' if done else 'идёт'}*\n\n"
+            f"📬 Обработано: {progress['position']}/{total} ({progress['position'] * 100 / max(total, 1):.0f}%)\n"
+            f"✅ Доставлено: {progress['sent']}\n"
+            f"🚫 Заблокировали бота: {progress['blocked']}\n"
+            f"⚠️ Ошибок: {progress['failed']}\n"
+            f"⚡️ Скорость: {speed:.1f} сообщ./с"
+            + ("" if done or failed else f"\n⏳ Осталось: {eta}")
+        )
+
+    async def report(self, text):
+        # В заданиях до status_chat_id статус всегда был в личке админа
+        status_chat_id = self.job.get('status_chat_id', self.job['admin_id'])
+        try:
+            await bot.edit_message_text(text, status_chat_id, self.job['status_message_id'], parse_mode="Markdown")
+        except Exception as e:
+            logger.warning(f"Could not update broadcast status: {e}")
+
+    # Сбой вне отправки одному получателю (запись прогресса, config.ini) прерывает рассылку:
+    # статус помечается, инициатор получает сообщение, задание не висит "идущим"
+    async def run(self):
+        self.started = time.monotonic()
+        self.processed = 0
+        try:
+            await self.send_all()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"Broadcast failed: {e}")
+            text = self.status_text(self.started, self.processed, failed=True)
+            await self.report(text)
+            try:
+                await bot.send_message(self.job['admin_id'], text + "\n\nПодробности в логе бота", parse_mode="Markdown")
+            except Exception as e:
+                logger.warning(f"Could not notify broadcast initiator: {e}")
+            try:
+                self.finish()
+            except Exception as e:
+                logger.error(f"Broadcast cleanup failed: {e}")
+
+    async def send_all(self):
+        job, progress = self.job, self.progress
+        users = job['users']
+        interval = 1 / self.rate
+        started = next_send = last_report = self.started
+        try:
+            while progress['position'] < len(users):
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                next_send = max(next_send, time.monotonic()) + interval
+                
+                user_id = users[progress['position']]
+                try:
+                    await bot.copy_message(user_id, job['from_chat_id'], job['message_id'])
+                    progress['sent'] += 1
+                except RetryAfter as e:
+                    # Превысили лимит: ждём, сколько сказал Telegram, и повторяем того же
+                    logger.warning(f"Broadcast flood control, sleeping {e.timeout}s")
+                    await asyncio.sleep(e.timeout)
+                    next_send = time.monotonic()
+                    continue
+                except (Unauthorized, ChatNotFound):
+                    progress['blocked'] += 1
+                    self.dropped.append(user_id)
+                except Exception as e:
+                    # Ошибки API и сети (таймаут, обрыв соединения) - сбой для одного получателя
+                    progress['failed'] += 1
+                    logger.warning(f"Broadcast to {user_id} failed: {e}")
+                progress['position'] += 1
+                self.processed += 1
+                self.checkpoint()
+                
+                if time.monotonic() - last_report >= self.report_seconds:
+                    last_report = time.monotonic()
+                    self.flush_dropped()
+                    await self.report(self.status_text(started, self.processed))
+        finally:
+            self.flush_dropped()
+        
+        await self.report(self.status_text(started, self.processed, done=True))
+        logger.info(f"Broadcast finished: {progress}")
+        self.finish()
+
+broadcast = Broadcast.from_config(config.config)
+
+@dp.message_handler(commands=['broadcast'])
+async def broadcast_command(message: types.Message):
+    try:
+        if message.from_user.id not in config.admin_ids:
+            return
+        
+        args = message.get_args().strip().lower()
+        if args == 'stop':
+            if not broadcast.running:
+                await message.reply("ℹ️ Рассылка не идёт")
+                return
+            broadcast.stop()
+            await message.reply("🛑 Рассылка остановлена")
+            return
+        if args == 'status' or broadcast.running:
+            if not broadcast.running:
+                await message.reply("ℹ️ Рассылка не идёт")
+                return
+            progress = broadcast.progress
+            await message.reply(
+                f"📣 Рассылка идёт: {progress['position']}/{len(broadcast.job['users'])}\n"
+                "Остановить: /broadcast stop"
+            )
+            return
+        if not message.reply_to_message:
+            await message.reply(
+                "ℹ️ Ответьте командой `/broadcast` на сообщение, которое нужно разослать\n"
+                "`/broadcast status` - ход рассылки, `/broadcast stop` - остановить",
+                parse_mode="Markdown"
+            )
+            return
+        
+        users = config.get_users()
+        if not users:
+            await message.reply("ℹ️ Нет пользователей для рассылки")
+            return
+        text = (
+            f"📣 *Рассылка запущена*\n\n👥 Получателей: {len(users)}\n"
+            f"⏳ Примерно {len(users) / broadcast.rate / 60:.0f} мин"
+        )
+        # Статус - в личку админа; если он не писал боту в личку, прямо в этот чат
+        try:
+            status = await bot.send_message(message.from_user.id, text, parse_mode="Markdown")
+        except TelegramAPIError as e:
+            logger.warning(f"Broadcast status not sent privately to {message.from_user.id}: {e}")
+            status = await message.reply(text, parse_mode="Markdown")
+        broadcast.start(
+            message.chat.id, message.reply_to_message.message_id, message.from_user.id,
+            status.chat.id, status.message_id, users
+        )
+    
+    except Exception as e:
+        logger.error(f"Error in broadcast command: {e}")
+
+# Перезагрузка config.ini на лету, итог уходит админам
+async def reload_config():
+    config.reload()
+    reports, config.reports = config.reports, []
+    for report in reports:
+        for admin_id in config.admin_ids:
+            try:
+                await bot.send_message(admin_id, report, parse_mode="Markdown")
+            except Exception as e:
+                logger.error(f"Error reporting config reload to {admin_id}: {e}")
+
+async def save_activity_history():
     while True:
+        await asyncio.sleep(300)
         try:
-            now = datetime.now()
-            next_day = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-            if now >= next_day:
-                next_day = next_day.replace(day=next_day.day + 1)
-            await asyncio.sleep((next_day - now).seconds)
-            config.reset_daily_stats()
+            config.history.save()
         except Exception as e:
-            logger.error(f"Error in reset_daily_stats: {e}")
-            await asyncio.sleep(60)
+            logger.error(f"Error saving activity history: {e}")
+
+async def on_startup(dp):
+    asyncio.create_task(save_activity_history())
+    asyncio.create_task(loop_monitor.run())
+    asyncio.create_task(ConfigWatcher([config.filename], reload_config).watch())
+    broadcast.resume()
+
+async def on_shutdown(dp):
+    config.history.save()
+    if config.save_handle is not None:
+        config.save_stats()
+    await pair_data_cache.close()
 
 if __name__ == '__main__':
-    from aiogram import executor
     try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.create_task(reset_daily_stats())
-        executor.start_polling(dp, skip_updates=True)
+        offsets = OffsetFile(config.config.get('Updates', 'offset_file', fallback='fpi_offset'))
+        run_polling(dp, offsets, on_startup=on_startup, on_shutdown=on_shutdown, executor=update_executor)
     except Exception as e:
         logger.error(f"Main loop error: {e}")
@@ -0,0 +1,419 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import types
+from collections import Counter, defaultdict, deque
+
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+
+def callable_name(func):
+    return getattr(func, '__qualname__', None) or getattr(func, '__name__', None) or repr(func)
+
+
+# Имя того, что выполняет шаг цикла: корутина задачи или обычный колбэк
+def handle_name(handle):
+    callback = handle._callback
+    owner = getattr(callback, '__self__', None)
+    if isinstance(owner, asyncio.Task):
+        return callable_name(owner.get_coro())
+    return callable_name(callback)
+
+
+def handle_handler(handle):
+    context = handle._context
+    return context.get(current_handler, None) if context is not None else None
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+# Стек от корня к листу в формате collapsed stacks (flamegraph.pl, speedscope)
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+# Профилировщик цикла событий: поток-сэмплер снимает стек потока цикла, а обёртка
+# Handle._run считает CPU и время на цикле для каждого шага корутин и колбэков
+class LoopProfiler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.active = False
+        self.reset()
+
+    def reset(self):
+        self.stacks = Counter()
+        self.coroutines = defaultdict(lambda: [0, 0.0, 0.0])  # имя -> [шагов, CPU, на цикле]
+        self.handlers = defaultdict(lambda: [0, 0.0, 0.0])    # обработчик -> [шагов, CPU, на цикле]
+        self.responses = defaultdict(lambda: [0, 0.0])        # обработчик -> [вызовов, время ответа]
+        self.samples = 0
+        self.duration = 0.0
+
+    def sample(self, thread_id, stop):
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                self.stacks[collapse_stack(frame)] += 1
+                self.samples += 1
+
+    def patch(self):
+        original = asyncio.events.Handle._run
+        profiler = self
+
+        def _run(handle):
+            handler = handle_handler(handle)
+            wall = time.perf_counter()
+            cpu = time.thread_time()
+            try:
+                return original(handle)
+            finally:
+                cpu = time.thread_time() - cpu
+                wall = time.perf_counter() - wall
+                row = profiler.coroutines[handle_name(handle)]
+                row[0] += 1
+                row[1] += cpu
+                row[2] += wall
+                handler = handle_handler(handle) or handler
+                if handler is not None:
+                    row = profiler.handlers[callable_name(handler)]
+                    row[0] += 1
+                    row[1] += cpu
+                    row[2] += wall
+
+        asyncio.events.Handle._run = _run
+        return original
+
+    def record_response(self, handler, elapsed):
+        row = self.responses[callable_name(handler)]
+        row[0] += 1
+        row[1] += elapsed
+
+    async def run(self, seconds):
+        if self.active:
+            raise RuntimeError("Profiler is already running")
+        self.reset()
+        self.active = True
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self.sample, args=(threading.get_ident(), stop), name='loop-profiler', daemon=True
+        )
+        original = self.patch()
+        # Сэмплер ждёт GIL: без короткого интервала переключения он просыпался бы
+        # только в select() и видел бы один простой цикла
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(switch_interval, self.interval / 10))
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            sys.setswitchinterval(switch_interval)
+            asyncio.events.Handle._run = original
+            stop.set()
+            self.active = False
+            self.duration = time.perf_counter() - started
+        await asyncio.get_running_loop().run_in_executor(None, sampler.join)
+        logging.info(f"Profiled event loop for {self.duration:.1f}s: {self.samples} samples")
+        return self
+
+    def top(self, table, limit=10):
+        return sorted(table.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+
+    # Листья стеков: где поток цикла находился чаще всего
+    def hot_frames(self, limit=10):
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return leaves.most_common(limit)
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+# Время ответа обработчиков (от фильтров до конца обработчика), пока идёт профилирование
+class ProfilerMiddleware(BaseMiddleware):
+    def __init__(self, profiler):
+        self.profiler = profiler
+        super(ProfilerMiddleware, self).__init__()
+
+    def start(self, data):
+        if self.profiler.active:
+            data['_profile_started'] = (current_handler.get(None), time.perf_counter())
+
+    def finish(self, data):
+        started = data.pop('_profile_started', None)
+        if started is not None and started[0] is not None and self.profiler.active:
+            self.profiler.record_response(started[0], time.perf_counter() - started[1])
+
+    async def on_process_message(self, message, data):
+        self.start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        self.finish(data)
+
+    async def on_process_callback_query(self, callback_query, data):
+        self.start(data)
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        self.finish(data)
+
+
+class SlowCallback:
+    __slots__ = ('name', 'handler', 'duration', 'stack', 'at')
+
+    def __init__(self, name, handler, duration, stack, at):
+        self.name = name
+        self.handler = handler
+        self.duration = duration
+        self.stack = stack
+        self.at = at
+
+
+def format_stack(frame, limit=8):
+    lines = []
+    while frame is not None and len(lines) < limit:
+        code = frame.f_code
+        lines.append(f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}")
+        frame = frame.f_back
+    return lines
+
+
+# Монитор цикла событий: зонд задержки (насколько позже запланированного просыпается
+# sleep) и детектор медленных шагов. Стек блокирующего шага снимает сторожевой поток,
+# пока шаг ещё выполняется, - так видно, где именно цикл стоит (json.dump, запись файла).
+class LoopMonitor:
+    def __init__(self, threshold=0.1, interval=0.5, alert_seconds=10.0, alert_cooldown=600.0,
+                 log_interval=300.0, on_alert=None):
+        self.threshold = threshold
+        self.interval = interval
+        self.alert_seconds = alert_seconds
+        self.alert_cooldown = alert_cooldown
+        self.log_interval = log_interval
+        self.on_alert = on_alert
+        self.lags = deque(maxlen=max(1, int(600 / interval)))  # последние ~10 минут
+        self.max_lag = 0.0
+        self.lag_since = None    # с какого момента задержка держится выше порога
+        self.alerted_at = None
+        self.slow = deque(maxlen=50)
+        self.slow_total = 0
+        self.slow_by_name = Counter()
+        self.step_started = None
+        self.step_stack = None
+        self.loop_thread = None
+        self.stop = threading.Event()
+
+    @classmethod
+    def from_config(cls, config, on_alert=None, section='Monitor'):
+        return cls(
+            config.getfloat(section, 'lag_threshold_ms', fallback=100) / 1000,
+            config.getfloat(section, 'probe_interval', fallback=0.5),
+            config.getfloat(section, 'alert_seconds', fallback=10),
+            config.getfloat(section, 'alert_cooldown', fallback=600),
+            config.getfloat(section, 'log_interval', fallback=300),
+            on_alert
+        )
+
+    def install(self):
+        original = asyncio.events.Handle._run
+        monitor = self
+
+        def _run(handle):
+            monitor.step_stack = None
+            monitor.step_started = started = time.perf_counter()
+            try:
+                return original(handle)
+            finally:
+                monitor.step_started = None
+                duration = time.perf_counter() - started
+                if duration > monitor.threshold:
+                    monitor.record_slow(handle, duration)
+
+        asyncio.events.Handle._run = _run
+
+    def record_slow(self, handle, duration):
+        handler = handle_handler(handle)
+        name = handle_name(handle)
+        record = SlowCallback(
+            name, callable_name(handler) if handler is not None else None,
+            duration, self.step_stack or [], time.time()
+        )
+        self.slow.append(record)
+        self.slow_total += 1
+        self.slow_by_name[record.handler or name] += 1
+        where = f" (handler {record.handler})" if record.handler else ""
+        stack = "\n  ".join(record.stack)
+        logging.warning(f"Slow callback {name}{where}: {duration * 1000:.0f} ms" + (f"\n  {stack}" if stack else ""))
+
+    def watchdog(self):
+        while not self.stop.wait(self.threshold / 2):
+            started = self.step_started
+            if started is not None and self.step_stack is None and time.perf_counter() - started > self.threshold:
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is not None and self.step_started == started:
+                    self.step_stack = format_stack(frame)
+
+    async def run(self):
+        self.loop_thread = threading.get_ident()
+        self.install()
+        threading.Thread(target=self.watchdog, name='loop-watchdog', daemon=True).start()
+        logged_at = time.monotonic()
+        try:
+            while True:
+                expected = time.monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                lag = max(0.0, now - expected)
+                self.lags.append(lag)
+                self.max_lag = max(self.max_lag, lag)
+                await self.check_alert(lag, now)
+                if now - logged_at >= self.log_interval:
+                    logged_at = now
+                    stats = self.stats()
+                    logging.info(
+                        f"Loop lag: avg {stats['avg'] * 1000:.1f} ms, p99 {stats['p99'] * 1000:.1f} ms, "
+                        f"max {stats['max'] * 1000:.1f} ms, slow callbacks {stats['slow']}"
+                    )
+        finally:
+            self.stop.set()
+
+    async def check_alert(self, lag, now):
+        if lag <= self.threshold:
+            self.lag_since = None
+            return
+        if self.lag_since is None:
+            self.lag_since = now
+        if now - self.lag_since < self.alert_seconds:
+            return
+        if self.alerted_at is not None and now - self.alerted_at < self.alert_cooldown:
+            return
+        self.alerted_at = now
+        logging.warning(f"Event loop lag above {self.threshold * 1000:.0f} ms for {now - self.lag_since:.0f}s")
+        if self.on_alert:
+            try:
+                await self.on_alert(self)
+            except Exception as e:
+                logging.error(f"Loop lag alert failed: {e}")
+
+    def stats(self):
+        lags = sorted(self.lags)
+        return {
+            'current': self.lags[-1] if self.lags else 0.0,
+            'avg': sum(lags) / len(lags) if lags else 0.0,
+            'p99': lags[min(len(lags) - 1, int(len(lags) * 0.99))] if lags else 0.0,
+            'max': self.max_lag,
+            'slow': self.slow_total,
+            'top': self.slow_by_name.most_common(3)
+        }
+
+
+# Глубокий размер контейнера: обход ссылок с ограничением, функции и модули не считаются
+def deep_size(obj, limit=200000):
+    seen = set()
+    stack = [obj]
+    total = 0
+    visited = 0
+    while stack and visited < limit:
+        item = stack.pop()
+        if id(item) in seen or isinstance(item, (type, types.ModuleType, types.FunctionType, types.MethodType)):
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        visited += 1
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            stack.extend(item)
+        else:
+            for cls in type(item).__mro__:
+                for name in getattr(cls, '__slots__', ()):
+                    value = getattr(item, name, None)
+                    if value is not None:
+                        stack.append(value)
+            if hasattr(item, '__dict__'):
+                stack.append(item.__dict__)
+    return total, bool(stack)
+
+
+def process_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def format_size(size):
+    if abs(size) < 1024:
+        return f"{size:.0f} Б"
+    if abs(size) < 1024 * 1024:
+        return f"{size / 1024:.1f} КБ"
+    return f"{size / 1024 / 1024:.1f} МБ"
+
+def trace_site(stat):
+    frame = stat.traceback[0]
+    return f"{os.path.basename(frame.filename)}:{frame.lineno}"
+
+
+# Учёт памяти: размеры зарегистрированных хранилищ состояния и снимки tracemalloc
+# (сравнение с прошлым снимком показывает, что растёт между вызовами)
+class MemoryTracker:
+    def __init__(self, frames=10):
+        self.frames = frames
+        self.containers = {}
+        self.previous = None
+
+    def register(self, name, getter):
+        self.containers[name] = getter
+
+    def sizes(self):
+        rows = []
+        for name, getter in self.containers.items():
+            try:
+                container = getter()
+                items = len(container) if hasattr(container, '__len__') else None
+                size, truncated = deep_size(container)
+            except Exception as e:
+                logging.error(f"Could not measure {name}: {e}")
+                continue
+            rows.append((name, items, size, truncated))
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.previous = None
+
+    def stop(self):
+        tracemalloc.stop()
+        self.previous = None
+
+    # (топ мест выделения, изменения с прошлого снимка или None, всего отслежено байт)
+    def snapshot(self, limit=10):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ))
+        top = snapshot.statistics('lineno')[:limit]
+        diff = None
+        if self.previous is not None:
+            diff = [stat for stat in snapshot.compare_to(self.previous, 'lineno') if stat.size_diff][:limit]
+        self.previous = snapshot
+        return top, diff, tracemalloc.get_traced_memory()[0]
@@ -0,0 +1,360 @@
+import asyncio
+import copy
+import json
+import logging
+import sqlite3
+import typing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from aiogram.dispatcher.storage import BaseStorage
+
+
+# Бэкенд на SQLite: одна таблица ключ-значение, все запросы в отдельном потоке
+class SQLiteBackend:
+    def __init__(self, path='state.db'):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self.db = None
+
+    def _open(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        return self.db
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _get(self, key):
+        row = self._open().execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _write(self, batch):
+        db = self._open()
+        with db:
+            db.executemany(
+                "INSERT INTO kv (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                [(key, value) for key, value in batch.items() if value is not None]
+            )
+            db.executemany("DELETE FROM kv WHERE key = ?", [(key,) for key, value in batch.items() if value is None])
+
+    def _scan(self, prefix):
+        # Диапазон [prefix, prefix + U+FFFF) идёт по первичному ключу без LIKE
+        cursor = self._open().execute(
+            "SELECT key, value FROM kv WHERE key >= ? AND key < ? ORDER BY key",
+            (prefix, prefix + '\uffff')
+        )
+        return cursor.fetchall()
+
+    def _close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    async def get(self, key):
+        return await self._run(self._get, key)
+
+    async def write(self, batch):
+        await self._run(self._write, batch)
+
+    async def scan(self, prefix):
+        return await self._run(self._scan, prefix)
+
+    async def close(self):
+        await self._run(self._close)
+        self.executor.shutdown(wait=False)
+
+
+# Бэкенд для любого сервера с протоколом Redis (Redis, KeyDB, Valkey...), без зависимостей
+class RedisBackend:
+    def __init__(self, url='redis://localhost:6379/0'):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.strip('/') or 0)
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def _encode(*args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        return b"".join(parts)
+
+    async def _read(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            raise RuntimeError(f"Redis error: {payload.decode()}")
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            size = int(payload)
+            if size < 0:
+                return None
+            data = await self.reader.readexactly(size + 2)
+            return data[:-2].decode()
+        if kind == b'*':
+            size = int(payload)
+            if size < 0:
+                return None
+            return [await self._read() for _ in range(size)]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self._call_unlocked([('AUTH', self.password)])
+        if self.db:
+            await self._call_unlocked([('SELECT', self.db)])
+
+    async def _call_unlocked(self, commands):
+        self.writer.write(b"".join(self._encode(*command) for command in commands))
+        await self.writer.drain()
+        return [await self._read() for _ in commands]
+
+    # Команды уходят одним пакетом (pipeline), при обрыве - одно переподключение
+    async def call(self, *commands):
+        async with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.writer is None:
+                        await self._connect()
+                    return await self._call_unlocked(commands)
+                except (ConnectionError, OSError):
+                    self.writer = None
+                    if attempt:
+                        raise
+
+    async def get(self, key):
+        return (await self.call(('GET', key)))[0]
+
+    async def write(self, batch):
+        commands = [('MULTI',)]
+        for key, value in batch.items():
+            commands.append(('SET', key, value) if value is not None else ('DEL', key))
+        commands.append(('EXEC',))
+        await self.call(*commands)
+
+    async def scan(self, prefix):
+        cursor = '0'
+        keys = []
+        while True:
+            cursor, found = (await self.call(('SCAN', cursor, 'MATCH', prefix + '*', 'COUNT', 500)))[0]
+            keys.extend(found)
+            if cursor == '0':
+                break
+        keys.sort()
+        rows = []
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            values = (await self.call(('MGET', *chunk)))[0]
+            rows.extend((key, value) for key, value in zip(chunk, values) if value is not None)
+        return rows
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+# Хранилище состояния с отложенной пакетной записью (write-behind).
+# Кэш чтения - LRU на cache_size ключей (вместе с промахами: ключа нет в бэкенде),
+# незаписанные изменения лежат в dirty и не вытесняются до записи
+class StateStore:
+    def __init__(self, backend, flush_interval=1.0, max_pending=500, cache_size=10000):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # ключ -> значение (None - ключа нет), порядок = последнее обращение
+        self.dirty = {}
+        self.flush_task = None
+
+    @classmethod
+    def from_config(cls, config, section='Storage'):
+        kind = config.get(section, 'backend', fallback='sqlite')
+        if kind == 'redis':
+            backend = RedisBackend(config.get(section, 'url', fallback='redis://localhost:6379/0'))
+        elif kind == 'sqlite':
+            backend = SQLiteBackend(config.get(section, 'state_file', fallback='state.db'))
+        else:
+            raise ValueError(f"Unknown storage backend: {kind}")
+        return cls(
+            backend,
+            config.getfloat(section, 'flush_interval', fallback=1.0),
+            config.getint(section, 'max_pending', fallback=500),
+            config.getint(section, 'cache_size', fallback=10000)
+        )
+
+    def remember(self, key, value):
+        cache = self.cache
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    async def get(self, key, default=None):
+        if key in self.dirty:
+            value = self.dirty[key]
+        elif key in self.cache:
+            value = self.cache[key]
+            self.cache.move_to_end(key)
+        else:
+            raw = await self.backend.get(key)
+            value = json.loads(raw) if raw is not None else None
+            # Пока шёл запрос, ключ могли записать - новое значение не затираем
+            if key not in self.cache and key not in self.dirty:
+                self.remember(key, value)
+        return default if value is None else value
+
+    def set(self, key, value):
+        self.remember(key, value)
+        self.dirty[key] = value
+        self.schedule_flush()
+
+    def delete(self, key):
+        self.set(key, None)
+
+    async def scan(self, prefix):
+        await self.flush()
+        return [(key, json.loads(value)) for key, value in await self.backend.scan(prefix)]
+
+    def schedule_flush(self):
+        if len(self.dirty) >= self.max_pending:
+            asyncio.create_task(self.flush())
+        elif self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        batch, self.dirty = self.dirty, {}
+        encoded = {key: None if value is None else json.dumps(value, ensure_ascii=False) for key, value in batch.items()}
+        try:
+            await self.backend.write(encoded)
+        except Exception as e:
+            logging.error(f"State flush failed, will retry: {e}")
+            for key, value in batch.items():
+                self.dirty.setdefault(key, value)
+            return
+        # Удалённые ключи больше не держим в кэше
+        for key, value in batch.items():
+            if value is None and key not in self.dirty and self.cache.get(key, 0) is None:
+                del self.cache[key]
+
+    async def close(self):
+        await self.flush()
+        await self.backend.close()
+
+
+# FSM aiogram поверх StateStore: состояния переживают перезапуск.
+# StateFilter спрашивает состояние на каждое обновление, а оно почти всегда пустое:
+# множество ключей с состоянием читается один раз, за остальными в бэкенд не ходим
+class StoreFSMStorage(BaseStorage):
+    def __init__(self, store, prefix='fsm'):
+        self.store = store
+        self.prefix = prefix
+        self.known = None  # ключи с сохранённым состоянием
+
+    def key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return f"{self.prefix}:{chat}:{user}"
+
+    async def load(self, chat, user):
+        key = self.key(chat, user)
+        if self.known is None:
+            self.known = {found for found, _ in await self.store.scan(f"{self.prefix}:")}
+        if key not in self.known:
+            return {'state': None, 'data': {}, 'bucket': {}}
+        record = await self.store.get(key)
+        return copy.deepcopy(record) if record else {'state': None, 'data': {}, 'bucket': {}}
+
+    def save(self, chat, user, record):
+        key = self.key(chat, user)
+        if record['state'] is None and not record['data'] and not record['bucket']:
+            self.store.delete(key)
+            if self.known is not None:
+                self.known.discard(key)
+        else:
+            self.store.set(key, record)
+            if self.known is not None:
+                self.known.add(key)
+
+    async def close(self):
+        await self.store.flush()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        record = await self.load(chat, user)
+        return record['state'] if record['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await self.load(chat, user)
+        return record['data'] or (default or {})
+
+    async def set_state(self, *, chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        record = await self.load(chat, user)
+        record['state'] = self.resolve_state(state)
+        self.save(chat, user, record)
+
+    async def set_data(self, *, chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        record = await self.load(chat, user)
+        record['data'] = copy.deepcopy(data) or {}
+        self.save(chat, user, record)
+
+    async def update_data(self, *, chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        record = await self.load(chat, user)
+        record['data'].update(data or {}, **kwargs)
+        self.save(chat, user, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await self.load(chat, user)
+        return record['bucket'] or (default or {})
+
+    async def set_bucket(self, *, chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        record = await self.load(chat, user)
+        record['bucket'] = copy.deepcopy(bucket) or {}
+        self.save(chat, user, record)
+
+    async def update_bucket(self, *, chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        record = await self.load(chat, user)
+        record['bucket'].update(bucket or {}, **kwargs)
+        self.save(chat, user, record)
@@ -0,0 +1,35 @@
+import importlib
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Модули бота лежат в корне репозитория, пакета нет
+sys.path.insert(0, ROOT)
+
+
+# Боты (d.py, fpi.py) импортируются и работают во временном каталоге с копией конфигов:
+# рабочие файлы репозитория (config.ini, state.db, логи) не трогаются
+@pytest.fixture(scope='session')
+def bot_workdir(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp('bot')
+    for name in ('c.ini', 'config.ini', 'banned_words.txt'):
+        if os.path.exists(os.path.join(ROOT, name)):
+            shutil.copy(os.path.join(ROOT, name), workdir)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    yield workdir
+    os.chdir(cwd)
+
+
+@pytest.fixture(scope='session')
+def d(bot_workdir):
+    return importlib.import_module('d')
+
+
+@pytest.fixture(scope='session')
+def fpi(bot_workdir):
+    return importlib.import_module('fpi')
@@ -0,0 +1,211 @@
+import asyncio
+
+import pytest
+
+from antispam import (
+    AhoCorasick, AntiSpamSettings, FloodDetector, KnownMedia, MediaDetector, Rule, RuleEngine,
+    SimilarityDetector, WordFilter, normalize_words
+)
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeStore:
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    async def scan(self, prefix):
+        return sorted((key, value) for key, value in self.data.items() if key.startswith(prefix))
+
+
+def test_flood_detector_hits_after_max_messages_and_resets():
+    clock = Clock()
+    detector = FloodDetector(AntiSpamSettings(max_messages=3, spam_seconds=2), clock=clock)
+    assert [detector.hit('u') for _ in range(4)] == [False, False, False, True]
+    # Окно сброшено: та же волна повторно не наказывается
+    assert detector.hit('u') is False
+
+
+def test_flood_detector_forgets_messages_outside_window():
+    clock = Clock()
+    detector = FloodDetector(AntiSpamSettings(max_messages=2, spam_seconds=2), clock=clock)
+    for _ in range(5):
+        assert detector.hit('u') is False
+        clock.now += 1.5
+
+
+def test_similarity_detector_flags_copies_from_several_users():
+    clock = Clock()
+    detector = SimilarityDetector(AntiSpamSettings(max_similar=3, time_window=60), clock=clock)
+    text = 'заходите на мой канал, там раздача монет каждый день'
+    assert detector.check(1, text) is None
+    assert detector.check(2, text + '!') is None
+    assert detector.check(3, text.upper()) is None
+    assert detector.check(4, text) == {1, 2, 3, 4}
+
+
+def test_similarity_detector_ignores_different_and_expired_texts():
+    clock = Clock()
+    detector = SimilarityDetector(AntiSpamSettings(max_similar=1, time_window=60), clock=clock)
+    assert detector.check(1, 'первое сообщение про погоду сегодня') is None
+    assert detector.check(2, 'совсем другой текст о футболе вчера') is None
+    clock.now += 61
+    assert detector.check(3, 'первое сообщение про погоду сегодня') is None
+
+
+def test_normalize_words_folds_homoglyphs_and_separators():
+    assert normalize_words('Д.у.р-а-а-к') == 'дурак'
+    assert normalize_words('CAMOKAT') == 'самокат'
+
+
+def test_aho_corasick_finds_overlapping_words():
+    automaton = AhoCorasick(['he', 'she', 'hers'])
+    assert automaton.search('ushers') in ('she', 'he')
+    assert automaton.search('xyz') is None
+    assert AhoCorasick([]).search('anything') is None
+
+
+def test_word_filter_reads_file(tmp_path):
+    path = tmp_path / 'words.txt'
+    path.write_text('# комментарий\nдурак\n', encoding='utf-8')
+    word_filter = WordFilter(str(path))
+    assert word_filter.match('ты Д.у.р.а.к!') == 'дурак'
+    assert word_filter.match('всё хорошо') is None
+    assert WordFilter(str(tmp_path / 'missing.txt')).match('дурак') is None
+
+
+def test_rule_engine_reports_overlapping_regex_rules():
+    engine = RuleEngine([
+        Rule('first', 'regex', pattern='abc'),
+        Rule('second', 'regex', pattern='bcd', action='warn'),
+    ])
+    verdicts = engine.evaluate(-1, 1, 'xabcdx', AntiSpamSettings())
+    assert [verdict.rule.name for verdict in verdicts] == ['first', 'second']
+    assert engine.strongest(verdicts).rule.name == 'second'
+
+
+def test_rule_engine_requires_settings():
+    engine = RuleEngine([Rule('flood', 'flood')])
+    with pytest.raises(TypeError):
+        engine.evaluate(-1, 1, 'text')
+
+
+def test_rule_engine_respects_protection_toggle():
+    engine = RuleEngine([Rule('caps', 'caps', toggle='anticaps', min_length=3, ratio=0.5)])
+    assert engine.evaluate(-1, 1, 'КРИЧУ ГРОМКО', AntiSpamSettings(), protection={'anticaps': True})
+    assert not engine.evaluate(-1, 1, 'КРИЧУ ГРОМКО', AntiSpamSettings(), protection={'anticaps': False})
+
+
+def test_media_detector_counts_distinct_users():
+    detector = MediaDetector(AntiSpamSettings(max_similar=3), clock=Clock())
+    for _ in range(10):
+        assert detector.check(42, 'sticker:popular', 0) is None
+    assert detector.check(1, 'sticker:popular', 0) is None
+    assert detector.check(2, 'sticker:popular', 0) is None
+    assert detector.check(3, 'sticker:popular', 0) == {42, 1, 2, 3}
+
+
+def test_media_detector_matches_close_photo_hashes():
+    detector = MediaDetector(AntiSpamSettings(max_similar=1), clock=Clock())
+    assert detector.check(1, 0xff00ff00ff00ff00, 6) is None
+    assert detector.check(2, 0xff00ff00ff00ff03, 6) == {1, 2}
+    assert detector.check(3, 0x00ff00ff00ff00ff, 6) is None
+
+
+def media_engine(known):
+    return RuleEngine([Rule('media', 'media', action='warn', distance=6)], known_media=known)
+
+
+def test_known_media_learns_photos_per_chat_only():
+    known = KnownMedia(clock=Clock())
+    engine = media_engine(known)
+    settings = AntiSpamSettings(max_similar=1)
+    photo = 0xff00ff00ff00ff00
+    assert not engine.evaluate(-1, 1, '', settings, media=photo)
+    assert engine.evaluate(-1, 2, '', settings, media=photo)
+    assert known.count(-1) == 1
+    # Известный спам срабатывает с первого сообщения, но только в своём чате
+    assert engine.evaluate(-1, 7, '', settings, media=photo)[0].detail == 'известный спам'
+    assert not engine.evaluate(-2, 7, '', settings, media=photo)
+
+
+def test_known_media_does_not_learn_stickers():
+    known = KnownMedia(clock=Clock())
+    engine = media_engine(known)
+    settings = AntiSpamSettings(max_similar=1)
+    engine.evaluate(-1, 1, '', settings, media='sticker:abc')
+    assert engine.evaluate(-1, 2, '', settings, media='sticker:abc')
+    assert len(known) == 0
+
+
+def test_known_media_expires_and_forgets():
+    clock = Clock()
+    store = FakeStore()
+    known = KnownMedia(store, days=1, clock=clock)
+    known.add(-1, 'sticker:abc')
+    known.add(-1, 0xff00ff00ff00ff00)
+    assert store.data['mediaknown:-1:sticker:abc'] == clock.now + 86400
+    assert known.forget(-1, 0xff00ff00ff00ff01) == 1
+    assert 'mediaknown:-1:ff00ff00ff00ff00' not in store.data
+    clock.now += 86401
+    assert known.match(-1, 'sticker:abc', 0) is None
+    assert len(known) == 0 and not store.data
+
+
+def test_known_media_load_drops_legacy_and_expired_keys():
+    clock = Clock()
+    store = FakeStore({
+        'mediaknown:ff00ff00ff00ff00': 900,
+        'mediaknown:sticker:old': 900,
+        'mediaknown:-1:sticker:abc': clock.now + 60,
+        'mediaknown:-1:00000000000000ff': clock.now - 1,
+    })
+    known = KnownMedia(store, clock=clock)
+    asyncio.run(known.load())
+    assert list(store.data) == ['mediaknown:-1:sticker:abc']
+    assert known.match(-1, 'sticker:abc', 0) == 'sticker:abc'
+
+
+def test_known_media_limit_evicts_oldest():
+    store = FakeStore()
+    known = KnownMedia(store, limit=2, clock=Clock())
+    for media in ('sticker:a', 'sticker:b', 'sticker:c'):
+        known.add(-1, media)
+    assert known.match(-1, 'sticker:a', 0) is None
+    assert sorted(store.data) == ['mediaknown:-1:sticker:b', 'mediaknown:-1:sticker:c']
+
+
+def test_rule_engine_single_pass_reports_rules_matching_at_same_position():
+    engine = RuleEngine([
+        Rule('short', 'regex', pattern='ab'),
+        Rule('long', 'regex', pattern='abc'),
+        Rule('other', 'regex', pattern='zzz'),
+    ])
+    assert engine.combined is not None and not engine.patterns
+    verdicts = engine.evaluate(-1, 1, 'xabcx', AntiSpamSettings())
+    assert [verdict.rule.name for verdict in verdicts] == ['short', 'long']
+    assert engine.evaluate(-1, 1, 'nothing here', AntiSpamSettings()) == []
+
+
+def test_rule_engine_searches_uncombinable_rules_separately():
+    engine = RuleEngine([
+        Rule('repeat', 'regex', pattern=r'(.)\1\1'),
+        Rule('named', 'regex', pattern=r'(?P<link>t\.me/\w+)'),
+        Rule('flags', 'regex', pattern=r'(?i)казино'),
+        Rule('plain', 'regex', pattern='spam'),
+    ])
+    assert sorted(engine.patterns) == [0, 1, 2]
+    verdicts = engine.evaluate(-1, 1, 'aaa t.me/x КАЗИНО spam', AntiSpamSettings())
+    assert [verdict.rule.name for verdict in verdicts] == ['repeat', 'named', 'flags', 'plain']
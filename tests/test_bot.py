@@ -0,0 +1,206 @@
+import asyncio
+import json
+import types
+
+
+def chat_message(chat_id):
+    return types.SimpleNamespace(chat=types.SimpleNamespace(id=chat_id))
+
+
+def test_check_chat_falls_back_to_snapshot_when_lookup_fails(d, monkeypatch):
+    async def broken(chat_id):
+        raise RuntimeError('storage is down')
+    monkeypatch.setattr(d.chat_settings, 'get', broken)
+    chat_id = d.snapshot.chat_ids[0]
+    settings = asyncio.run(d.check_chat(chat_message(chat_id)))
+    assert settings is not None and settings.chat_id == chat_id
+    assert settings.antispam is not None
+    assert asyncio.run(d.check_chat(chat_message(-42))) is None
+
+
+class FailingBot:
+    def __init__(self):
+        self.restricted = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        raise RuntimeError('flood control')
+
+    async def restrict_chat_member(self, chat_id, user_id, **kwargs):
+        self.restricted.append(user_id)
+
+
+def test_raid_mode_ends_even_if_alert_fails(d):
+    async def main():
+        bot = FailingBot()
+        guard = d.RaidGuard(bot)
+        guard.max_joins = 2
+        guard.cooldown = 0.05
+        assert await guard.on_join(-1, [1]) is False
+        assert await guard.on_join(-1, [2]) is True
+        assert guard.active(-1) and sorted(bot.restricted) == [1, 2]
+        await asyncio.sleep(0.1)
+        return guard.active(-1)
+    assert asyncio.run(main()) is False
+
+
+def test_activity_history_puts_unknown_commands_under_other(fpi, tmp_path):
+    history = fpi.ActivityHistory(str(tmp_path / 'history.json'))
+    for command in ('/coin', '/coin', '/junk1', '/junk2', '/junk3'):
+        history.add(command)
+    assert set(history.hourly) == set(fpi.ActivityHistory.COMMANDS)
+    today = next(iter(history.days(1).values()))
+    assert today['/coin'] == 2 and today['other'] == 3
+    assert history.today_total() == 5
+    history.save()
+    assert fpi.ActivityHistory(history.path).today_total() == 5
+
+
+def test_activity_history_folds_legacy_commands_into_other(fpi, tmp_path):
+    history = fpi.ActivityHistory(str(tmp_path / 'history.json'))
+    history.add('/coin')
+    history.save()
+    path = tmp_path / 'history.json'
+    data = json.loads(path.read_text())
+    data['hourly']['/junk'] = data['hourly']['/coin']
+    data['daily']['/junk'] = data['daily']['/coin']
+    path.write_text(json.dumps(data))
+    loaded = fpi.ActivityHistory(history.path)
+    assert '/junk' not in loaded.hourly
+    assert next(iter(loaded.days(1).values()))['other'] == 1
+
+
+class MemoryStore:
+    def __init__(self):
+        self.data = {}
+
+    def set(self, key, value):
+        self.data[key] = value
+
+
+def test_mod_stats_keeps_system_actions_apart_from_admins(d):
+    stats = d.ModStats(MemoryStore(), bot_id=1)
+    stats.record_punishment('warns', {"chat_id": -1, "admin_id": 5, "admin_name": "Админ", "date": 0})
+    stats.record_punishment('mutes', {
+        "chat_id": -1, "admin_id": 1, "admin_name": "Система варнов",
+        "until_date": 3600, "date": 0
+    })
+    rollup = stats.rollup(-1)
+    assert rollup["manual"] == 1 and rollup["auto"] == 1
+    assert rollup["admins"] == {"5": 1}
+    assert rollup["names"] == {"5": "Админ"}
+    assert rollup["mute_minutes"] == 60
+
+
+class BroadcastBot:
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.copied = []
+        self.sent = []
+        self.edited = []
+
+    async def copy_message(self, user_id, from_chat_id, message_id):
+        if user_id in self.failing:
+            raise asyncio.TimeoutError()
+        self.copied.append(user_id)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self.edited.append((chat_id, text))
+
+
+def run_broadcast(fpi, monkeypatch, tmp_path, bot, users, broadcast=None):
+    monkeypatch.setattr(fpi, 'bot', bot)
+    broadcast = broadcast or fpi.Broadcast(str(tmp_path / 'broadcast.json'), rate=1000)
+
+    async def main():
+        broadcast.start(-1, 10, 5, -1, 20, users)
+        await broadcast.task
+    asyncio.run(main())
+    return broadcast
+
+
+def test_broadcast_counts_network_errors_per_recipient(fpi, monkeypatch, tmp_path):
+    bot = BroadcastBot(failing={2})
+    broadcast = run_broadcast(fpi, monkeypatch, tmp_path, bot, [1, 2, 3])
+    assert bot.copied == [1, 3]
+    assert broadcast.progress['failed'] == 1 and broadcast.progress['sent'] == 2
+    assert 'завершена' in bot.edited[-1][1]
+    assert not (tmp_path / 'broadcast.json').exists()
+
+
+def test_broadcast_failure_is_reported_and_cleared(fpi, monkeypatch, tmp_path):
+    class BrokenBroadcast(fpi.Broadcast):
+        def checkpoint(self):
+            if self.progress['position']:
+                raise OSError('disk full')
+            super().checkpoint()
+
+    bot = BroadcastBot()
+    broadcast = BrokenBroadcast(str(tmp_path / 'broadcast.json'), rate=1000)
+    run_broadcast(fpi, monkeypatch, tmp_path, bot, [1, 2, 3], broadcast)
+    assert not broadcast.running
+    assert 'прервана' in bot.edited[-1][1]
+    assert bot.sent and bot.sent[0][0] == 5
+    assert not (tmp_path / 'broadcast.json').exists()
+
+
+class AlertBot:
+    def __init__(self, blocked=()):
+        self.blocked = set(blocked)
+        self.sent = []
+
+    async def get_chat_administrators(self, chat_id):
+        return [
+            types.SimpleNamespace(user=types.SimpleNamespace(id=11, is_bot=False)),
+            types.SimpleNamespace(user=types.SimpleNamespace(id=12, is_bot=True)),
+        ]
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.blocked:
+            raise RuntimeError("bot can't initiate conversation")
+        self.sent.append(chat_id)
+
+
+def test_alerts_go_to_chat_admins_privately_not_to_the_chat(d, monkeypatch):
+    bot = AlertBot()
+    monkeypatch.setattr(d, 'bot', bot)
+    monkeypatch.setattr(d.snapshot, 'owner_ids', set())
+    monkeypatch.setattr(d.snapshot, 'alert_chat_ids', [])
+    asyncio.run(d.send_alert('lag'))
+    assert bot.sent == [11]
+
+    monkeypatch.setattr(d.snapshot, 'owner_ids', {7})
+    asyncio.run(d.send_alert('lag'))
+    assert bot.sent == [11, 7]
+
+
+def test_undelivered_alert_is_logged(d, monkeypatch, caplog):
+    monkeypatch.setattr(d, 'bot', AlertBot(blocked={11}))
+    monkeypatch.setattr(d.snapshot, 'owner_ids', set())
+    monkeypatch.setattr(d.snapshot, 'alert_chat_ids', [])
+    asyncio.run(d.send_alert('lag'))
+    assert 'Alert not delivered' in caplog.text
+
+
+def photo_message(unique_id):
+    return types.SimpleNamespace(photo=[types.SimpleNamespace(file_unique_id=unique_id)])
+
+
+def test_unhashed_photo_is_unknown_until_hash_arrives(d, monkeypatch):
+    monkeypatch.setattr(d, 'PERCEPTUAL_HASH', True)
+    hasher = d.MediaHasher(workers=0, timeout=0.01)
+
+    async def slow_hash(message, unique_id):
+        await asyncio.sleep(0.05)
+        hasher.cache[unique_id] = 0xABCD
+        return 0xABCD
+    monkeypatch.setattr(hasher, 'hash_photo', slow_hash)
+
+    async def main():
+        message = photo_message('uid1')
+        assert await hasher.key(message) is None
+        assert await hasher.key(message, timeout=None) == 0xABCD
+        return await hasher.key(message)
+    assert asyncio.run(main()) == 0xABCD
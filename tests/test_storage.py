@@ -0,0 +1,102 @@
+import asyncio
+
+from storage import SQLiteBackend, StateStore, StoreFSMStorage
+
+
+class CountingBackend:
+    def __init__(self, backend):
+        self.backend = backend
+        self.gets = 0
+
+    async def get(self, key):
+        self.gets += 1
+        return await self.backend.get(key)
+
+    async def write(self, batch):
+        await self.backend.write(batch)
+
+    async def scan(self, prefix):
+        return await self.backend.scan(prefix)
+
+    async def close(self):
+        await self.backend.close()
+
+
+def run(tmp_path, test, **kwargs):
+    async def main():
+        backend = CountingBackend(SQLiteBackend(str(tmp_path / 'state.db')))
+        store = StateStore(backend, flush_interval=60, **kwargs)
+        try:
+            await test(store, backend)
+        finally:
+            await store.close()
+    asyncio.run(main())
+
+
+def test_cache_is_bounded_including_misses(tmp_path):
+    async def test(store, backend):
+        for i in range(10):
+            assert await store.get(f'missing:{i}') is None
+        assert len(store.cache) == 3
+        # Последний промах ещё в кэше, первый уже вытеснен
+        gets = backend.gets
+        await store.get('missing:9')
+        assert backend.gets == gets
+        await store.get('missing:0')
+        assert backend.gets == gets + 1
+    run(tmp_path, test, cache_size=3)
+
+
+def test_dirty_values_survive_cache_eviction(tmp_path):
+    async def test(store, backend):
+        for i in range(5):
+            store.set(f'key:{i}', i)
+        assert len(store.cache) == 2
+        assert await store.get('key:0') == 0
+        await store.flush()
+        assert not store.dirty
+        assert await store.get('key:1') == 1
+        assert await store.get('key:1', 'default') == 1
+    run(tmp_path, test, cache_size=2)
+
+
+def test_deleted_keys_leave_cache_after_flush(tmp_path):
+    async def test(store, backend):
+        store.set('a', {'x': 1})
+        await store.flush()
+        store.delete('a')
+        assert await store.get('a', 'gone') == 'gone'
+        await store.flush()
+        assert 'a' not in store.cache
+        assert await store.scan('a') == []
+    run(tmp_path, test)
+
+
+def test_scan_sees_unflushed_writes(tmp_path):
+    async def test(store, backend):
+        store.set('p:1', 1)
+        store.set('p:2', 2)
+        store.set('q:1', 3)
+        assert await store.scan('p:') == [('p:1', 1), ('p:2', 2)]
+    run(tmp_path, test)
+
+
+def test_fsm_storage_skips_backend_for_users_without_state(tmp_path):
+    async def test(store, backend):
+        fsm = StoreFSMStorage(store)
+        for user in range(100):
+            assert await fsm.get_state(chat=-1, user=user) is None
+        assert backend.gets == 0
+        await fsm.set_state(chat=-1, user=5, state='Form:name')
+        await fsm.update_data(chat=-1, user=5, data={'name': 'test'})
+        assert await fsm.get_state(chat=-1, user=5) == 'Form:name'
+        await fsm.close()
+
+        # Новый процесс: состояние читается из бэкенда
+        fresh = StoreFSMStorage(StateStore(backend))
+        assert await fresh.get_state(chat=-1, user=5) == 'Form:name'
+        assert await fresh.get_data(chat=-1, user=5) == {'name': 'test'}
+        await fresh.reset_state(chat=-1, user=5)
+        assert await fresh.get_state(chat=-1, user=5) is None
+        assert 'fsm:-1:5' not in fresh.known
+    run(tmp_path, test)
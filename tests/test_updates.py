@@ -0,0 +1,135 @@
+import asyncio
+import json
+
+from updates import OffsetFile, UpdateExecutor, update_chat_id, update_command
+
+
+def message(update_id, chat_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': text,
+            'chat': {'id': chat_id, 'type': 'group'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'test'}
+        }
+    }
+
+
+class FakeDispatcher:
+    def __init__(self, delays=None):
+        self.delays = delays or {}
+        self.log = []
+
+    async def process_update(self, update):
+        text = update.message.text
+        await asyncio.sleep(self.delays.get(text, 0))
+        self.log.append((update.message.chat.id, text))
+
+
+def test_update_command_and_chat():
+    assert update_command(message(1, -1, '/Coin@fpi_bot 5m')) == 'coin'
+    assert update_command(message(1, -1, 'hello')) is None
+    assert update_command({'update_id': 1, 'edited_message': {}}) is None
+    assert update_chat_id(message(1, -5, 'hi')) == -5
+
+
+def test_executor_keeps_order_within_chat():
+    async def main():
+        dp = FakeDispatcher({'slow': 0.05})
+        executor = UpdateExecutor(dp)
+        await executor.submit(message(1, -1, 'slow'))
+        await executor.submit(message(2, -1, 'fast'))
+        await executor.submit(message(3, -2, 'other chat'))
+        await executor.join()
+        return dp.log
+    log = asyncio.run(main())
+    assert [text for chat, text in log if chat == -1] == ['slow', 'fast']
+    # Другой чат не ждёт медленный
+    assert log[0] == (-2, 'other chat')
+
+
+def test_executor_reports_pending_and_done():
+    async def main():
+        done = []
+        executor = UpdateExecutor(FakeDispatcher({'slow': 0.05}))
+        executor.on_done = done.append
+        await executor.submit(message(2, -1, 'slow'))
+        await executor.submit(message(1, -2, 'slow'))
+        pending = [update['update_id'] for update in executor.pending()]
+        await executor.join()
+        return pending, done, executor.pending()
+    pending, done, after = asyncio.run(main())
+    assert pending == [1, 2]
+    assert sorted(done) == [1, 2]
+    assert after == []
+
+
+def test_executor_sheds_low_priority_when_busy():
+    async def main():
+        done = []
+        dp = FakeDispatcher({'slow': 0.05})
+        executor = UpdateExecutor(dp, shed_queue=1, low_priority=('dice',))
+        executor.on_done = done.append
+        await executor.submit(message(1, -1, 'slow'))
+        await executor.submit(message(2, -1, '/dice'))
+        await executor.submit(message(3, -1, '/ban'))
+        await executor.join()
+        return dp.log, done, executor.shed
+    log, done, shed = asyncio.run(main())
+    assert [text for _, text in log] == ['slow', '/ban']
+    assert shed == 1 and sorted(done) == [1, 2, 3]
+
+
+def test_executor_runs_detached_commands_outside_chat_queue():
+    async def main():
+        done = []
+        dp = FakeDispatcher({'/profile': 0.1})
+        executor = UpdateExecutor(dp, detached=('profile',))
+        executor.on_done = done.append
+        await executor.submit(message(1, -1, '/profile'))
+        await executor.submit(message(2, -1, 'spam'))
+        await asyncio.sleep(0.02)
+        early = list(dp.log)
+        await executor.join()
+        return early, dp.log, done
+    early, log, done = asyncio.run(main())
+    assert early == [(-1, 'spam')]
+    assert log == [(-1, 'spam'), (-1, '/profile')]
+    assert sorted(done) == [1, 2]
+
+
+def test_executor_backpressure_waits_for_space():
+    async def main():
+        executor = UpdateExecutor(FakeDispatcher({'slow': 0.02}), max_queue=2)
+        for update_id in range(1, 6):
+            await executor.submit(message(update_id, -update_id, 'slow'))
+            assert len(executor) <= 2
+        await executor.join()
+        return executor.peak, executor.processed
+    assert asyncio.run(main()) == (2, 5)
+
+
+def test_offset_file_checkpoint_and_replay(tmp_path):
+    path = str(tmp_path / 'offset')
+    offsets = OffsetFile(path)
+    assert offsets.load() is None
+    assert offsets.replay(None) == []
+
+    offsets.checkpoint(11, [message(9, -1, 'a'), message(10, -1, 'b')])
+    restored = OffsetFile(path)
+    assert restored.load() == 11
+    # Не ниже offset Telegram отдаст сам, такие из журнала не повторяются
+    assert [update['update_id'] for update in restored.replay(10)] == [9]
+    assert [update['update_id'] for update in restored.replay(restored.saved)] == [9, 10]
+
+    restored.checkpoint(12, [])
+    assert OffsetFile(path).load() == 12
+    assert json.loads((tmp_path / 'offset.pending').read_text()) == []
+
+
+def test_offset_file_ignores_broken_journal(tmp_path):
+    (tmp_path / 'offset').write_text('not a number')
+    (tmp_path / 'offset.pending').write_text('{broken')
+    offsets = OffsetFile(str(tmp_path / 'offset'))
+    assert offsets.load() is None
+    assert offsets.replay(None) == []
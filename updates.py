@@ -0,0 +1,458 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from queue import Empty, Full
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+# Номер воркера в текущем процессе (None - обычный режим с одним процессом)
+current_shard = None
+
+
+# Разовые задачи и отчёты в режиме воркеров выполняет только первый
+def is_main_shard():
+    return current_shard in (None, 0)
+
+# Разделы обновления, где лежит чат (по нему шардируем и сохраняем порядок)
+CHAT_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+               'my_chat_member', 'chat_member', 'chat_join_request')
+
+
+def update_chat_id(update):
+    for field in CHAT_FIELDS:
+        if field in update:
+            return update[field]['chat']['id']
+    if 'callback_query' in update:
+        message = update['callback_query'].get('message')
+        if message:
+            return message['chat']['id']
+        return update['callback_query']['from']['id']
+    for field in ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query'):
+        if field in update:
+            return update[field]['from']['id']
+    return 0
+
+
+# Команда из необработанного обновления (без разбора в types.Update)
+def update_command(update):
+    text = (update.get('message') or {}).get('text') or ''
+    if not text.startswith('/') or len(text) < 2:
+        return None
+    return text[1:].split(maxsplit=1)[0].split('@')[0].lower()
+
+
+async def fetch_updates(bot, offset=None, timeout=20, limit=100):
+    data = {"timeout": timeout, "limit": limit}
+    if offset is not None:
+        data["offset"] = offset
+    return await bot.request('getUpdates', data)
+
+
+# Запись через временный файл: при сбое остаётся прежнее содержимое, а не пустой файл
+def write_file(path, text):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+# Позиция в очереди обновлений на диске: после перезапуска очередь дочитывается, а не теряется.
+# getUpdates с offset подтверждает всё, что ниже, и Telegram эти обновления больше не отдаст,
+# поэтому принятые, но ещё не обработанные обновления перед каждым запросом пишутся рядом
+# ({path}.pending) и после перезапуска обрабатываются заново: возможен повтор, но не потеря
+class OffsetFile:
+    def __init__(self, path):
+        self.path = path
+        self.pending_path = f"{path}.pending"
+        self.saved = None
+        self.saved_pending = ()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.saved = int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            self.saved = None
+        return self.saved
+
+    def save(self, offset):
+        if offset == self.saved:
+            return
+        write_file(self.path, str(offset))
+        self.saved = offset
+
+    def load_pending(self):
+        try:
+            with open(self.pending_path) as f:
+                pending = json.load(f)
+        except FileNotFoundError:
+            pending = []
+        except ValueError as e:
+            logging.error(f"Unprocessed updates not loaded: {e}")
+            pending = []
+        self.saved_pending = tuple(update['update_id'] for update in pending)
+        return pending
+
+    def save_pending(self, pending):
+        ids = tuple(update['update_id'] for update in pending)
+        if ids == self.saved_pending:
+            return
+        write_file(self.pending_path, json.dumps(pending, ensure_ascii=False))
+        self.saved_pending = ids
+
+    # Перед getUpdates: сначала необработанные, потом offset - при сбое между записями
+    # обновления повторятся, а не потеряются
+    def checkpoint(self, offset, pending):
+        self.save_pending(pending)
+        self.save(offset)
+
+    # Необработанные с прошлого запуска; те, что не ниже offset, Telegram и так отдаст снова
+    def replay(self, offset):
+        return [update for update in self.load_pending() if offset is None or update['update_id'] < offset]
+
+
+# Стартовый offset: сохранённый, а без него (первый запуск) - пропуск накопившихся обновлений
+async def initial_offset(bot, offsets=None, skip_updates=True):
+    offset = offsets.load() if offsets is not None else None
+    if offset is None and skip_updates:
+        last = await bot.request('getUpdates', {"offset": -1, "timeout": 0})
+        if last:
+            offset = last[-1]['update_id'] + 1
+    return offset
+
+
+def message_age(message):
+    return time.time() - message.date.timestamp()
+
+
+# Устаревшее сообщение (дочитываем очередь после простоя)
+def is_stale(message, stale_seconds):
+    return message.date is not None and message_age(message) > stale_seconds
+
+
+# При дочитывании очереди команды "для красоты" (игры, справка, приветствия) пропускаются:
+# ответ через несколько минут никому не нужен, а модерация и действия админов выполняются
+class StaleUpdateMiddleware(BaseMiddleware):
+    def __init__(self, stale_seconds=60, commands=(), content_types=()):
+        self.stale_seconds = stale_seconds
+        self.commands = frozenset(commands)
+        self.content_types = frozenset(content_types)
+        self.skipped = 0
+        super(StaleUpdateMiddleware, self).__init__()
+
+    async def on_process_message(self, message: types.Message, _):
+        if not is_stale(message, self.stale_seconds):
+            return
+        if message.content_type in self.content_types or message.get_command(pure=True) in self.commands:
+            self.skipped += 1
+            raise CancelHandler()
+
+
+# Исполнитель обновлений: очередь FIFO на каждый чат (порядок внутри чата сохраняется),
+# разные чаты обрабатываются параллельно, но не больше concurrency обработчиков сразу.
+# При переполнении приём обновлений ждёт (backpressure), а развлечения отбрасываются.
+# Долгие команды (detached: профилирование, анимации игр) идут мимо очереди чата,
+# иначе модерация чата ждала бы их окончания
+class UpdateExecutor:
+    def __init__(self, dp, concurrency=32, max_queue=1000, shed_queue=500, low_priority=(), detached=()):
+        self.dp = dp
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.shed_queue = shed_queue
+        self.low_priority = frozenset(low_priority)
+        self.detached = frozenset(detached)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.space = asyncio.Event()
+        self.queues = {}         # chat_id -> deque(update), есть только у чатов с работой
+        self.unfinished = {}     # update_id -> обновление: принятые, но ещё не обработанные
+        self.on_done = None      # вызывается с update_id обработанного или отброшенного обновления
+        self.in_flight = 0
+        self.processed = 0
+        self.shed = 0
+        self.peak = 0
+
+    @classmethod
+    def from_config(cls, dp, config, low_priority=(), detached=(), section='Updates'):
+        return cls(
+            dp,
+            config.getint(section, 'concurrency', fallback=32),
+            config.getint(section, 'max_queue', fallback=1000),
+            config.getint(section, 'shed_queue', fallback=500),
+            low_priority,
+            detached
+        )
+
+    def __len__(self):
+        return len(self.unfinished)
+
+    async def submit(self, update):
+        command = update_command(update)
+        if len(self.unfinished) >= self.shed_queue and command in self.low_priority:
+            self.shed += 1
+            self.done(update)
+            return
+        while len(self.unfinished) >= self.max_queue:
+            self.space.clear()
+            await self.space.wait()
+        self.unfinished[update['update_id']] = update
+        self.peak = max(self.peak, len(self.unfinished))
+        if command in self.detached:
+            asyncio.create_task(self.process(update))
+            return
+        chat_id = update_chat_id(update)
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            self.queues[chat_id] = deque([update])
+            asyncio.create_task(self.drain(chat_id))
+        else:
+            queue.append(update)
+
+    async def drain(self, chat_id):
+        queue = self.queues[chat_id]
+        while queue:
+            await self.process(queue[0])
+            queue.popleft()
+        del self.queues[chat_id]
+
+    async def process(self, update):
+        # Семафор берётся на одно обновление: загруженный чат не держит слот за собой
+        async with self.semaphore:
+            self.in_flight += 1
+            try:
+                await self.dp.process_update(types.Update(**update))
+            except Exception as e:
+                logging.error(f"Failed to process update {update['update_id']}: {e}")
+            finally:
+                self.in_flight -= 1
+        del self.unfinished[update['update_id']]
+        self.processed += 1
+        self.done(update)
+        self.space.set()
+
+    def done(self, update):
+        if self.on_done is not None:
+            self.on_done(update['update_id'])
+
+    # Принятые, но не обработанные обновления (для OffsetFile.save_pending)
+    def pending(self):
+        return [self.unfinished[update_id] for update_id in sorted(self.unfinished)]
+
+    async def join(self):
+        while self.unfinished:
+            self.space.clear()
+            await self.space.wait()
+
+    def stats(self):
+        depths = sorted((len(queue) for queue in self.queues.values()), reverse=True)
+        return {
+            'pending': len(self.unfinished),
+            'chats': len(self.queues),
+            'deepest': depths[0] if depths else 0,
+            'in_flight': self.in_flight,
+            'concurrency': self.concurrency,
+            'processed': self.processed,
+            'shed': self.shed,
+            'peak': self.peak
+        }
+
+
+async def close_executor(executor, timeout=10):
+    try:
+        await asyncio.wait_for(executor.join(), timeout)
+    except asyncio.TimeoutError:
+        logging.warning(f"Shutdown with {len(executor)} unprocessed updates")
+
+
+# Один процесс: getUpdates пачками до 100; перед каждым запросом (он подтверждает прошлую
+# пачку) offset и необработанные обновления сохраняются, после перезапуска те обрабатываются заново
+async def polling_loop(dp, offsets=None, on_startup=None, on_shutdown=None, skip_updates=True, executor=None):
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    executor = executor or UpdateExecutor(dp)
+    if on_startup:
+        await on_startup(dp)
+    offset = await initial_offset(dp.bot, offsets, skip_updates)
+    catching_up = offsets is not None and offsets.saved is not None
+    backlog = 0
+    try:
+        if offsets is not None:
+            replay = offsets.replay(offset)
+            if replay:
+                logging.info(f"Replaying {len(replay)} unprocessed updates")
+            for update in replay:
+                await executor.submit(update)
+        while True:
+            if offsets is not None and offset is not None:
+                offsets.checkpoint(offset, executor.pending())
+            try:
+                # Пока дочитываем очередь - без ожидания, пачка за пачкой
+                updates = await fetch_updates(dp.bot, offset, timeout=0 if catching_up else 20)
+            except Exception as e:
+                logging.error(f"getUpdates failed: {e}")
+                await asyncio.sleep(5)
+                continue
+            if not updates:
+                if catching_up:
+                    logging.info(f"Caught up with backlog: {backlog} updates")
+                    catching_up = False
+                continue
+            if catching_up:
+                backlog += len(updates)
+            offset = updates[-1]['update_id'] + 1
+            for update in updates:
+                await executor.submit(update)
+    finally:
+        await close_executor(executor)
+        # Не успевшие обработаться за время остановки обработаются после запуска
+        if offsets is not None and offset is not None:
+            offsets.checkpoint(offset, executor.pending())
+        if on_shutdown:
+            await on_shutdown(dp)
+        await dp.storage.close()
+        session = await dp.bot.get_session()
+        await session.close()
+
+
+def run_polling(dp, offsets=None, on_startup=None, on_shutdown=None, skip_updates=True, executor=None):
+    try:
+        asyncio.run(polling_loop(dp, offsets, on_startup, on_shutdown, skip_updates, executor))
+    except KeyboardInterrupt:
+        pass
+
+
+# Воркер: свой цикл событий и свой исполнитель (копия после fork), чаты по порядку.
+# В done уходят update_id обработанных обновлений - приёмщик вычёркивает их из сохранённых
+def run_worker(dp, shard, queue, on_startup=None, on_shutdown=None, executor=None, done=None):
+    asyncio.run(worker_loop(dp, shard, queue, on_startup, on_shutdown, executor, done))
+
+
+async def worker_loop(dp, shard, queue, on_startup=None, on_shutdown=None, executor=None, done=None):
+    global current_shard
+    current_shard = shard
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    loop = asyncio.get_running_loop()
+    executor = executor or UpdateExecutor(dp)
+    if done is not None:
+        executor.on_done = done.put_nowait
+    if on_startup:
+        await on_startup(dp)
+    logging.info(f"Worker {shard} started")
+    try:
+        while True:
+            batch = await loop.run_in_executor(None, queue.get)
+            if batch is None:
+                break
+            for update in batch:
+                await executor.submit(update)
+    finally:
+        await close_executor(executor)
+        if on_shutdown:
+            await on_shutdown(dp)
+        await dp.storage.close()
+        session = await dp.bot.get_session()
+        await session.close()
+
+
+# Обработанные воркерами обновления больше не нужно хранить
+def collect_done(done, pending):
+    if done is None:
+        return
+    while True:
+        try:
+            pending.pop(done.get_nowait(), None)
+        except Empty:
+            return
+
+
+# Приёмщик: один getUpdates на всех, раздача пачками в очередь воркера по chat_id.
+# Пачки в очередях и у воркеров после подтверждения у Telegram есть только в памяти,
+# поэтому, как и в polling_loop, перед каждым запросом не обработанные воркерами
+# обновления (pending, update_id -> обновление) сохраняются и после перезапуска раздаются снова
+async def ingest(bot, queues, offsets=None, skip_updates=True, done=None, pending=None):
+    loop = asyncio.get_running_loop()
+    offset = await initial_offset(bot, offsets, skip_updates)
+    workers = len(queues)
+    pending = {} if pending is None else pending
+
+    async def dispatch(updates):
+        batches = {}
+        for update in updates:
+            pending[update['update_id']] = update
+            batches.setdefault(update_chat_id(update) % workers, []).append(update)
+        for shard, batch in batches.items():
+            await loop.run_in_executor(None, queues[shard].put, batch)
+
+    if offsets is not None:
+        replay = offsets.replay(offset)
+        if replay:
+            logging.info(f"Replaying {len(replay)} unprocessed updates")
+        await dispatch(replay)
+    while True:
+        if offsets is not None and offset is not None:
+            collect_done(done, pending)
+            offsets.checkpoint(offset, [pending[update_id] for update_id in sorted(pending)])
+        try:
+            updates = await fetch_updates(bot, offset)
+        except Exception as e:
+            logging.error(f"getUpdates failed: {e}")
+            await asyncio.sleep(5)
+            continue
+        if not updates:
+            continue
+        offset = updates[-1]['update_id'] + 1
+        await dispatch(updates)
+
+
+# Режим нескольких процессов: fork делается до запуска цикла событий,
+# поэтому воркеры получают уже настроенный dp без повторного импорта модуля
+def run_sharded(dp, workers, on_startup=None, on_shutdown=None, offsets=None, skip_updates=True, executor=None):
+    context = multiprocessing.get_context('fork')
+    queues = [context.Queue(maxsize=100) for _ in range(workers)]
+    done = context.Queue() if offsets is not None else None
+    pending = {}
+    processes = [
+        context.Process(
+            target=run_worker,
+            args=(dp, shard, queues[shard], on_startup, on_shutdown, executor, done),
+            name=f"worker-{shard}",
+            daemon=True
+        )
+        for shard in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    logging.info(f"Started {workers} workers")
+    try:
+        asyncio.run(ingest(dp.bot, queues, offsets, skip_updates, done, pending))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Упавшему воркеру сигнал не нужен, а полная очередь живого не должна вешать остановку:
+        # не принявший сигнал воркер останавливается по таймауту
+        for process, queue in zip(processes, queues):
+            if not process.is_alive():
+                continue
+            try:
+                queue.put_nowait(None)
+            except Full:
+                logging.warning(f"{process.name} queue is full, stopping it after timeout")
+        for process in processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                logging.warning(f"{process.name} did not stop, terminating")
+                process.terminate()
+                process.join(timeout=5)
+        # Непрочитанные пачки остались в журнале pending; выход не ждёт их записи в трубу
+        for queue in queues:
+            queue.cancel_join_thread()
+        # Не дождавшиеся обработки воркерами раздадутся после запуска
+        if offsets is not None and offsets.saved is not None:
+            collect_done(done, pending)
+            offsets.checkpoint(offsets.saved, [pending[update_id] for update_id in sorted(pending)])